@@ -0,0 +1,164 @@
+# chat_context.py
+"""
+Token-budgeted conversation context for the multi-turn chat clients.
+
+Instead of resending the whole history on every turn, ContextWindow selects the
+messages that fit in a per-model token budget: the system prompt, an optional
+rolling summary of the turns that no longer fit, and the most recent turns.
+
+Run `python chat_context.py` for a self-check on a long synthetic conversation.
+"""
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+CHARS_PER_TOKEN = 4          # rough average for English text with BPE tokenizers
+MESSAGE_OVERHEAD_TOKENS = 4  # role markers added by the chat template around each message
+SUMMARY_WORDS = 200
+SUMMARY_MAX_TOKENS = 320     # room kept for a summary of SUMMARY_WORDS words
+
+SUMMARY_PROMPT = (
+    "You maintain a concise running summary of a conversation between a user and an assistant. "
+    "Merge the new messages into the current summary. Keep facts, names, numbers and decisions; "
+    "drop pleasantries. Answer with the updated summary only, in at most {words} words."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Tokenizer-free estimate: about 4 characters per token."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def load_token_counter(tokenizer_name: str = "") -> Callable[[str], int]:
+    """
+    Returns a function counting the tokens of a text.
+    - tokenizer_name: a Hugging Face tokenizer (e.g. "microsoft/Phi-4-mini-reasoning") for exact
+      counts (requires `pip install transformers`); empty for the fast estimate.
+    """
+    if not tokenizer_name:
+        return estimate_tokens
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def format_for_summary(previous_summary: str, messages: List[dict]) -> List[dict]:
+    """Builds the chat messages asking a model to fold `messages` into `previous_summary`."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT.format(words=SUMMARY_WORDS)},
+        {"role": "user", "content": f"Current summary:\n{previous_summary or '(empty)'}\n\nNew messages:\n{transcript}"},
+    ]
+
+
+class ContextWindow:
+    """
+    Chooses the messages of the history sent to the model on each turn.
+
+    The leading system messages and the most recent turns that fit in the budget are kept.
+    When the history overflows, the start of the window jumps forward by whole turns until
+    the prompt falls under `low_water` of the budget, rather than sliding by one turn on every
+    request: the beginning of the prompt then stays identical for several turns, so vLLM's
+    automatic prefix caching keeps serving it from the KV cache.
+
+    With a `summarize(previous_summary, evicted_messages) -> str` callable, evicted turns are
+    folded into a rolling summary appended to the system prompt. It only changes when the window
+    moves, for the same reason.
+    """
+
+    def __init__(self, budget_tokens: int, count_tokens: Callable[[str], int] = estimate_tokens,
+                 low_water: float = 0.75, summarize: Optional[Callable[[str, List[dict]], str]] = None):
+        self.budget_tokens = budget_tokens
+        self.low_water = low_water
+        self.summarize = summarize
+        self.set_token_counter(count_tokens)
+        self.start = 0           # index in the history of the first non-system message sent
+        self.summary = ""
+        self.prompt_tokens = 0   # size of the last prompt built
+        self.dropped = 0         # messages of the history left out of the last prompt
+
+    def set_token_counter(self, count_tokens: Callable[[str], int]):
+        if getattr(self, "_counter", None) is not count_tokens:
+            self._counter = count_tokens
+            # Memoized: the same messages are counted again on every turn
+            self._count = lru_cache(maxsize=4096)(count_tokens)
+
+    def message_tokens(self, message: dict) -> int:
+        return self._count(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+    def _turn_end(self, history: List[dict], start: int) -> int:
+        """Index after the turn beginning at `start` (up to the next user message), never the last message."""
+        end = start + 1
+        while end < len(history) - 1 and history[end]["role"] != "user":
+            end += 1
+        return min(end, len(history) - 1)
+
+    def build(self, history: List[dict], reserve_tokens: int = 0) -> List[dict]:
+        """
+        Returns the messages to send for `history`, keeping `reserve_tokens` of the budget
+        for the answer (the request's max_tokens).
+        """
+        lead = 0
+        while lead < len(history) and history[lead]["role"] == "system":
+            lead += 1
+        if self.start < lead or self.start > len(history):
+            # New conversation, or the history was reset
+            self.start, self.summary = lead, ""
+
+        budget = max(self.budget_tokens - reserve_tokens, 0)
+        fixed = sum(self.message_tokens(m) for m in history[:lead])
+        window = sum(self.message_tokens(m) for m in history[self.start:])
+
+        def total(summary_allowance: int = 0) -> int:
+            summary = self._count(self.summary) + MESSAGE_OVERHEAD_TOKENS if self.summary else 0
+            return fixed + max(summary, summary_allowance) + window
+
+        # While evicting, leave room for the summary the evicted turns will produce;
+        # a second pass handles a summary that outgrew it.
+        allowance = SUMMARY_MAX_TOKENS if self.summarize else 0
+        for _ in range(2):
+            if total() <= budget:
+                break
+            evicted: List[dict] = []
+            while self.start < len(history) - 1 and total(allowance) > budget * self.low_water:
+                end = self._turn_end(history, self.start)
+                evicted += history[self.start:end]
+                window -= sum(self.message_tokens(m) for m in history[self.start:end])
+                self.start = end
+            if evicted and self.summarize:
+                self.summary = self.summarize(self.summary, evicted)
+
+        messages = [dict(m) for m in history[:lead]]
+        if self.summary:
+            note = f"Summary of the earlier conversation:\n{self.summary}"
+            if messages:
+                messages[-1]["content"] = f"{messages[-1]['content']}\n\n{note}"
+            else:
+                messages.append({"role": "system", "content": note})
+        messages += history[self.start:]
+        self.prompt_tokens = total()
+        self.dropped = self.start - lead
+        return messages
+
+
+def _self_check(turns: int = 200, budget: int = 2048, reserve: int = 512):
+    """Simulates a long conversation and checks the budget and the stability of the prompt prefix."""
+    for low_water in (1.0, 0.75):
+        history = [{"role": "system", "content": "You are a helpful assistant."}]
+        window = ContextWindow(budget, low_water=low_water, summarize=lambda previous, evicted: (previous + " " + evicted[0]["content"])[-1200:])
+        prefixes = []
+        for turn in range(turns):
+            history.append({"role": "user", "content": f"question {turn} " + "lorem ipsum " * 20})
+            messages = window.build(history, reserve_tokens=reserve)
+            assert window.prompt_tokens <= budget - reserve, window.prompt_tokens
+            assert messages[-1] is history[-1] and messages[0]["role"] == "system"
+            assert messages[1]["role"] == "user"  # the window starts on a whole turn
+            prefixes.append(tuple(m["content"] for m in messages[:2]))
+            history.append({"role": "assistant", "content": f"answer {turn} " + "dolor sit amet " * 30})
+
+        changes = sum(a != b for a, b in zip(prefixes, prefixes[1:]))
+        print(f"low_water={low_water}: {turns} turns within {budget - reserve} prompt tokens, "
+              f"the prompt prefix changed on {changes} turns")
+
+
+if __name__ == "__main__":
+    _self_check()
@@ -0,0 +1,304 @@
+# loadgen.py
+"""
+Headless load generator for the confidential chat endpoint (app.py + Caddy + vLLM).
+
+Sends streaming chat/completions requests in the same format as the Streamlit
+client, either with a fixed number of concurrent users (closed loop) or with
+Poisson arrivals at a target rate (open loop), and reports percentiles of:
+- TTFT: time to first token, from sending the request to the first content delta
+- ITL: inter-token latency, between two consecutive content deltas. Deltas are timed when a
+  network read returns them: the time since the previous read is spread evenly over the deltas
+  of a read, so several deltas read at once are not counted as 0 ms apart
+- end-to-end latency, per-request decode speed (tokens/s) and error rate
+
+    python loadgen.py --url https://<host>/v1/chat/completions --api-key ... \\
+        --concurrency 1,4,16 --requests 64 --report-json report.json --report-csv requests.csv
+    python loadgen.py --mock --concurrency 1,8,32   # offline, against mock_sse_server.py
+
+Requires `pip install httpx` (`httpx[http2]` for --http2).
+"""
+import csv
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import httpx
+
+from chat_stream import build_headers, build_chat_payload, parse_chat_event, SSEParser
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logging.getLogger("httpx").setLevel(logging.WARNING)  # no line per request
+
+DEFAULT_PROMPTS = [
+    "Explain what a Trusted Execution Environment is in two sentences.",
+    "List three benefits of confidential computing for healthcare data.",
+    "Write a short Python function that checks whether a number is prime.",
+    "Summarize the difference between encryption at rest, in transit and in use.",
+    "What is remote attestation and why does it matter for AI workloads?",
+]
+
+REQUEST_FIELDS = ["level", "request", "status", "error", "queue_s", "ttft_s", "latency_s",
+                  "output_tokens", "prompt_tokens", "decode_tokens_per_s", "itl_mean_s", "finish_reason"]
+
+
+def load_prompts(path: Optional[str]) -> List[list]:
+    """
+    Loads the prompt set as a list of chat message lists.
+    - .jsonl: one object per line, with "messages" (a chat history) or "prompt" (a user message)
+    - anything else: one user prompt per non-empty line
+    """
+    if not path:
+        lines = DEFAULT_PROMPTS
+    else:
+        lines = [line.strip() for line in Path(path).read_text(encoding="utf-8").splitlines() if line.strip()]
+    prompts = []
+    for line in lines:
+        if path and path.endswith(".jsonl"):
+            item = json.loads(line)
+            prompts.append(item["messages"] if "messages" in item else [{"role": "user", "content": item["prompt"]}])
+        else:
+            prompts.append([{"role": "user", "content": line}])
+    if not prompts:
+        raise ValueError(f"No prompts found in {path}")
+    return prompts
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Linear-interpolated percentile (pct in 0..100); None for an empty list."""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def distribution(values: List[float]) -> dict:
+    return {
+        "mean": sum(values) / len(values) if values else None,
+        **{f"p{p}": percentile(values, p) for p in (50, 90, 95, 99)},
+        "max": max(values) if values else None,
+    }
+
+
+async def send_request(client: httpx.AsyncClient, url: str, headers: dict, payload: dict) -> dict:
+    """Sends one streaming request and measures its timings at the client."""
+    result = {"status": None, "error": "", "ttft_s": None, "latency_s": None, "output_tokens": 0,
+              "prompt_tokens": None, "finish_reason": None, "itl": []}
+    start = time.perf_counter()
+    first = last = None
+    deltas = 0
+    try:
+        async with client.stream("POST", url, headers=headers, json=payload) as resp:
+            result["status"] = resp.status_code
+            if resp.status_code != 200:
+                await resp.aread()
+                result["error"] = f"HTTP {resp.status_code}"
+                return result
+            parser = SSEParser()
+            async for chunk in resp.aiter_bytes():
+                now = time.perf_counter()
+                read_deltas = 0
+                for event in parser.feed(chunk):
+                    delta = parse_chat_event(event.data)
+                    if delta is None or delta.done:
+                        continue
+                    if delta.content:
+                        read_deltas += 1
+                        deltas += 1
+                    if delta.finish_reason:
+                        result["finish_reason"] = delta.finish_reason
+                    if delta.usage:
+                        result["prompt_tokens"] = delta.usage.get("prompt_tokens")
+                        result["output_tokens"] = delta.usage.get("completion_tokens") or deltas
+                if read_deltas:
+                    if first is None:
+                        first = now  # the deltas read with the first token start the intervals
+                    else:
+                        result["itl"] += [(now - last) / read_deltas] * read_deltas
+                    last = now
+    except Exception as e:
+        # Network errors, but also a bad payload or a decoding error: counted as a failed
+        # request instead of ending the worker task (and losing the request from the summary)
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    end = time.perf_counter()
+    result["latency_s"] = end - start
+    result["output_tokens"] = result["output_tokens"] or deltas
+    if first is None:
+        result["error"] = "no tokens received"
+    else:
+        result["ttft_s"] = first - start
+    return result
+
+
+async def run_level(client: httpx.AsyncClient, args, prompts: List[list], headers: dict,
+                    concurrency: int, rate: float) -> tuple:
+    """
+    Runs args.requests requests, with at most `concurrency` in flight.
+    rate > 0 schedules Poisson arrivals at `rate` requests/s (open loop); requests
+    that find every slot busy wait, and the wait is reported as queue_s.
+    Returns (per-request records, wall-clock seconds).
+    """
+    rng = random.Random(args.seed)
+    slots = asyncio.Semaphore(concurrency)
+    records = []
+
+    async def one(i: int):
+        scheduled = time.perf_counter()
+        async with slots:
+            queue_s = time.perf_counter() - scheduled
+            payload = build_chat_payload(args.model, prompts[i % len(prompts)], args.temperature, args.max_tokens)
+            result = await send_request(client, args.url, headers, payload)
+        result.update(request=i, queue_s=queue_s)
+        records.append(result)
+
+    start = time.perf_counter()
+    tasks = []
+    for i in range(args.requests):
+        if rate > 0 and i:
+            await asyncio.sleep(rng.expovariate(rate))
+        tasks.append(asyncio.create_task(one(i)))
+    await asyncio.gather(*tasks)
+    return sorted(records, key=lambda r: r["request"]), time.perf_counter() - start
+
+
+def summarize(label: str, concurrency: int, rate: float, records: List[dict], wall_s: float) -> dict:
+    ok = [r for r in records if not r["error"]]
+    itl = [x for r in ok for x in r["itl"]]
+    decode = [r["decode_tokens_per_s"] for r in ok if r["decode_tokens_per_s"]]
+    output_tokens = sum(r["output_tokens"] for r in ok)
+    return {
+        "level": label,
+        "concurrency": concurrency,
+        "target_rate_rps": rate or None,
+        "requests": len(records),
+        "errors": len(records) - len(ok),
+        "error_rate": (len(records) - len(ok)) / len(records) if records else 0.0,
+        "wall_s": wall_s,
+        "throughput_rps": len(ok) / wall_s,
+        "output_tokens_per_s": output_tokens / wall_s,
+        "ttft_s": distribution([r["ttft_s"] for r in ok]),
+        "itl_s": distribution(itl),
+        "latency_s": distribution([r["latency_s"] for r in ok]),
+        "queue_s": distribution([r["queue_s"] for r in records]),
+        "decode_tokens_per_s": distribution(decode),
+    }
+
+
+def fmt_ms(seconds: Optional[float]) -> str:
+    return f"{seconds * 1000:8.1f}" if seconds is not None else "       -"
+
+
+def print_summary(s: dict):
+    print(
+        f"{s['level']:>14} | {s['requests']:>5} req {s['error_rate']:6.1%} err | "
+        f"{s['throughput_rps']:7.2f} req/s {s['output_tokens_per_s']:9.1f} tok/s | "
+        f"TTFT p50/p95/p99 {fmt_ms(s['ttft_s']['p50'])}{fmt_ms(s['ttft_s']['p95'])}{fmt_ms(s['ttft_s']['p99'])} ms | "
+        f"ITL p50/p95/p99 {fmt_ms(s['itl_s']['p50'])}{fmt_ms(s['itl_s']['p95'])}{fmt_ms(s['itl_s']['p99'])} ms"
+    )
+
+
+async def run(args) -> Tuple[dict, List[dict]]:
+    prompts = load_prompts(args.prompts)
+    headers = build_headers(args.api_key, args.header_mode)
+    concurrencies = [int(c) for c in args.concurrency.split(",")]
+    rates = [float(r) for r in args.rate.split(",")] if args.rate else [0.0]
+    levels = [(c, r) for r in rates for c in concurrencies]
+
+    limits = httpx.Limits(max_connections=max(concurrencies), max_keepalive_connections=max(concurrencies))
+    timeout = httpx.Timeout(args.timeout, connect=10)
+    report = {"config": {k: v for k, v in vars(args).items() if k != "api_key"}, "levels": []}
+    rows = []
+    async with httpx.AsyncClient(http2=args.http2, verify=not args.insecure, limits=limits, timeout=timeout) as client:
+        if args.warmup:
+            logging.info(f"Warming up with {args.warmup} requests...")
+            payload = build_chat_payload(args.model, prompts[0], args.temperature, args.max_tokens)
+            await asyncio.gather(*(send_request(client, args.url, headers, payload) for _ in range(args.warmup)))
+        for concurrency, rate in levels:
+            label = f"c={concurrency}" + (f" r={rate:g}/s" if rate else "")
+            logging.info(f"Running {args.requests} requests at {label}...")
+            records, wall_s = await run_level(client, args, prompts, headers, concurrency, rate)
+            for r in records:
+                decode_s = r["latency_s"] - r["ttft_s"] if r["ttft_s"] is not None else 0
+                r["decode_tokens_per_s"] = (r["output_tokens"] - 1) / decode_s if decode_s > 0 and r["output_tokens"] > 1 else None
+                r["itl_mean_s"] = sum(r["itl"]) / len(r["itl"]) if r["itl"] else None
+                rows.append({"level": label, **{k: r.get(k) for k in REQUEST_FIELDS if k != "level"}})
+            summary = summarize(label, concurrency, rate, records, wall_s)
+            report["levels"].append(summary)
+            print_summary(summary)
+    return report, rows
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Parse command-line arguments.
+    """
+    p = argparse.ArgumentParser(description="Load generator and latency benchmark for the confidential chat endpoint.")
+    p.add_argument("--url", help="chat/completions URL, e.g. https://<host>/v1/chat/completions")
+    p.add_argument("--mock", action="store_true", help="Start the bundled mock SSE server and target it (offline test).")
+    p.add_argument("--api-key", default="", help="API key sent to the endpoint.")
+    p.add_argument("--header-mode", choices=["X-API-Key", "Authorization: Bearer"], default="X-API-Key",
+                   help="Authentication header (default: X-API-Key).")
+    p.add_argument("--model", default="/dev/shm/decrypted_model", help="Model name or path served by vLLM.")
+    p.add_argument("--prompts", help="Prompt set: a text file (one prompt per line) or a .jsonl file with 'prompt' or 'messages'.")
+    p.add_argument("--concurrency", default="1,4,16",
+                   help="Comma-separated numbers of concurrent requests; each one is a load level (default: 1,4,16).")
+    p.add_argument("--rate", help="Comma-separated Poisson arrival rates in requests/s (open loop); "
+                                  "--concurrency then caps the requests in flight.")
+    p.add_argument("--requests", type=int, default=32, help="Requests per load level (default: 32).")
+    p.add_argument("--warmup", type=int, default=1, help="Unmeasured requests sent first (default: 1).")
+    p.add_argument("--max-tokens", type=int, default=256, help="max_tokens of each request (default: 256).")
+    p.add_argument("--temperature", type=float, default=0.2)
+    p.add_argument("--timeout", type=float, default=180, help="Read timeout per request in seconds (default: 180).")
+    p.add_argument("--http2", action="store_true", help="Multiplex the requests over HTTP/2 (requires httpx[http2]).")
+    p.add_argument("--insecure", action="store_true", help="Do not verify the TLS certificate (self-signed certificates).")
+    p.add_argument("--seed", type=int, default=0, help="Seed of the arrival process.")
+    p.add_argument("--report-json", help="Write the per-level summary (percentiles) to this JSON file.")
+    p.add_argument("--report-csv", help="Write one row per request to this CSV file.")
+    args = p.parse_args()
+    if not args.url and not args.mock:
+        p.error("--url or --mock is required")
+    return args
+
+
+def main():
+    args = parse_args()
+    server = None
+    if args.mock:
+        from mock_sse_server import start_mock_server
+        server, args.url = start_mock_server(api_key=args.api_key or None)
+        logging.info(f"Mock SSE server started on {args.url}")
+
+    try:
+        report, rows = asyncio.run(run(args))
+    finally:
+        if server:
+            server.shutdown()
+
+    if args.report_json:
+        Path(args.report_json).write_text(json.dumps(report, indent=2))
+        logging.info(f"Summary -> '{args.report_json}'")
+    if args.report_csv:
+        with open(args.report_csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=REQUEST_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        logging.info(f"Per-request records -> '{args.report_csv}'")
+    if any(level["errors"] for level in report["levels"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
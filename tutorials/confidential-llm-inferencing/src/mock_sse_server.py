@@ -0,0 +1,123 @@
+# mock_sse_server.py
+"""
+Local stand-in for the OpenAI-compatible /v1/chat/completions endpoint of vLLM,
+streaming synthetic tokens over SSE with a configurable time to first token,
+inter-token delay and error rate. Used to exercise loadgen.py offline:
+
+    python mock_sse_server.py --port 8001 --ttft-ms 150 --itl-ms 20
+"""
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, chunked responses
+
+    def log_message(self, format, *args):
+        pass  # one line per request would drown the load generator output
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        cfg = self.server.config
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if cfg["api_key"]:
+            auth = self.headers.get("X-API-Key") or self.headers.get("Authorization", "").removeprefix("Bearer ")
+            if auth != cfg["api_key"]:
+                return self._send_json(401, {"error": "invalid API key"})
+        try:
+            request = json.loads(body)
+        except json.JSONDecodeError:
+            return self._send_json(400, {"error": "invalid JSON"})
+        if random.random() < cfg["error_rate"]:
+            return self._send_json(503, {"error": "simulated overload"})
+
+        max_tokens = int(request.get("max_tokens") or cfg["tokens"])
+        n_tokens = min(max_tokens, cfg["tokens"])
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in request.get("messages", []))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": request.get("model", "mock")}
+        time.sleep(cfg["ttft_ms"] / 1000)
+        for i in range(n_tokens):
+            if i:
+                time.sleep(cfg["itl_ms"] / 1000)
+            finish = None if i < n_tokens - 1 else ("length" if n_tokens == max_tokens else "stop")
+            event = dict(chunk, choices=[{"index": 0, "delta": {"content": f"tok{i} "}, "finish_reason": finish}])
+            self._send_chunk(b"data: " + json.dumps(event).encode() + b"\n\n")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": n_tokens, "total_tokens": prompt_tokens + n_tokens}
+            self._send_chunk(b"data: " + json.dumps(dict(chunk, choices=[], usage=usage)).encode() + b"\n\n")
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")  # last chunk
+
+
+def start_mock_server(host: str = "127.0.0.1", port: int = 0, tokens: int = 128, ttft_ms: float = 100,
+                      itl_ms: float = 10, error_rate: float = 0.0, api_key: str = None):
+    """
+    Starts the mock server in a background thread.
+    Returns (server, url); call server.shutdown() to stop it. port=0 picks a free port.
+    """
+    server = ThreadingHTTPServer((host, port), MockChatHandler)
+    server.daemon_threads = True
+    server.config = {"tokens": tokens, "ttft_ms": ttft_ms, "itl_ms": itl_ms,
+                     "error_rate": error_rate, "api_key": api_key}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://{host}:{server.server_address[1]}/v1/chat/completions"
+    return server, url
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Parse command-line arguments.
+    """
+    p = argparse.ArgumentParser(description="Mock OpenAI-compatible streaming chat endpoint for offline load tests.")
+    p.add_argument("--host", default="127.0.0.1", help="Bind address (default: 127.0.0.1).")
+    p.add_argument("--port", type=int, default=8001, help="Port (default: 8001).")
+    p.add_argument("--tokens", type=int, default=128, help="Tokens streamed per answer, capped by max_tokens (default: 128).")
+    p.add_argument("--ttft-ms", type=float, default=100, help="Delay before the first token (default: 100 ms).")
+    p.add_argument("--itl-ms", type=float, default=10, help="Delay between tokens (default: 10 ms).")
+    p.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 503 (default: 0).")
+    p.add_argument("--api-key", help="If set, require this key in X-API-Key or Authorization: Bearer.")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    server, url = start_mock_server(args.host, args.port, args.tokens, args.ttft_ms, args.itl_ms,
+                                    args.error_rate, args.api_key)
+    logging.info(f"Mock chat endpoint listening on {url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,45 @@
-import json
+import io
+import csv
+import time
+import queue
+import socket
+import importlib.util
+import statistics
+import threading
 import requests
 import streamlit as st
+from streamlit.runtime.scriptrunner import RerunException, StopException
 from html import escape
+from typing import Optional
+from urllib.parse import urlparse
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from think_parser import ThinkTagParser, THINK_DELTA, VISIBLE_DELTA
+from chat_stream import ChatStreamError, build_headers, build_chat_payload, iter_chat_deltas
+from chat_context import ContextWindow, estimate_tokens, format_for_summary, load_token_counter
+from response_cache import ResponseCache
+from turn_store import Turn, TurnStore
 
 # =========================
 # Page Configuration
 # =========================
 st.set_page_config(page_title="LLM Client (Confidential GPU)", layout="wide")
 
+# httpx is optional: it is only needed for HTTP/2 connections to the LLM endpoint.
+try:
+    import httpx
+    HAS_HTTPX = True
+except Exception:
+    HAS_HTTPX = False
+
+# httpx.Client(http2=True) raises ImportError without the h2 package (httpx[http2] extra)
+HAS_HTTP2 = HAS_HTTPX and importlib.util.find_spec("h2") is not None
+
+HTTP_ERRORS = (requests.exceptions.RequestException,) + ((httpx.HTTPError,) if HAS_HTTPX else ())
+# Raised by Streamlit in the script thread to stop or rerun it (stop button or any other interaction)
+STREAMLIT_INTERRUPTS = (StopException, RerunException)
+STREAM_POLL_S = 0.2  # while no token arrives, how often a run checks for a stop (see stream_chat_completions)
+
 # =========================
 # Styles
 # =========================
@@ -60,30 +92,188 @@ st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 # =========================
 # Session state
 # =========================
-if "messages" not in st.session_state:
-    # Message history sent to model (without <think>)
-    st.session_state.messages = []
+if "history" not in st.session_state:
+    # Every turn, stored once (see turn_store.py): the UI shows content, reasoning and metrics,
+    # history.messages is what is sent to the model (without <think>)
+    st.session_state.history = TurnStore()
+
+if "latency_log" not in st.session_state:
+    # Metrics of every answered turn of the session (see format_metrics)
+    st.session_state.latency_log = []
+
+if "response_cache" not in st.session_state:
+    # Per session: cached answers are never replayed to other users of the app
+    st.session_state.response_cache = ResponseCache()
 
-if "turns" not in st.session_state:
-    # Rich history for display: we also memorize the 'think' of each response
-    # Each item: {"role": "user|assistant|system", "content": "...", "think": "...(optional)"}
-    st.session_state.turns = []
+if "context" not in st.session_state:
+    # Selects the part of the history sent to the model (see chat_context.py)
+    st.session_state.context = ContextWindow(budget_tokens=8192)
 
 # =========================
 # Utilities
 # =========================
-def build_headers(api_key: str, header_mode: str):
+@st.cache_resource(show_spinner=False)
+def get_http_client(use_http2: bool = False, pool_size: int = 10, verify_ssl: bool = True):
+    """
+    Returns a pooled HTTP client shared by every session and rerun of the app (one per
+    configuration), so chat turns reuse keep-alive TCP/TLS connections to the front end
+    instead of paying a new handshake each time.
+    - use_http2: multiplex the requests over one HTTP/2 connection (requires `pip install httpx[http2]`)
+    - pool_size: maximum number of pooled connections
+    """
+    if use_http2 and HAS_HTTP2:
+        return httpx.Client(
+            http2=True,
+            verify=verify_ssl,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(180, connect=10),
+        )
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.verify = verify_ssl
+    return session
+
+
+@contextmanager
+def open_event_stream(client, url: str, headers: dict, payload: dict, on_response=None):
+    """
+    POSTs a streaming request with the pooled client and yields an iterator over the raw body
+    chunks, as they arrive, for the SSE parser of chat_stream.py.
+    on_response(resp) is called as soon as the response headers are received (status checked).
+    """
+    if HAS_HTTPX and isinstance(client, httpx.Client):
+        stream = client.stream("POST", url, headers=headers, json=payload)
+    else:
+        stream = client.post(url, headers=headers, json=payload, stream=True, timeout=(10, 180))
+
+    # Leaving the block early (stop button, rerun, closed page) closes the connection instead of
+    # returning it to the pool: Caddy then cancels the upstream request and vLLM aborts the generation.
+    with stream as resp:
+        resp.raise_for_status()
+        if on_response:
+            on_response(resp)
+        chunks = resp.iter_bytes() if HAS_HTTPX and isinstance(resp, httpx.Response) else resp.iter_content(chunk_size=None)
+        yield chunks
+        # Read the end of the body (after [DONE]) so the connection goes back to the pool
+        for _ in chunks:
+            pass
+
+
+class _StreamStopped(Exception):
+    """Raised inside open_event_stream to close the connection, so the server aborts the generation."""
+
+
+def abort_stream(resp):
     """
-    Builds authentication headers.
-    - header_mode: "X-API-Key" or "Authorization: Bearer"
+    Aborts a streaming response read by another thread. Closing the response does not wake up
+    a read blocked on the socket (e.g. during the prefill), shutting the socket down does.
+    An HTTP/2 connection is shared by other requests: only the stream is closed.
     """
-    headers = {"Content-Type": "application/json"}
-    if api_key:
-        if header_mode == "X-API-Key":
-            headers["X-API-Key"] = api_key
+    try:
+        if HAS_HTTPX and isinstance(resp, httpx.Response):
+            sock = None if resp.http_version == "HTTP/2" else resp.extensions["network_stream"].get_extra_info("socket")
         else:
-            headers["Authorization"] = f"Bearer {api_key}"
-    return headers
+            sock = resp.raw._connection.sock
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+        resp.close()
+    except Exception:
+        pass  # already closed, or ended meanwhile
+
+
+BLOCK_CHARS = 1000  # an open block longer than this is closed at its last paragraph break
+
+
+def completed_length(text: str, min_chars: int = BLOCK_CHARS) -> int:
+    """
+    Length of the beginning of `text` made of finished paragraphs: up to its last blank line
+    outside a ``` code block and followed by an unindented line, or 0 while the text is
+    shorter than min_chars. (Streamlit dedents each element, which would change indented blocks.)
+    """
+    if len(text) < min_chars:
+        return 0
+    cut = len(text)
+    while True:
+        cut = text.rfind("\n\n", 0, cut)
+        if cut <= 0:
+            return 0
+        if text.count("```", 0, cut) % 2:
+            cut = text.rfind("```", 0, cut)  # inside a code block: look before the fence that opens it
+        elif text[cut + 2:cut + 3] not in ("", " ", "\t", "\n"):
+            return cut + 2
+
+
+def draw_markdown(slot, text: str):
+    slot.markdown(text)
+
+
+def draw_thinking(slot, text: str):
+    slot.markdown(f"<div class='thinking'>{escape(text)}</div>", unsafe_allow_html=True)
+
+
+def draw_blocks(container, blocks: dict, text: str, draw):
+    """
+    Draws `text` in `container` as a sequence of elements: finished blocks (see completed_length)
+    are drawn once in their own element, and only the open block at the end is redrawn on each
+    call. blocks holds the drawing state: {"done": characters drawn in finished blocks, "tail": open element}.
+    """
+    if blocks["tail"] is None:
+        blocks["tail"] = container.empty()
+    tail = text[blocks["done"]:]
+    cut = completed_length(tail)
+    if cut:
+        draw(blocks["tail"], tail[:cut])
+        blocks["tail"] = container.empty()
+        blocks["done"] += cut
+        tail = tail[cut:]
+    draw(blocks["tail"], tail)
+
+
+def render_pending(state: dict, think_placeholder, chat_placeholder, force: bool = False):
+    """
+    Pushes the accumulated text to the placeholders (containers), at most once every
+    state["render_interval"] seconds unless 'force' is set (tag boundaries, end of stream).
+    Only the open block at the end of each text is redrawn (see draw_blocks), so a flush sends
+    a bounded amount of text and the websocket traffic stays linear in the output length,
+    except inside a code block longer than BLOCK_CHARS, which is redrawn whole until it ends.
+    """
+    now = time.monotonic()
+    if not force and now - state["last_render"] < state["render_interval"]:
+        return
+    if state["visible_dirty"]:
+        draw_blocks(chat_placeholder, state["visible_blocks"], state["parser"].visible_text, draw_markdown)
+        state["visible_dirty"] = False
+    if state["think_dirty"]:
+        draw_blocks(think_placeholder, state["think_blocks"], state["parser"].think_text, draw_thinking)
+        state["think_dirty"] = False
+    if state.get("turn") is not None:
+        # Also seen by a run started before this one ends (Streamlit's fast reruns)
+        state["turn"].content, state["turn"].think = state["parser"].visible_text, state["parser"].think_text
+    state["last_render"] = now
+
+
+def apply_parse_events(events: list, state: dict, think_placeholder, chat_placeholder, thinking_spinner=None, force: bool = False):
+    """
+    Applies the events of the <think> parser to the UI state.
+    Tag boundaries force a render so that the switch between reasoning and answer shows at once.
+    """
+    for event in events:
+        if event.kind == THINK_DELTA:
+            if state["first_think"] is None:
+                state["first_think"] = time.perf_counter()
+            if not state["thinking_active"] and thinking_spinner:
+                thinking_spinner.markdown("🤔 *Thinking...*")
+                state["thinking_active"] = True
+            state["think_dirty"] = True
+        elif event.kind == VISIBLE_DELTA:
+            if state["first_visible"] is None:
+                state["first_visible"] = time.perf_counter()
+            state["visible_dirty"] = True
+        else:
+            force = True
+    render_pending(state, think_placeholder, chat_placeholder, force=force)
 
 
 def parse_and_stream_tokens(
@@ -94,100 +284,35 @@ def parse_and_stream_tokens(
     thinking_spinner=None,
 ):
     """
-    Incremental parsing to support <think> ... </think> tags potentially fragmented between chunks.
-    Updates in real time:
-      - the 'thinking' placeholder (gray) when in_think == True
+    Incremental parsing of <think> ... </think> tags potentially fragmented between chunks
+    (see think_parser.ThinkTagParser), then coalesced rendering of:
+      - the 'thinking' placeholder (gray) for reasoning text
       - the 'chat' placeholder (normal) otherwise
-
-    'state' contains:
-      - state["pending"]: pending text to detect fragmented tags
-      - state["in_think"]: bool
-      - state["think_text"]: accumulation for expander
-      - state["visible_text"]: accumulation for chat display
-      - state["thinking_active"]: bool to track if spinner is shown
-    """
-    TAG_OPEN = "<think>"
-    TAG_CLOSE = "</think>"
-    MAX_TAG_LEN = max(len(TAG_OPEN), len(TAG_CLOSE))
-
-    # Adds the new chunk
-    state["pending"] += incoming_text
-
-    # We'll consume 'pending' progressively while keeping a small "queue"
-    # to avoid breaking tags split on chunk boundaries.
-    def flush_outside_text(text):
-        if text:
-            state["visible_text"] += text
-            chat_placeholder.markdown(state["visible_text"])
-
-    def flush_thinking_text(text):
-        if text:
-            if not state["thinking_active"] and thinking_spinner:
-                thinking_spinner.markdown("🤔 *Thinking...*")
-                state["thinking_active"] = True
-            state["think_text"] += text
-            think_placeholder.markdown(f"<div class='thinking'>{escape(state['think_text'])}</div>", unsafe_allow_html=True)
-
-    while True:
-        if state["in_think"]:
-            # Look for closing tag
-            idx_close = state["pending"].find(TAG_CLOSE)
-            if idx_close == -1:
-                # Nothing to close in this chunk -> we can purge everything except a small "queue"
-                if len(state["pending"]) > (MAX_TAG_LEN - 1):
-                    consume = len(state["pending"]) - (MAX_TAG_LEN - 1)
-                    chunk, state["pending"] = state["pending"][:consume], state["pending"][consume:]
-                    flush_thinking_text(chunk)
-                break
-            else:
-                # Found the closing tag, flush the thinking part
-                before_close = state["pending"][:idx_close]
-                flush_thinking_text(before_close)
-                # Skip the closing tag
-                state["pending"] = state["pending"][idx_close + len(TAG_CLOSE):]
-                state["in_think"] = False
-                # continue the loop to process the rest in the same pending
-        else:
-            # We're outside thinking, look for opening
-            idx_open = state["pending"].find(TAG_OPEN)
-            if idx_open == -1:
-                # No opening -> we can send everything to chat except a small "queue"
-                if len(state["pending"]) > (MAX_TAG_LEN - 1):
-                    consume = len(state["pending"]) - (MAX_TAG_LEN - 1)
-                    chunk, state["pending"] = state["pending"][:consume], state["pending"][consume:]
-                    flush_outside_text(chunk)
-                break
-            else:
-                # Send what's before the opening to chat, then switch to thinking mode
-                before_open = state["pending"][:idx_open]
-                flush_outside_text(before_open)
-                # Skip the opening tag
-                state["pending"] = state["pending"][idx_open + len(TAG_OPEN):]
-                state["in_think"] = True
-                # continue to potentially process the rest immediately
+    """
+    events = state["parser"].feed(incoming_text)
+    apply_parse_events(events, state, think_placeholder, chat_placeholder, thinking_spinner)
 
 
 def finalize_pending(state: dict, think_placeholder, chat_placeholder, thinking_spinner=None):
     """
-    At the end of the stream, we push the rest of 'pending' to the right place.
+    At the end of the stream, push the rest of the parser's buffer to the right place.
     """
-    if state["pending"]:
-        if state["in_think"]:
-            if not state["thinking_active"] and thinking_spinner:
-                thinking_spinner.markdown("🤔 *Thinking...*")
-                state["thinking_active"] = True
-            state["think_text"] += state["pending"]
-            think_placeholder.markdown(f"<div class='thinking'>{escape(state['think_text'])}</div>", unsafe_allow_html=True)
-        else:
-            state["visible_text"] += state["pending"]
-            chat_placeholder.markdown(state["visible_text"])
-        state["pending"] = ""
-    
+    events = state["parser"].finish()
+    apply_parse_events(events, state, think_placeholder, chat_placeholder, thinking_spinner, force=True)
+
     # Clear the thinking spinner when done
     if state["thinking_active"] and thinking_spinner:
         thinking_spinner.empty()
 
 
+def end_turn(turn: Turn, visible: str, think: str, metrics: Optional[dict]):
+    """Sets the final state of an answer streamed into `turn`: out of the context if it has no text."""
+    turn.content, turn.think, turn.metrics = visible, think, metrics
+    turn.in_context = bool(visible or think)
+    if turn.in_context:
+        st.session_state.latency_log.append(metrics)
+
+
 def stream_chat_completions(
     server_url: str,
     api_key: str,
@@ -197,21 +322,22 @@ def stream_chat_completions(
     temperature: float = 0.2,
     max_tokens: int = 2048,
     verify_ssl: bool = True,
+    render_interval_ms: int = 50,
+    http_client=None,
+    response_cache=None,
+    turn: Optional[Turn] = None,
 ):
     """
     Sends a chat/completions request in streaming mode (OpenAI-like format).
-    Returns (assistant_visible_text, assistant_think_text).
+    The answer is written in place into `turn`, an assistant turn of the history added before
+    the call: its content and reasoning follow the stream, then its metrics are set when it ends
+    or is stopped. On error, the turn is emptied and left out of the model's context.
+    Returns the metrics, None on error.
+    With a ResponseCache, an identical earlier request is replayed from it instead of being sent.
     Streams live in the UI via placeholders provided by the caller.
     """
     headers = build_headers(api_key, header_mode)
-    print(messages)
-    payload = {
-        "model": model,
-        "messages": messages,
-        "stream": True,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-    }
+    payload = build_chat_payload(model, messages, temperature, max_tokens)
 
     # Visual container for assistant response
     assistant_container = st.chat_message("assistant")
@@ -220,72 +346,519 @@ def stream_chat_completions(
         exp = st.expander("🧠 View reasoning (stream)", expanded=False)
         with exp:
             thinking_spinner = st.empty()  # spinner for reasoning
-            think_placeholder = st.empty()      # thinking (light gray)
-        chat_placeholder = st.empty()        # visible text (normal)
+            think_placeholder = st.container()  # thinking (light gray)
+        chat_placeholder = st.container()    # visible text (normal)
+        # Any click reruns the app: Streamlit interrupts this run, which closes the stream (see below)
+        stop_slot = st.empty()
+        stop_slot.button("⏹️ Stop generating", key="stop_generation")
 
     # Streaming indicator
     top_line.markdown("<span class='streaming-dot'></span>Streaming in progress…", unsafe_allow_html=True)
 
     # Parser state
     parse_state = {
-        "pending": "",
-        "in_think": False,
-        "think_text": "",
-        "visible_text": "",
+        "parser": ThinkTagParser(),
         "thinking_active": False,
+        # Render scheduling (see render_pending)
+        "think_blocks": {"done": 0, "tail": None},
+        "visible_blocks": {"done": 0, "tail": None},
+        "visible_dirty": False,
+        "think_dirty": False,
+        "last_render": 0.0,
+        "render_interval": render_interval_ms / 1000,
+        # Timings (see format_metrics)
+        "first_think": None,
+        "first_visible": None,
+        # The history shows the answer so far (see render_pending)
+        "turn": turn if turn is not None else Turn("assistant", ""),
     }
+    turn = parse_state["turn"]
+
+    started_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    start = time.perf_counter()
+    headers_at = None
+    cache_key = ResponseCache.make_key(model, messages, temperature, max_tokens) if response_cache is not None else None
+    cached = response_cache.get(cache_key) if cache_key else None
+
+    finish_reason, usage, n_deltas = None, None, 0
+    completed = False
+    # The stream is read by a worker thread (see read_stream) and applied here, in the script thread
+    deltas = queue.Queue()
+    stop = threading.Event()
+    stream = {"response": None}
+    reader = None
+
+    def turn_metrics(finish: str) -> dict:
+        """Timings and token counts of the turn so far (see format_metrics)."""
+        end = time.perf_counter()
+        firsts = [t for t in (parse_state["first_think"], parse_state["first_visible"]) if t is not None]
+        completion_tokens = (usage or {}).get("completion_tokens") or n_deltas
+
+        def since(t):
+            return t - start if t is not None else None
+
+        return {
+            "time": started_at,
+            "model": model,
+            "cached": cached is not None,
+            "headers_s": since(headers_at),
+            "first_think_s": since(parse_state["first_think"]),
+            "first_visible_s": since(parse_state["first_visible"]),
+            "first_token_s": since(min(firsts)) if firsts else None,
+            "total_s": end - start,
+            "prompt_tokens": (usage or {}).get("prompt_tokens"),
+            "completion_tokens": completion_tokens,
+            # Decode speed, after the first token
+            "tokens_per_s": (completion_tokens - 1) / (end - min(firsts)) if firsts and completion_tokens > 1 and end > min(firsts) else None,
+            "finish_reason": finish,
+        }
 
     try:
-        with requests.post(
-            server_url,
-            headers=headers,
-            json=payload,
-            stream=True,
-            timeout=(10, 180),
-            verify=verify_ssl,
-        ) as resp:
-            resp.raise_for_status()
+        if cached is not None:
+            # Replay the cached answer through the same parser and placeholders
+            visible, think = cached
+            parse_and_stream_tokens(
+                f"<think>{think}</think>{visible}" if think else visible,
+                parse_state,
+                think_placeholder=think_placeholder,
+                chat_placeholder=chat_placeholder,
+                thinking_spinner=thinking_spinner,
+            )
+        else:
+            if http_client is None:
+                http_client = get_http_client(verify_ssl=verify_ssl)
 
-            for raw in resp.iter_lines(decode_unicode=True):
-                if not raw:
+            def headers_received(resp):
+                nonlocal headers_at
+                headers_at = time.perf_counter()
+                stream["response"] = resp
+                if stop.is_set():
+                    raise _StreamStopped()
+
+            def read_stream():
+                # No Streamlit calls in this thread: it may outlive the run
+                try:
+                    with open_event_stream(http_client, server_url, headers, payload, headers_received) as chunks:
+                        for delta in iter_chat_deltas(chunks):
+                            if stop.is_set():
+                                raise _StreamStopped()
+                            deltas.put(delta)
+                except _StreamStopped:
+                    pass
+                except Exception as e:
+                    if not stop.is_set():
+                        deltas.put(e)
+                finally:
+                    deltas.put(None)
+
+            reader = threading.Thread(target=read_stream, daemon=True)
+            reader.start()
+            while True:
+                try:
+                    delta = deltas.get(timeout=STREAM_POLL_S)
+                except queue.Empty:
+                    # Nothing received (queueing, prefill): this Streamlit call is where a stop or
+                    # a rerun interrupts the run, so they also take effect before the first token
+                    top_line.markdown(
+                        f"<span class='streaming-dot'></span>Streaming in progress… {time.perf_counter() - start:.0f} s",
+                        unsafe_allow_html=True,
+                    )
                     continue
-                # Typical SSE format: "data: {...}" or "data: [DONE]"
-                if raw.startswith("data:"):
-                    data = raw[5:].strip()
-                    if data == "[DONE]":
-                        break
-                    try:
-                        event = json.loads(data)
-                    except json.JSONDecodeError:
-                        # malformed line
-                        continue
-                    # Get the delta content (OpenAI-like streaming)
-                    try:
-                        token = event["choices"][0]["delta"].get("content", "")
-                    except Exception:
-                        token = ""
-                    if token:
-                        parse_and_stream_tokens(
-                            token,
-                            parse_state,
-                            think_placeholder=think_placeholder,
-                            chat_placeholder=chat_placeholder,
-                            thinking_spinner=thinking_spinner,
-                        )
+                if delta is None:
+                    break
+                if isinstance(delta, Exception):
+                    raise delta
+                if delta.content:
+                    parse_and_stream_tokens(
+                        delta.content,
+                        parse_state,
+                        think_placeholder=think_placeholder,
+                        chat_placeholder=chat_placeholder,
+                        thinking_spinner=thinking_spinner,
+                    )
+                finish_reason = delta.finish_reason or finish_reason
+                usage = delta.usage or usage
+                n_deltas += bool(delta.content)
 
         # End of stream: flush remaining pending
+        completed = True
+        stop_slot.empty()
         finalize_pending(parse_state, think_placeholder, chat_placeholder, thinking_spinner)
         top_line.empty()  # remove streaming badge
+        metrics = turn_metrics(finish_reason)
+        assistant_container.caption(format_metrics(metrics))
 
-        return parse_state["visible_text"], parse_state["think_text"]
+        visible, think = parse_state["parser"].visible_text, parse_state["parser"].think_text
+        if cache_key and cached is None and (visible or think):
+            response_cache.put(cache_key, visible, think)
+        end_turn(turn, visible, think, metrics)
+        return metrics
 
-    except requests.exceptions.RequestException as e:
+    except HTTP_ERRORS + (ChatStreamError,) as e:
+        completed = True
+        stop_slot.empty()
         top_line.empty()
         if thinking_spinner:
             thinking_spinner.empty()
-        st.error(f"Server connection error: {e}")
-        st.info("Check the URL, API Key, that the service is running, and network rules.")
-        return "", ""
+        if isinstance(e, ChatStreamError):
+            st.error(f"The server stopped the answer with an error: {e}")
+        else:
+            st.error(f"Server connection error: {e}")
+            st.info("Check the URL, API Key, that the service is running, and network rules.")
+        end_turn(turn, "", "", None)
+        return None
+    except STREAMLIT_INTERRUPTS:
+        if not completed:
+            # Interrupted by Streamlit while streaming (stop button or any other interaction):
+            # the turn keeps the partial answer, marked as stopped (no UI call is allowed here)
+            parser = parse_state["parser"]
+            parser.finish()
+            end_turn(turn, parser.visible_text, parser.think_text, turn_metrics("stopped"))
+        raise
+    except Exception:
+        # Any other error is reported by Streamlit; as after a connection error, the question
+        # is left out of the model's context
+        end_turn(turn, "", "", None)
+        st.session_state.history.drop_unanswered()
+        raise
+    finally:
+        if reader is not None and reader.is_alive():
+            # Stopped or failed before the end: close the connection, so the server aborts the generation
+            stop.set()
+            abort_stream(stream["response"])
+
+
+METRICS_FIELDS = ["time", "model", "cached", "headers_s", "first_think_s", "first_visible_s", "first_token_s",
+                  "total_s", "prompt_tokens", "completion_tokens", "tokens_per_s", "finish_reason"]
+
+
+def format_metrics(m: dict) -> str:
+    """One-line summary of a turn's metrics, shown under the answer."""
+    def ms(seconds):
+        return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.1f} s"
+    if m["cached"]:
+        parts = ["♻️ replayed from the response cache"]
+    else:
+        parts = []
+        if m["headers_s"] is not None:
+            parts.append(f"headers {ms(m['headers_s'])}")
+        if m["first_think_s"] is not None:
+            parts.append(f"first thought {ms(m['first_think_s'])}")
+        if m["first_visible_s"] is not None:
+            parts.append(f"first answer token {ms(m['first_visible_s'])}")
+        parts.append(f"total {ms(m['total_s'])}")
+        if m["prompt_tokens"] is not None:
+            parts.append(f"{m['prompt_tokens']} prompt tokens")
+        parts.append(f"{m['completion_tokens']} completion tokens")
+        if m["tokens_per_s"]:
+            parts.append(f"{m['tokens_per_s']:.1f} tok/s")
+    line = "⏱️ " + " · ".join(parts)
+    if m["finish_reason"] == "length":
+        line += " — ⚠️ answer cut at the max response tokens limit"
+    elif m["finish_reason"] == "stopped":
+        line += " — ⏹️ stopped by the user, partial answer"
+    return line
+
+
+def percentiles(values: list) -> tuple:
+    """(p50, p95) of a non-empty list."""
+    if len(values) == 1:
+        return values[0], values[0]
+    q = statistics.quantiles(values, n=100, method="inclusive")
+    return q[49], q[94]
+
+
+def render_latency_summary(log: list):
+    """Session summary (p50/p95) of the generated turns, and CSV export of every turn."""
+    generated = [m for m in log if not m["cached"]]
+    if not log:
+        st.caption("No turns yet.")
+        return
+    rows = []
+    for label, key, fmt in (("Headers", "headers_s", "{:.2f} s"), ("First token", "first_token_s", "{:.2f} s"),
+                            ("Total", "total_s", "{:.1f} s"), ("Tokens/s", "tokens_per_s", "{:.1f}")):
+        values = [m[key] for m in generated if m[key] is not None]
+        if values:
+            p50, p95 = percentiles(values)
+            rows.append(f"| {label} | {fmt.format(p50)} | {fmt.format(p95)} |")
+    if rows:
+        st.markdown(f"{len(generated)} generated turns\n\n| | p50 | p95 |\n|---|---|---|\n" + "\n".join(rows))
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=METRICS_FIELDS)
+    writer.writeheader()
+    writer.writerows(log)
+    st.download_button("⬇️ Export CSV", buffer.getvalue(), file_name="chat_latency.csv", mime="text/csv")
+
+
+@st.cache_resource(show_spinner=False)
+def get_token_counter(tokenizer_name: str):
+    """Loads the token counter once per tokenizer (see chat_context.load_token_counter)."""
+    return load_token_counter(tokenizer_name)
+
+
+def summarize_turns(server_url: str, api_key: str, header_mode: str, model: str, http_client,
+                    previous_summary: str, evicted: list) -> str:
+    """
+    Folds the turns that left the context window into the running summary, with a
+    non-streaming request to the same model. Keeps the previous summary on failure.
+    """
+    payload = {
+        "model": model,
+        "messages": format_for_summary(previous_summary, evicted),
+        "stream": False,
+        "temperature": 0.0,
+        "max_tokens": 1024,
+    }
+    try:
+        with st.spinner("Summarizing earlier turns…"):
+            resp = http_client.post(server_url, headers=build_headers(api_key, header_mode), json=payload, timeout=120)
+            resp.raise_for_status()
+            content = resp.json()["choices"][0]["message"]["content"] or ""
+    except HTTP_ERRORS + (KeyError, IndexError, ValueError) as e:
+        st.warning(f"Could not summarize the earlier turns, they are left out: {e}")
+        return previous_summary
+    # Reasoning models think before answering: keep the answer only
+    parser = ThinkTagParser()
+    parser.feed(content)
+    parser.finish()
+    return parser.visible_text.strip() or previous_summary
+
+
+def select_context(reserve_tokens: int, exact_counts: bool) -> list:
+    """
+    Returns the part of the history's messages that fits in the context budget, and
+    shows its size under the last user message (also stored in its turn for the history).
+    """
+    window = st.session_state.context
+    messages = window.build(st.session_state.history.messages, reserve_tokens=reserve_tokens)
+    note = f"📏 {'' if exact_counts else '≈'}{window.prompt_tokens} prompt tokens"
+    if window.dropped:
+        note += f" · {window.dropped} earlier messages {'summarized' if window.summary else 'left out'}"
+    st.caption(note)
+    st.session_state.history.last.context = note
+    return messages
+
+
+def render_turn(turn: Turn):
+    """One message of the history (without re-streaming)."""
+    if turn.role == "assistant" and not (turn.content or turn.has_think):
+        return  # an answer still waiting for its first token, or that failed
+    with st.chat_message(turn.role):
+        st.markdown(turn.content)
+        if turn.context:
+            st.caption(turn.context)
+        if turn.has_think:
+            with st.expander("🧠 View reasoning"):
+                st.markdown(f"<div class='thinking'>{escape(turn.think)}</div>", unsafe_allow_html=True)
+        if turn.metrics:
+            st.caption(format_metrics(turn.metrics))
+
+
+def render_history(history: TurnStore, recent: int):
+    """
+    Renders the last `recent` turns. Older turns are only rendered on demand, one page of
+    `recent` turns at a time, so a rerun costs the same however long the conversation is.
+    """
+    older = len(history) - recent
+    if older > 0 and st.toggle(f"🗂️ Show {older} earlier messages", key="show_older_turns"):
+        pages = -(-older // recent)
+        page = st.number_input(f"Page (1 = oldest, {pages} = most recent)", min_value=1, max_value=pages,
+                               value=pages, key="history_page")
+        for turn in history.turns[(page - 1) * recent:min(page * recent, older)]:
+            render_turn(turn)
+        st.markdown("---")
+    for turn in history.turns[max(older, 0):]:
+        render_turn(turn)
+
+
+def parse_endpoints(text: str, default_model: str, default_api_key: str) -> list:
+    """
+    Endpoints of the fan-out mode, one per line: `URL | model | API key`. The model and the
+    key are optional and default to the main settings.
+    """
+    endpoints = []
+    for line in text.splitlines():
+        fields = [f.strip() for f in line.split("|")]
+        if not fields[0]:
+            continue
+        endpoints.append({
+            "name": f"{len(endpoints) + 1}. {urlparse(fields[0]).netloc or fields[0]}",
+            "url": fields[0],
+            "model": fields[1] if len(fields) > 1 and fields[1] else default_model,
+            "api_key": fields[2] if len(fields) > 2 and fields[2] else default_api_key,
+        })
+    return endpoints
+
+
+def stream_endpoint(endpoint: dict, messages: list, temperature: float, max_tokens: int, header_mode: str,
+                    http_client, state: dict, stop: threading.Event):
+    """
+    Streams one endpoint's answer into `state` ("parser", "metrics", "error", "done", and
+    "response", which fan_out_chat aborts when stopped, see abort_stream).
+    Runs in a worker thread of fan_out_chat: no Streamlit calls.
+    """
+    parser = state["parser"]
+    started_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    start = time.perf_counter()
+    headers_at = first_think = first_visible = None
+    finish_reason, usage, n_deltas = None, None, 0
+    try:
+        headers = build_headers(endpoint["api_key"], header_mode)
+        payload = build_chat_payload(endpoint["model"], messages, temperature, max_tokens)
+        def headers_received(resp):
+            nonlocal headers_at
+            headers_at = time.perf_counter()
+            state["response"] = resp
+            if stop.is_set():
+                raise _StreamStopped()
+
+        with open_event_stream(http_client, endpoint["url"], headers, payload, headers_received) as chunks:
+            for delta in iter_chat_deltas(chunks):
+                if stop.is_set():
+                    raise _StreamStopped()
+                if delta.content:
+                    for event in parser.feed(delta.content):
+                        if event.kind == THINK_DELTA and first_think is None:
+                            first_think = time.perf_counter()
+                        elif event.kind == VISIBLE_DELTA and first_visible is None:
+                            first_visible = time.perf_counter()
+                    n_deltas += 1
+                finish_reason = delta.finish_reason or finish_reason
+                usage = delta.usage or usage
+    except _StreamStopped:
+        finish_reason = "stopped"
+    except Exception as e:
+        if stop.is_set():
+            finish_reason = "stopped"  # the read failed because fan_out_chat aborted the response
+        else:
+            state["error"] = str(e)
+    finally:
+        parser.finish()
+        end = time.perf_counter()
+        firsts = [t for t in (first_think, first_visible) if t is not None]
+        completion_tokens = (usage or {}).get("completion_tokens") or n_deltas
+
+        def since(t):
+            return t - start if t is not None else None
+
+        # Same fields as the metrics of stream_chat_completions (see format_metrics)
+        state["metrics"] = {
+            "time": started_at,
+            "model": endpoint["model"],
+            "cached": False,
+            "headers_s": since(headers_at),
+            "first_think_s": since(first_think),
+            "first_visible_s": since(first_visible),
+            "first_token_s": since(min(firsts)) if firsts else None,
+            "total_s": end - start,
+            "prompt_tokens": (usage or {}).get("prompt_tokens"),
+            "completion_tokens": completion_tokens,
+            "tokens_per_s": (completion_tokens - 1) / (end - min(firsts)) if firsts and completion_tokens > 1 and end > min(firsts) else None,
+            "finish_reason": finish_reason,
+        }
+        state["done"] = True
+
+
+def fan_out_chat(endpoints: list, messages: list, temperature: float, max_tokens: int, header_mode: str,
+                 http_client, render_interval_ms: int = 50) -> list:
+    """
+    Sends the same messages to every endpoint at once, one worker thread each on the pooled
+    client, and streams the answers side by side: the wall time is that of the slowest
+    endpoint, not the sum. Returns one result per endpoint ("name", "model", "content",
+    "think", "metrics", "error"); an interrupted run stores its partial results in
+    st.session_state.comparison instead, and closes the streams still open.
+    """
+    states = [{"parser": ThinkTagParser(), "metrics": None, "error": None, "done": False, "response": None}
+              for _ in endpoints]
+    blocks = [({"done": 0, "tail": None}, {"done": 0, "tail": None}) for _ in endpoints]  # see draw_blocks
+    slots = []
+    for column, endpoint in zip(st.columns(len(endpoints)), endpoints):
+        with column:
+            st.markdown(f"**{endpoint['name']}**")
+            st.caption(endpoint["model"])
+            with st.expander("🧠 View reasoning"):
+                think_placeholder = st.container()
+            slots.append((think_placeholder, st.container(), st.empty()))
+    stop_slot = st.empty()
+    stop_slot.button("⏹️ Stop all", key="stop_fan_out")
+
+    def results() -> list:
+        return [
+            {"name": e["name"], "model": e["model"], "content": s["parser"].visible_text,
+             "think": s["parser"].think_text, "metrics": s["metrics"], "error": s["error"]}
+            for e, s in zip(endpoints, states)
+        ]
+
+    stop = threading.Event()
+    for endpoint, state in zip(endpoints, states):
+        threading.Thread(
+            target=stream_endpoint, daemon=True,
+            args=(endpoint, messages, temperature, max_tokens, header_mode, http_client, state, stop),
+        ).start()
+
+    shown = [None] * len(endpoints)     # text lengths drawn
+    statuses = [None] * len(endpoints)  # status line drawn
+    start = time.perf_counter()
+    try:
+        while True:
+            elapsed = time.perf_counter() - start
+            # The status lines of the endpoints still streaming are redrawn every STREAM_POLL_S: these
+            # Streamlit calls are where a stop or a rerun interrupts the run, also before the first tokens
+            tick = int(elapsed / STREAM_POLL_S)
+            for i, (state, (think_placeholder, answer_placeholder, stats_placeholder)) in enumerate(zip(states, slots)):
+                parser = state["parser"]
+                text = (len(parser.think_text), len(parser.visible_text))
+                if text != shown[i]:
+                    shown[i] = text
+                    think_blocks, answer_blocks = blocks[i]
+                    draw_blocks(think_placeholder, think_blocks, parser.think_text, draw_thinking)
+                    draw_blocks(answer_placeholder, answer_blocks, parser.visible_text, draw_markdown)
+                status = "error" if state["error"] else "done" if state["done"] else tick
+                if status == statuses[i]:
+                    continue
+                statuses[i] = status
+                if state["error"]:
+                    stats_placeholder.error(f"Server connection error: {state['error']}")
+                elif state["done"]:
+                    stats_placeholder.caption(format_metrics(state["metrics"]))
+                else:
+                    stats_placeholder.markdown(f"<span class='streaming-dot'></span>Streaming… {elapsed:.0f} s",
+                                               unsafe_allow_html=True)
+            if all(state["done"] for state in states):
+                break
+            time.sleep(max(render_interval_ms / 1000, 0.02))
+        stop_slot.empty()
+        return results()
+    except STREAMLIT_INTERRUPTS:
+        # Interrupted by Streamlit (stop button or any other interaction): keep the partial answers
+        st.session_state.comparison = {"prompt": messages[-1]["content"], "results": results()}
+        raise
+    finally:
+        # Close the streams still open from here: a worker blocked on a read (e.g. during the
+        # prefill) would not see the stop event until its endpoint sends something
+        stop.set()
+        for state in states:
+            if not state["done"] and state["response"] is not None:
+                abort_stream(state["response"])
+
+
+def render_comparison(comparison: dict):
+    """The last fan-out prompt and its answers, side by side (without re-streaming)."""
+    st.chat_message("user").markdown(comparison["prompt"])
+    for column, result in zip(st.columns(len(comparison["results"])), comparison["results"]):
+        with column:
+            st.markdown(f"**{result['name']}**")
+            st.caption(result["model"])
+            if result["think"]:
+                with st.expander("🧠 View reasoning"):
+                    st.markdown(f"<div class='thinking'>{escape(result['think'])}</div>", unsafe_allow_html=True)
+            st.markdown(result["content"])
+            if result["error"]:
+                st.error(f"Server connection error: {result['error']}")
+            elif result["metrics"]:
+                st.caption(format_metrics(result["metrics"]))
+            else:
+                st.caption("⏹️ stopped by the user, partial answer")
 
 
 # =========================
@@ -308,11 +881,92 @@ with st.sidebar:
     temperature = st.slider("Temperature", min_value=0.0, max_value=1.0, value=0.2, step=0.05)
     max_tokens = st.slider("Max response tokens", min_value=128, max_value=32000, value=2048, step=128)
     verify_ssl = st.toggle("Verify SSL certificate", value=True, help="Disable if you have a self-signed certificate (not recommended)")
+    render_interval_ms = st.slider(
+        "Render interval (ms)", min_value=0, max_value=500, value=50, step=10,
+        help="Streamed tokens are coalesced and the answer is redrawn at most this often (0 = every token)",
+    )
+    with st.expander("🔌 Connection pool"):
+        use_http2 = st.toggle(
+            "HTTP/2", value=False, disabled=not HAS_HTTP2,
+            help="Multiplex requests over a single connection (requires `pip install httpx[http2]`)",
+        )
+        pool_size = st.number_input("Max pooled connections", min_value=1, max_value=100, value=10)
+    http_client = get_http_client(use_http2, int(pool_size), verify_ssl)
+    with st.expander("🧮 Context window"):
+        context_budget = st.number_input(
+            "Context budget (tokens)", min_value=1024, max_value=262144, value=8192, step=1024,
+            help="Prompt + answer tokens per request, at most the --max-model-len of vLLM. "
+                 "The oldest turns that do not fit are left out.",
+        )
+        summarize_dropped = st.toggle(
+            "Summarize dropped turns", value=False,
+            help="Fold the turns left out into a running summary (one extra request each time the window moves)",
+        )
+        tokenizer_name = st.text_input(
+            "Tokenizer (optional)", value="",
+            help="Hugging Face tokenizer for exact counts, e.g. microsoft/Phi-4-mini-reasoning "
+                 "(requires `pip install transformers`). Empty: about 4 characters per token.",
+        )
+    try:
+        count_tokens = get_token_counter(tokenizer_name.strip())
+    except Exception as e:
+        st.warning(f"Tokenizer unavailable, estimating token counts instead: {e}")
+        count_tokens = estimate_tokens
+    context_window = st.session_state.context
+    context_window.budget_tokens = int(context_budget)
+    context_window.set_token_counter(count_tokens)
+    context_window.summarize = (
+        lambda previous, evicted: summarize_turns(
+            server_url.strip(), api_key.strip(), header_mode, model_name.strip(), http_client, previous, evicted
+        )
+    ) if summarize_dropped else None
+    with st.expander("♻️ Response cache"):
+        cache_enabled = st.toggle(
+            "Replay identical requests", value=False,
+            help="Answers to an identical request (same model, context, temperature and max tokens) "
+                 "are replayed from this session's memory instead of generated again",
+        )
+        cache_sampled = st.toggle(
+            "Also when temperature > 0", value=False, disabled=not cache_enabled,
+            help="Sampled answers are random: by default only temperature 0 answers are cached",
+        )
+        response_cache = st.session_state.response_cache
+        response_cache.max_entries = st.number_input("Max cached answers", min_value=1, max_value=1000, value=128)
+        response_cache.ttl_seconds = 60 * st.number_input("Time to live (minutes)", min_value=1, max_value=1440, value=60)
+        cache_stats = st.empty()  # filled at the end of the run, after this turn's lookup
+        if st.button("Clear cache"):
+            response_cache.clear()
+    use_cache = cache_enabled and (temperature == 0 or cache_sampled)
+    with st.expander("🔀 Compare endpoints"):
+        fan_out = st.toggle(
+            "Fan-out mode", value=False,
+            help="Send each prompt to every endpoint below at once and show the answers side by side. "
+                 "Prompts are sent alone, without the conversation history.",
+        )
+        endpoints_text = st.text_area(
+            "Endpoints (one per line: URL | model | API key)",
+            value=server_url,
+            help="Model and API key are optional and default to the settings above",
+        )
+    endpoints = parse_endpoints(endpoints_text, model_name.strip(), api_key.strip())
+    with st.expander("🗂️ History"):
+        history_recent = st.number_input(
+            "Messages shown in full", min_value=2, max_value=200, value=20, step=2,
+            help="Older messages are rendered only on demand, one page at a time",
+        )
+        compress_think = st.toggle(
+            "Compress older reasoning", value=True,
+            help="Keep the reasoning of the messages not shown in full compressed in memory",
+        )
+    st.session_state.history.compress_after = int(history_recent) if compress_think else None
+    with st.expander("⏱️ Latency (session)"):
+        latency_panel = st.container()  # filled at the end of the run, with this turn included
 
     st.markdown("---")
     if st.button("🗑️ Reset conversation"):
-        st.session_state.messages = []
-        st.session_state.turns = []
+        st.session_state.history = TurnStore()
+        st.session_state.pop("history_page", None)
+        st.session_state.context = ContextWindow(budget_tokens=int(context_budget))
         st.rerun()
 
 
@@ -325,43 +979,59 @@ st.caption("Multi‑turn chat • Streaming • Clear reasoning via expander •
 # =========================
 # History Display
 # =========================
-# Display past turns (without re-streaming).
-for msg in st.session_state.turns:
-    with st.chat_message(msg["role"]):
-        st.markdown(msg["content"])
-        if msg.get("think"):
-            with st.expander("🧠 View reasoning"):
-                st.markdown(f"<div class='thinking'>{escape(msg['think'])}</div>", unsafe_allow_html=True)
+render_history(st.session_state.history, int(history_recent))
 
 # =========================
 # User Input & Streaming
 # =========================
-if user_prompt := st.chat_input("Ask your question…"):
+if fan_out:
+    if not endpoints:
+        st.info("Add at least one endpoint in the sidebar's 🔀 Compare endpoints section.")
+    elif fan_out_prompt := st.chat_input(f"Ask all {len(endpoints)} endpoints…"):
+        st.chat_message("user").markdown(fan_out_prompt)
+        # Comparisons are single-turn: the prompt is sent alone, without the conversation history
+        st.session_state.comparison = {
+            "prompt": fan_out_prompt,
+            "results": fan_out_chat(endpoints, [{"role": "user", "content": fan_out_prompt}], temperature,
+                                    max_tokens, header_mode, http_client, render_interval_ms),
+        }
+    elif st.session_state.get("comparison"):
+        render_comparison(st.session_state.comparison)
+elif user_prompt := st.chat_input("Ask your question…"):
     # 1) Display and store on UI side
-    st.chat_message("user").markdown(user_prompt)
-    st.session_state.turns.append({"role": "user", "content": user_prompt})
+    user_box = st.chat_message("user")
+    user_box.markdown(user_prompt)
 
-    # 2) Add to context sent to model (without <think>)
-    st.session_state.messages.append({"role": "user", "content": user_prompt})
+    # 2) Add to the history (and so to the context sent to the model)
+    st.session_state.history.append("user", user_prompt)
+    # Only the turns that fit in the context budget are sent
+    with user_box:
+        request_messages = select_context(max_tokens, exact_counts=count_tokens is not estimate_tokens)
 
-    # 3) Send to server and stream live (with <think> parsing)
-    visible, think = stream_chat_completions(
+    # 3) Send to server and stream live (with <think> parsing) into the assistant turn: the "clean"
+    # response (without <think> tags) and the reasoning are stored separately, and we do NOT send
+    # the 'think' to the next turn, only the visible part (see turn_store.py)
+    answer = st.session_state.history.append("assistant", "")
+    stream_chat_completions(
         server_url=server_url.strip(),
         api_key=api_key.strip(),
         header_mode=header_mode,
         model=model_name.strip(),
-        messages=st.session_state.messages,
+        messages=request_messages,
         temperature=temperature,
         max_tokens=max_tokens,
         verify_ssl=verify_ssl,
+        render_interval_ms=render_interval_ms,
+        http_client=http_client,
+        response_cache=response_cache if use_cache else None,
+        turn=answer,
     )
+    if not answer.in_context:
+        # In case of error, keep the last user message out of the model's context to avoid a broken context
+        st.session_state.history.drop_unanswered()
 
-    # 4) Store the "clean" response (without <think> tags), and the reasoning separately
-    if visible or think:
-        st.session_state.turns.append({"role": "assistant", "content": visible, "think": think})
-        # Important: we do NOT send the 'think' to the next turn, only the visible part
-        st.session_state.messages.append({"role": "assistant", "content": visible})
-    else:
-        # In case of error, remove the last user message to avoid a broken context
-        if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
-            st.session_state.messages.pop()
+with latency_panel:
+    render_latency_summary(st.session_state.latency_log)
+cache_stats.caption(
+    f"{response_cache.hits} hits · {response_cache.misses} misses · {len(response_cache)} cached answers"
+)
@@ -1,8 +1,12 @@
 import os
 import sys
+import glob
+import json
 import logging
 import argparse
 from pathlib import Path
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.keys.crypto import CryptographyClient, KeyWrapAlgorithm
@@ -16,13 +20,23 @@ logging.basicConfig(
 )
 
 CHUNK_SIZE = 8 * 1024 * 1024  # 8 MB
+MANIFEST_NAME = "manifest.json"
+SCHEMA_NAME = "schema.json"
+SHARDED_KEY_NAME = "dataset.key"
+SCHEMA_CHUNK_ROWS = 1_000_000
+MAX_CATEGORIES = 1024  # string columns with more distinct values stay plain strings
 
+# Order in which pandas column kinds widen when chunks disagree (bool < int < float < object)
+_KIND_RANK = {"b": 0, "i": 1, "u": 1, "f": 2, "O": 3}
+_INT_TYPES = ("int8", "uint8", "int16", "uint16", "int32", "uint32", "int64")
 
-def encrypt_file(src_path: Path, dek: bytes) -> Path:
+
+def encrypt_file(src_path: Path, dek: bytes, enc_path: Path = None) -> Path:
     """Encrypt a file with AES-256-GCM, storing [nonce][ciphertext][tag]."""
     nonce = os.urandom(12)
     encryptor = Cipher(algorithms.AES(dek), modes.GCM(nonce)).encryptor()
-    enc_path = src_path.with_suffix(".enc")
+    if enc_path is None:
+        enc_path = src_path.with_suffix(".enc")
     with src_path.open("rb") as fin, enc_path.open("wb") as fout:
         fout.write(nonce)
         while True:
@@ -35,6 +49,108 @@ def encrypt_file(src_path: Path, dek: bytes) -> Path:
     return enc_path
 
 
+def _encrypt_shard(job: tuple) -> dict:
+    """Worker entry point: encrypt one shard and describe it for the manifest."""
+    src_path, enc_path, dek = job
+    encrypt_file(src_path, dek, enc_path)
+    return {
+        "source": src_path.name,
+        "file": enc_path.name,
+        "plaintext_bytes": src_path.stat().st_size,
+        "ciphertext_bytes": enc_path.stat().st_size,
+    }
+
+
+def resolve_inputs(path_or_glob: str) -> list:
+    """
+    Expand the positional argument into a sorted list of input files.
+    Accepts a single file, a directory (all regular files inside it) or a glob pattern.
+    """
+    p = Path(path_or_glob)
+    if p.is_file():
+        return [p]
+    if p.is_dir():
+        candidates = p.iterdir()
+    else:
+        candidates = (Path(m) for m in glob.glob(path_or_glob))
+    return sorted(
+        c for c in candidates
+        if c.is_file() and c.suffix not in (".enc", ".key")
+        and c.name not in (MANIFEST_NAME, SCHEMA_NAME) and not c.name.endswith(".schema.json")
+    )
+
+
+def shard_names(src_paths: list) -> list:
+    """
+    Output names (without ".enc") of the shards: the file stems, or, when two inputs share a
+    stem (same file name in several directories, e.g. partitioned data), their paths relative
+    to the common directory joined with "__". Raises ValueError if names still collide.
+    """
+    names = [src.stem for src in src_paths]
+    if len(set(names)) < len(names):
+        resolved = [src.resolve() for src in src_paths]
+        root = Path(os.path.commonpath([str(src.parent) for src in resolved]))
+        names = ["__".join(src.relative_to(root).with_suffix("").parts) for src in resolved]
+    duplicates = sorted(name for name, count in Counter(names).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"Several input files would be encrypted to the same shard name: {duplicates}")
+    return names
+
+
+def encrypt_shards(src_paths: list, out_dir: Path, dek: bytes, workers: int) -> list:
+    """
+    Encrypt every shard under the same DEK on a process pool.
+    Each shard gets its own random nonce, so sharing the DEK is safe.
+    Returns the manifest entries, in input order.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [(src, out_dir / (name + ".enc"), dek) for src, name in zip(src_paths, shard_names(src_paths))]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_encrypt_shard, jobs))
+
+
+def infer_schema(src_paths: list) -> dict:
+    """
+    Infers the most compact dtype of every CSV column with a full pass over the plaintext:
+    the smallest integer width covering the observed range, float32 for floats and
+    categoricals for low-cardinality strings. The CVM can then parse straight into them.
+    """
+    import numpy as np  # only needed for --schema
+    import pandas as pd
+
+    stats = {}
+    for path in src_paths:
+        for chunk in pd.read_csv(path, chunksize=SCHEMA_CHUNK_ROWS):
+            for col, s in chunk.items():
+                kind = s.dtype.kind if s.dtype.kind in _KIND_RANK else "O"
+                st = stats.setdefault(col, {"kind": kind, "min": None, "max": None, "values": set()})
+                if _KIND_RANK[kind] > _KIND_RANK[st["kind"]]:
+                    st["kind"] = kind
+                if kind in "iu":
+                    lo, hi = int(s.min()), int(s.max())
+                    st["min"] = lo if st["min"] is None else min(st["min"], lo)
+                    st["max"] = hi if st["max"] is None else max(st["max"], hi)
+                elif kind == "O" and st["values"] is not None:
+                    st["values"].update(s.dropna().unique())
+                    if len(st["values"]) > MAX_CATEGORIES:
+                        st["values"] = None
+
+    schema = {}
+    for col, st in stats.items():
+        if st["kind"] == "b":
+            schema[col] = "bool"
+        elif st["kind"] in "iu":
+            schema[col] = next(
+                t for t in _INT_TYPES
+                if np.iinfo(t).min <= st["min"] and st["max"] <= np.iinfo(t).max
+            )
+        elif st["kind"] == "f":
+            schema[col] = "float32"
+        else:
+            schema[col] = "category" if st["values"] is not None else "object"
+    return schema
+
+
 def parse_args() -> argparse.Namespace:
     """
     Parse command-line arguments.
@@ -42,8 +158,31 @@ def parse_args() -> argparse.Namespace:
     p = argparse.ArgumentParser(
         description="Encrypt a file locally, then wrap the DEK with a KEK in AKV or Managed HSM."
     )
-    p.add_argument("file", help="Path to the file to encrypt.")
-    
+    p.add_argument(
+        "file",
+        help=(
+            "Path to the file to encrypt. A directory or a quoted glob pattern "
+            "(e.g. 'data/parts/*.csv') encrypts every match as a shard of one dataset."
+        )
+    )
+    p.add_argument(
+        "--out-dir",
+        help="Output directory for sharded datasets (default: the directory of the inputs)."
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of parallel encryption processes for sharded datasets (default: CPU count)."
+    )
+    p.add_argument(
+        "--schema",
+        action="store_true",
+        help=(
+            "Also infer a compact column schema (requires pandas) and store it next to the "
+            "encrypted data, so train_xgb.py can parse directly into memory-efficient dtypes."
+        )
+    )
     p.add_argument(
         "--key-id",
         help=(
@@ -57,10 +196,11 @@ def parse_args() -> argparse.Namespace:
 def main():
     args = parse_args()
 
-    src_path = Path(args.file)
-    if not src_path.exists() or not src_path.is_file():
-        logging.error(f"Input file not found: {src_path}")
+    src_paths = resolve_inputs(args.file)
+    if not src_paths:
+        logging.error(f"Input file not found: {args.file}")
         sys.exit(1)
+    sharded = not Path(args.file).is_file()
 
     # Resolve Key ID (prefer --key-id if provided)
     if args.key_id:
@@ -74,22 +214,48 @@ def main():
     credential = DefaultAzureCredential()
     crypto_client = CryptographyClient(key_id, credential)
 
-    logging.info(f"Starting encryption for: {src_path.name}")
+    if sharded:
+        logging.info(f"Starting encryption for {len(src_paths)} shards matching: {args.file}")
+    else:
+        logging.info(f"Starting encryption for: {src_paths[0].name}")
 
     # 1) Generate DEK (32 bytes for AES-256)
     dek = os.urandom(32)
 
-    # 2) Encrypt the file locally with AES-256-GCM
-    encrypted_file_path = encrypt_file(src_path, dek)
-    logging.info(f"Encrypted data -> '{encrypted_file_path.name}'")
+    # 2) Encrypt the file(s) locally with AES-256-GCM
+    if sharded:
+        out_dir = Path(args.out_dir) if args.out_dir else src_paths[0].parent
+        shards = encrypt_shards(src_paths, out_dir, dek, args.workers)
+        key_file_path = out_dir / SHARDED_KEY_NAME
+        manifest = {
+            "version": 1,
+            "format": "csv",  # how train_xgb.py parses the shards, checked by skr_decrypt.read_manifest
+            "key_file": key_file_path.name,
+            "shards": shards,
+        }
+        schema_path = out_dir / SCHEMA_NAME
+        if args.schema:
+            manifest["schema_file"] = schema_path.name
+        manifest_path = out_dir / MANIFEST_NAME
+        manifest_path.write_text(json.dumps(manifest, indent=2))
+        logging.info(f"Encrypted {len(shards)} shards -> '{out_dir}' (manifest: '{manifest_path.name}')")
+    else:
+        encrypted_file_path = encrypt_file(src_paths[0], dek)
+        key_file_path = src_paths[0].with_suffix(".key")
+        schema_path = src_paths[0].with_suffix(".schema.json")
+        logging.info(f"Encrypted data -> '{encrypted_file_path.name}'")
+
+    if args.schema:
+        logging.info("Inferring compact column schema ...")
+        schema_path.write_text(json.dumps({"columns": infer_schema(src_paths)}, indent=2))
+        logging.info(f"Saved schema -> '{schema_path.name}'")
 
     # 3) Wrap the DEK with the KEK (in AKV or MHSM)
     logging.info(f"Wrapping DEK with KEK using RSA_OAEP_256 ...")
     wrap_result = crypto_client.wrap_key(KeyWrapAlgorithm.rsa_oaep_256, dek)
     wrapped_dek = wrap_result.encrypted_key
 
-    # 4) Persist wrapped DEK alongside the encrypted file
-    key_file_path = src_path.with_suffix(".key")
+    # 4) Persist wrapped DEK alongside the encrypted file(s)
     key_file_path.write_bytes(wrapped_dek)
     logging.info(f"Saved wrapped DEK -> '{key_file_path.name}'")
 
@@ -1,7 +1,10 @@
 import os
+import io
+import json
 import base64
 import subprocess
-import io
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 def unwrap_dek(wrapped_key_path: str, attest_url: str, key_kid: str) -> bytes:
@@ -29,11 +32,31 @@ def unwrap_dek(wrapped_key_path: str, attest_url: str, key_kid: str) -> bytes:
     if dek.endswith(b"\n"):
         dek = dek[:-1]
 
+    # DEKs wrapped inside the CVM by wrap_dek are released in their Base64 form
+    if len(dek) == 44:
+        dek = base64.b64decode(dek)
+
     if len(dek) != 32:
         raise RuntimeError(f"DEK length is {len(dek)} bytes, expected 32. Stderr: {res.stderr.decode()}")
 
     return dek
 
+def wrap_dek(dek: bytes, attest_url: str, key_kid: str) -> bytes:
+    """
+    Uses the AzureAttestSKR tool to wrap a DEK generated inside the TEE with the KEK.
+    Returns the wrapped DEK in the same raw format as the .key files of encrypt_data.py.
+    """
+    cmd = [
+        "sudo", "-E", os.path.expanduser("~/AzureAttestSKR"),
+        "-a", attest_url,
+        "-k", key_kid,
+        "-c", "imds",
+        "-s", base64.b64encode(dek).decode("ascii"), "-w"
+    ]
+
+    res = subprocess.run(cmd, capture_output=True, check=True)
+    return base64.b64decode(res.stdout.strip())
+
 def decrypt_to_memory(enc_path: str, dek: bytes) -> io.BytesIO:
     """
     Decrypts an AES-GCM file and returns its content as an
@@ -56,6 +79,113 @@ def decrypt_to_memory(enc_path: str, dek: bytes) -> io.BytesIO:
     # Return the decrypted data in a binary memory buffer
     return io.BytesIO(plaintext)
 
+def derive_key(dek: bytes, purpose: bytes) -> bytes:
+    """
+    Derives a separate 32-byte key from the DEK with HKDF-SHA256, so that
+    artifacts produced inside the TEE are never encrypted directly with the DEK.
+    """
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=purpose).derive(dek)
+
+class EncryptedWriter:
+    """
+    Streams AES-GCM encryption into the [12-byte nonce][ciphertext][16-byte tag]
+    layout of encrypt_data.py. Data goes to a temporary file which only replaces
+    out_path on close(), so readers never see a partial or unauthenticated file.
+    """
+
+    def __init__(self, out_path: str, key: bytes):
+        self.out_path = out_path
+        self.tmp_path = f"{out_path}.tmp"
+        nonce = os.urandom(12)
+        self._encryptor = Cipher(algorithms.AES(key), modes.GCM(nonce)).encryptor()
+        self._file = open(self.tmp_path, "wb")
+        self._file.write(nonce)
+
+    def write(self, data: bytes):
+        self._file.write(self._encryptor.update(data))
+
+    def close(self):
+        self._file.write(self._encryptor.finalize())
+        self._file.write(self._encryptor.tag)
+        self._file.close()
+        os.replace(self.tmp_path, self.out_path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class DecryptedReader(io.RawIOBase):
+    """
+    Streams the decryption of an AES-GCM file with the [nonce][ciphertext][tag] layout,
+    so large files can be processed in batches without holding all of the plaintext.
+    The tag is only verified once the end is reached (InvalidTag is raised then):
+    results derived from the data must not be released before that.
+    """
+
+    def __init__(self, enc_path: str, dek: bytes):
+        self._file = open(enc_path, "rb")
+        nonce = self._file.read(12)
+        self._file.seek(-16, os.SEEK_END)
+        tag = self._file.read(16)
+        self._file.seek(12)
+        self._remaining = os.path.getsize(enc_path) - 12 - 16
+        self._decryptor = Cipher(algorithms.AES(dek), modes.GCM(nonce, tag)).decryptor()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b) -> int:
+        if self._remaining == 0:
+            if self._decryptor is not None:
+                # Verifies the tag; nothing is left to return with GCM
+                self._decryptor.finalize()
+                self._decryptor = None
+            return 0
+        chunk = self._file.read(min(len(b), self._remaining))
+        if not chunk:
+            raise EOFError("Encrypted file is truncated.")
+        self._remaining -= len(chunk)
+        plaintext = self._decryptor.update(chunk)
+        b[:len(plaintext)] = plaintext
+        return len(plaintext)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+def encrypt_to_file(data: bytes, out_path: str, key: bytes):
+    """
+    Encrypts in-memory data with AES-GCM into the same
+    [12-byte nonce][ciphertext][16-byte tag] layout as encrypt_data.py.
+    """
+    with EncryptedWriter(out_path, key) as writer:
+        writer.write(data)
+
+def read_manifest(manifest_path: str) -> tuple:
+    """
+    Reads a shard manifest written by encrypt_data.py.
+    Returns (wrapped_key_path, [encrypted shard paths], schema_path or None)
+    resolved relative to the manifest.
+    """
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("format", "csv") != "csv":
+        raise ValueError(f"Unsupported shard format in {manifest_path}: {manifest['format']!r} (expected 'csv')")
+    key_path = os.path.join(base, manifest["key_file"])
+    shard_paths = [os.path.join(base, shard["file"]) for shard in manifest["shards"]]
+    schema_path = os.path.join(base, manifest["schema_file"]) if "schema_file" in manifest else None
+    return key_path, shard_paths, schema_path
+
 # The decrypt_to_file function is kept in case you need it for other purposes
 def decrypt_to_file(enc_path: str, out_path: str, dek: bytes):
     """Decrypts data to a file (the previous method)."""
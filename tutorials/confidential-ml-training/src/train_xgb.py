@@ -1,11 +1,32 @@
 import os
+import sys
+import glob
+import json
+import math
+import time
+import random
+import hashlib
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import numpy as np
 import pandas as pd
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score, classification_report
 import xgboost as xgb
+from xgboost.tracker import RabitTracker
 import skr_decrypt as skr
+from cryptography.exceptions import InvalidTag
+
+# pyarrow is only needed for the optional parsed-data cache (CACHE_DIR).
+try:
+    import pyarrow as pa
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -14,41 +35,646 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+MAX_CATEGORY_RATIO = 0.5  # sampled string columns with fewer distinct values become categoricals
+
+
+def infer_compact_dtypes(sample: pd.DataFrame) -> dict:
+    """
+    Infers read_csv dtypes from a sample of the data: floats become float32 and
+    low-cardinality strings become categoricals. Integer widths are not guessed from a
+    sample (a later row could overflow them); compact_frame downcasts them exactly instead.
+    """
+    dtypes = {}
+    for col, s in sample.items():
+        if pd.api.types.is_float_dtype(s):
+            dtypes[col] = "float32"
+        elif s.dtype == object and s.nunique() <= MAX_CATEGORY_RATIO * len(s):
+            dtypes[col] = "category"
+    return dtypes
+
+
+def compact_frame(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    """
+    Downcasts the columns that were not parsed into a compact dtype: integers to the
+    smallest width holding their values, floats to float32, and categoricals that were
+    turned back into objects when concatenating shards with different categories.
+    """
+    for col, s in df.items():
+        if pd.api.types.is_integer_dtype(s) and s.dtype.itemsize > 1:
+            df[col] = pd.to_numeric(s, downcast="integer")
+        elif s.dtype == "float64":
+            df[col] = s.astype("float32")
+        elif dtypes.get(col) == "category" and not isinstance(s.dtype, pd.CategoricalDtype):
+            df[col] = s.astype("category")
+    return df
+
+
+def default_dtype_footprint(df: pd.DataFrame) -> int:
+    """
+    Estimates the bytes the DataFrame would use with pandas' default dtypes
+    (int64/float64 and one Python string object per row for text).
+    """
+    total = 0
+    for _, s in df.items():
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            counts = s.value_counts()
+            total += 8 * len(s) + sum(sys.getsizeof(v) * n for v, n in counts.items())
+        elif s.dtype.kind in "iuf":
+            total += 8 * len(s)
+        else:
+            total += s.memory_usage(index=False, deep=True)
+    return total
+
+
+def _load_shard(job: tuple) -> pd.DataFrame:
+    """Worker entry point: decrypt one shard in memory and parse it."""
+    enc_path, dek, dtypes = job
+    df = pd.read_csv(skr.decrypt_to_memory(enc_path, dek), dtype=dtypes)
+    return compact_frame(df, dtypes) if dtypes is not None else df
+
+
+def load_sharded_dataset(shard_paths: list, dek: bytes, workers: int, dtypes: dict = None) -> pd.DataFrame:
+    """
+    Decrypts and parses the shards of a dataset on a process pool, then concatenates them.
+    Plaintext only ever lives in the memory of the worker processes and of this process.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(_load_shard, [(p, dek, dtypes) for p in shard_paths]))
+    df = pd.concat(frames, ignore_index=True)
+    return compact_frame(df, dtypes) if dtypes is not None else df
+
+
+def load_dataset(enc_paths: list, dek: bytes, sharded: bool, dtypes: dict = None, workers: int = None) -> pd.DataFrame:
+    """
+    Decrypts the dataset in memory and parses it into a DataFrame.
+    When dtypes is given (compact mode), columns are parsed into them and the
+    remaining ones are downcast after parsing.
+    """
+    if sharded:
+        workers = workers or int(os.environ.get("LOAD_WORKERS", os.cpu_count()))
+        logging.info(f"Decrypting and parsing {len(enc_paths)} shards with {workers} workers...")
+        return load_sharded_dataset(enc_paths, dek, workers, dtypes)
+
+    logging.info(f"Decrypting '{enc_paths[0]}' into memory...")
+    decrypted_stream = skr.decrypt_to_memory(enc_paths[0], dek)
+    logging.info("Decryption complete.")
+    df = pd.read_csv(decrypted_stream, dtype=dtypes)
+    return compact_frame(df, dtypes) if dtypes is not None else df
+
+
+def read_schema(schema_file: str):
+    """Returns the column dtypes written by `encrypt_data.py --schema`, or None if there is no schema."""
+    if not schema_file or not os.path.isfile(schema_file):
+        return None
+    logging.info(f"Using column schema from '{schema_file}'.")
+    with open(schema_file, "r") as f:
+        return json.load(f)["columns"]
+
+
+def sample_compact_dtypes(enc_path: str, dek: bytes, sample_rows: int) -> dict:
+    """Infers compact dtypes from the first rows of an encrypted CSV file."""
+    logging.info(f"Inferring compact dtypes from the first {sample_rows} rows...")
+    sample = pd.read_csv(skr.decrypt_to_memory(enc_path, dek), nrows=sample_rows)
+    return infer_compact_dtypes(sample)
+
+
+def dataset_fingerprint(enc_paths: list, parse_options: dict) -> str:
+    """
+    Identifies an encrypted dataset together with the options used to parse it.
+    The GCM nonce and tag of each file authenticate its whole ciphertext, so hashing
+    them (plus the file size) detects any change without reading the full dataset.
+    """
+    h = hashlib.sha256()
+    for path in enc_paths:
+        with open(path, "rb") as f:
+            h.update(f.read(12))
+            f.seek(-16, os.SEEK_END)
+            h.update(f.read(16))
+        h.update(str(os.path.getsize(path)).encode())
+    h.update(json.dumps(parse_options, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def load_cached_dataset(cache_path: str, cache_key: bytes):
+    """
+    Decrypts a parsed-data cache entry (Arrow IPC) into a DataFrame.
+    Returns None when the entry is missing or cannot be authenticated.
+    """
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        buf = skr.decrypt_to_memory(cache_path, cache_key).getbuffer()
+    except InvalidTag:
+        logging.warning(f"Ignoring cache entry that failed authentication: '{cache_path}'")
+        return None
+    return pa.ipc.open_file(pa.py_buffer(buf)).read_pandas()
+
+
+def store_cached_dataset(df: pd.DataFrame, cache_path: str, cache_key: bytes):
+    """
+    Serializes a DataFrame to Arrow IPC and stores it encrypted at rest, then removes the
+    other entries of the cache directory (older versions of the dataset or parse options),
+    so the cache does not grow by a full copy of the data on every change.
+    """
+    sink = pa.BufferOutputStream()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    skr.encrypt_to_file(sink.getvalue().to_pybytes(), cache_path, cache_key)
+    for old in glob.glob(os.path.join(os.path.dirname(cache_path), "*.arrow.enc")):
+        if os.path.abspath(old) != os.path.abspath(cache_path):
+            os.remove(old)
+            logging.info(f"Removed stale cache entry '{old}'.")
+
+
+def feature_dtypes(X: pd.DataFrame) -> dict:
+    """
+    The dtypes of the training features that score_xgb.py must parse new records into:
+    float32 columns, and categoricals with their training categories, in the same order so
+    the category codes seen by the model match. Other columns keep pandas' default dtypes
+    (a narrower integer width could overflow on new records).
+    """
+    dtypes = {}
+    for col, s in X.items():
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            dtypes[col] = {"categories": s.cat.categories.tolist()}
+        elif s.dtype == "float32":
+            dtypes[col] = "float32"
+    return dtypes
+
+
+def save_encrypted_model(booster: xgb.Booster, model_out: str, dtypes: dict = None):
+    """
+    Saves the booster as UBJSON, encrypted under a freshly generated DEK that is
+    wrapped with the KEK. The wrapped DEK is written next to it with a .key extension.
+    The feature dtypes (see feature_dtypes) are stored in the model as the "feature_dtypes" attribute.
+    """
+    if dtypes:
+        booster.set_attr(feature_dtypes=json.dumps(dtypes))
+    model_dek = os.urandom(32)
+    skr.encrypt_to_file(bytes(booster.save_raw(raw_format="ubj")), model_out, model_dek)
+    key_path = os.path.splitext(model_out)[0] + ".key"
+    with open(key_path, "wb") as f:
+        f.write(skr.wrap_dek(model_dek, os.environ["ATTEST_URL"], os.environ["KEY_KID"]))
+    del model_dek
+    logging.info(f"Encrypted model saved -> '{model_out}' (wrapped DEK: '{key_path}')")
+
+
+class EncryptedCheckpoint(xgb.callback.TrainingCallback):
+    """
+    Saves the booster as an encrypted UBJSON checkpoint at least every min_interval rounds.
+    The interval grows when saving is slow compared to a boosting round, so that
+    checkpointing stays under max_overhead_pct percent of the training time.
+    Only the `keep` most recent checkpoints are kept.
+    """
+
+    def __init__(self, checkpoint_dir: str, key: bytes, min_interval: int, max_overhead_pct: float, keep: int = 2):
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.key = key
+        self.min_interval = min_interval
+        self.interval = min_interval
+        self.max_overhead = max_overhead_pct / 100
+        self.keep = keep
+        self._last_saved = 0
+        self._round_seconds = None
+        self._tick = None
+
+    def before_training(self, model):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        self._last_saved = model.num_boosted_rounds()
+        self._tick = time.perf_counter()
+        return model
+
+    def after_iteration(self, model, epoch, evals_log) -> bool:
+        # Moving average of the time per round, excluding the time spent saving
+        elapsed = time.perf_counter() - self._tick
+        self._round_seconds = elapsed if self._round_seconds is None else 0.8 * self._round_seconds + 0.2 * elapsed
+        rounds = model.num_boosted_rounds()
+        if rounds - self._last_saved >= self.interval:
+            self.save(model, rounds)
+        self._tick = time.perf_counter()
+        return False
+
+    def save(self, model, rounds: int):
+        start = time.perf_counter()
+        path = os.path.join(self.checkpoint_dir, f"checkpoint-{rounds:07d}.ubj.enc")
+        skr.encrypt_to_file(bytes(model.save_raw(raw_format="ubj")), path, self.key)
+        save_seconds = time.perf_counter() - start
+        self._last_saved = rounds
+
+        # Saving every k rounds costs save_seconds per k * round_seconds of training
+        needed = save_seconds / (self.max_overhead * max(self._round_seconds, 1e-9))
+        self.interval = max(self.min_interval, math.ceil(needed))
+        logging.info(f"Checkpoint at round {rounds} saved in {save_seconds:.2f}s (next in {self.interval} rounds).")
+        for old in list_checkpoints(self.checkpoint_dir)[self.keep:]:
+            os.remove(old)
+
+
+def list_checkpoints(checkpoint_dir: str) -> list:
+    """Returns the checkpoint files of a directory, most recent first."""
+    return sorted(glob.glob(os.path.join(checkpoint_dir, "checkpoint-*.ubj.enc")), reverse=True)
+
+
+def load_latest_checkpoint(checkpoint_dir: str, key: bytes):
+    """Loads the most recent checkpoint that decrypts and authenticates, or returns None."""
+    for path in list_checkpoints(checkpoint_dir):
+        try:
+            raw = skr.decrypt_to_memory(path, key).getbuffer()
+        except InvalidTag:
+            logging.warning(f"Skipping checkpoint that failed authentication: '{path}'")
+            continue
+        booster = xgb.Booster()
+        booster.load_model(bytearray(raw))
+        logging.info(f"Resuming from '{path}' ({booster.num_boosted_rounds()} rounds done).")
+        return booster
+    return None
+
+
+# Hyperparameter search space for TRAIN_MODE=search
+SEARCH_SPACE = {
+    "max_depth": [3, 4, 6, 8],
+    "learning_rate": [0.03, 0.1, 0.3],
+    "subsample": [0.7, 0.85, 1.0],
+    "colsample_bytree": [0.7, 0.85, 1.0],
+    "min_child_weight": [1, 5],
+    "reg_lambda": [1.0, 5.0],
+}
+BASE_PARAMS = {"objective": "binary:logistic", "eval_metric": "logloss", "tree_method": "hist"}
+
+
+def generate_configs(strategy: str, n_trials: int, seed: int = 42) -> list:
+    """Returns the full grid of SEARCH_SPACE, or n_trials random draws from it."""
+    keys = sorted(SEARCH_SPACE)
+    if strategy == "grid":
+        return [dict(zip(keys, values)) for values in itertools.product(*(SEARCH_SPACE[k] for k in keys))]
+    rng = random.Random(seed)
+    return [{k: rng.choice(SEARCH_SPACE[k]) for k in keys} for _ in range(n_trials)]
+
+
+def _advance_trial(trial: dict, target_rounds: int, dtrain, dvalid, nthread: int, early_stopping: int):
+    """
+    Continues training a trial's booster up to target_rounds boosting rounds.
+    Trials that already early-stopped are left as they are.
+    """
+    if trial["stopped"] or trial["rounds"] >= target_rounds:
+        return
+    start = time.perf_counter()
+    evals_result = {}
+    booster = xgb.train(
+        {**BASE_PARAMS, **trial["params"], "nthread": nthread},
+        dtrain,
+        num_boost_round=target_rounds - trial["rounds"],
+        evals=[(dvalid, "valid")],
+        evals_result=evals_result,
+        early_stopping_rounds=early_stopping,
+        xgb_model=trial["booster"],
+        verbose_eval=False,
+    )
+    history = evals_result["valid"]["logloss"]
+    best = min(range(len(history)), key=history.__getitem__)
+    if history[best] < trial["valid_logloss"]:
+        trial["valid_logloss"] = history[best]
+        trial["best_iteration"] = trial["rounds"] + best + 1
+    trial["stopped"] = len(history) < target_rounds - trial["rounds"]
+    trial["rounds"] += len(history)
+    trial["booster"] = booster
+    trial["seconds"] += time.perf_counter() - start
+
+
+def hyperparameter_search(X_train: pd.DataFrame, y_train: pd.Series, enable_categorical: bool):
+    """
+    Runs a grid or random search with successive halving on the already decrypted data.
+    One QuantileDMatrix is built and shared by every trial; trials run on a thread pool
+    (XGBoost releases the GIL while training) with the cores split between them.
+    Every rung trains the surviving trials for `eta` times more rounds and keeps the best 1/eta.
+    Returns (best booster, best iteration, results table).
+    """
+    strategy = os.environ.get("SEARCH_STRATEGY", "random").lower()
+    configs = generate_configs(strategy, int(os.environ.get("SEARCH_TRIALS", 16)))
+    workers = int(os.environ.get("SEARCH_WORKERS", max(1, (os.cpu_count() or 1) // 4)))
+    nthread = max(1, (os.cpu_count() or 1) // workers)
+    min_rounds = int(os.environ.get("SEARCH_MIN_ROUNDS", 50))
+    max_rounds = int(os.environ.get("SEARCH_MAX_ROUNDS", 800))
+    eta = int(os.environ.get("HALVING_ETA", 3))
+    early_stopping = int(os.environ.get("EARLY_STOPPING_ROUNDS", 20))
+    logging.info(
+        f"Starting {strategy} search over {len(configs)} configurations: "
+        f"{workers} parallel trials x {nthread} threads, {min_rounds}-{max_rounds} rounds (eta={eta})."
+    )
+
+    # Hold out part of the training data for early stopping and trial ranking
+    X_fit, X_valid, y_fit, y_valid = train_test_split(X_train, y_train, test_size=0.2, random_state=42)
+    dtrain = xgb.QuantileDMatrix(X_fit, y_fit, enable_categorical=enable_categorical)
+    dvalid = xgb.QuantileDMatrix(X_valid, y_valid, ref=dtrain, enable_categorical=enable_categorical)
+
+    trials = [
+        {"trial": i, "params": params, "booster": None, "rounds": 0, "best_iteration": 0,
+         "valid_logloss": float("inf"), "stopped": False, "rung": 0, "seconds": 0.0}
+        for i, params in enumerate(configs)
+    ]
+    alive, budget, rung = trials, min_rounds, 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            list(pool.map(lambda t: _advance_trial(t, budget, dtrain, dvalid, nthread, early_stopping), alive))
+            for t in alive:
+                t["rung"] = rung
+            logging.info(
+                f"Rung {rung}: {len(alive)} trials at {budget} rounds, "
+                f"best valid logloss {min(t['valid_logloss'] for t in alive):.4f}"
+            )
+            if budget >= max_rounds or len(alive) == 1:
+                break
+            alive = sorted(alive, key=lambda t: t["valid_logloss"])[:max(1, len(alive) // eta)]
+            budget, rung = min(budget * eta, max_rounds), rung + 1
+
+    results = pd.DataFrame([
+        {"trial": t["trial"], **t["params"], "rung": t["rung"], "rounds": t["rounds"],
+         "best_iteration": t["best_iteration"], "valid_logloss": t["valid_logloss"],
+         "seconds": round(t["seconds"], 2)}
+        for t in trials
+    ]).sort_values("valid_logloss")
+    best = min(trials, key=lambda t: t["valid_logloss"])
+    return best["booster"], best["best_iteration"], results
+
+
+def distributed_worker(rank: int, world_size: int, tracker_args: dict, nthread: int):
+    """
+    Runs one worker of a distributed training job (TRAIN_MODE=distributed).
+    Each worker performs its own attestation and DEK unwrap, decrypts only its own
+    shards of the manifest, and trains together with the other workers through
+    XGBoost's collective: only quantile sketches and gradient histograms leave the worker.
+    """
+    load_dotenv()
+    wrapped_key_file, shard_paths, schema_file = skr.read_manifest(os.environ["MANIFEST_FILE"])
+    my_shards = shard_paths[rank::world_size]
+    if not my_shards:
+        raise ValueError(f"Worker {rank}: the manifest has fewer shards ({len(shard_paths)}) than workers ({world_size}).")
+
+    start = time.perf_counter()
+    dek = skr.unwrap_dek(
+        os.environ.get("WRAPPED_KEY_FILE", wrapped_key_file),
+        os.environ["ATTEST_URL"],
+        os.environ["KEY_KID"]
+    )
+    dtypes = None
+    if os.environ.get("DTYPES", "default").lower() == "compact":
+        dtypes = read_schema(os.environ.get("SCHEMA_FILE", schema_file))
+        if dtypes is None:
+            dtypes = sample_compact_dtypes(my_shards[0], dek, int(os.environ.get("SAMPLE_ROWS", 10_000)))
+    df = load_dataset(my_shards, dek, sharded=True, dtypes=dtypes, workers=nthread)
+    del dek # The DEK is no longer needed, clear it from memory
+    load_seconds = time.perf_counter() - start
+
+    X = df.drop("Outcome", axis=1)
+    y = df["Outcome"]
+    if any(isinstance(dtype, pd.CategoricalDtype) for dtype in X.dtypes):
+        # Category codes are assigned per worker, so they would not match across workers
+        raise ValueError("Categorical columns are not supported in distributed mode.")
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+
+    with xgb.collective.CommunicatorContext(**tracker_args, dmlc_task_id=str(rank)):
+        start = time.perf_counter()
+        dtrain = xgb.QuantileDMatrix(X_train, y_train)
+        booster = xgb.train(
+            {**BASE_PARAMS, "nthread": nthread},
+            dtrain,
+            num_boost_round=int(os.environ.get("TRAIN_ROUNDS", 100)),
+        )
+        train_seconds = time.perf_counter() - start
+        logging.info(
+            f"Worker {rank}/{world_size}: {len(df)} rows from {len(my_shards)} shards, "
+            f"loaded in {load_seconds:.2f}s, trained in {train_seconds:.2f}s."
+        )
+
+        # Each worker scores its own test split; only the counts are aggregated
+        preds = (booster.inplace_predict(X_test) > 0.5).astype(int)
+        correct, total = xgb.collective.allreduce(
+            np.array([(preds == y_test.to_numpy()).sum(), len(y_test)], dtype=np.float64),
+            xgb.collective.Op.SUM,
+        )
+        if rank == 0:
+            logging.info(f"Distributed Model Accuracy: {correct / total:.4f} ({int(total)} test rows)")
+            if os.environ.get("MODEL_OUT"):
+                save_encrypted_model(booster, os.environ["MODEL_OUT"], feature_dtypes(X))
+
+
+def run_local_distributed(world_size: int) -> float:
+    """
+    Runs a distributed training job as world_size local processes over localhost,
+    with the tracker in this process. Returns the wall-clock time of the job.
+    """
+    tracker = RabitTracker(host_ip="127.0.0.1", n_workers=world_size, sortby="task")
+    tracker.start()
+    nthread = max(1, (os.cpu_count() or 1) // world_size)
+    ctx = multiprocessing.get_context("spawn")
+    start = time.perf_counter()
+    procs = [
+        ctx.Process(target=distributed_worker, args=(rank, world_size, tracker.worker_args(), nthread))
+        for rank in range(world_size)
+    ]
+    for proc in procs:
+        proc.start()
+    # Wait on the exit codes as workers finish: the others (and the tracker) would wait forever
+    # in the collective for a worker that failed, so they are terminated
+    running = {proc.sentinel: proc for proc in procs}
+    while running:
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            running.pop(sentinel).join()
+        if any(proc.exitcode not in (None, 0) for proc in procs):
+            for proc in running.values():
+                proc.terminate()
+                proc.join()
+            raise RuntimeError(f"A distributed worker failed (exit codes: {[proc.exitcode for proc in procs]}).")
+    tracker.wait_for()
+    return time.perf_counter() - start
+
+
+def run_distributed():
+    """
+    Entry point of TRAIN_MODE=distributed. DIST_ROLE selects what this process does:
+      - "local" (default): run the job as local processes for each count in DIST_LOCAL_WORKERS
+        and report the speedup versus the first count.
+      - "tracker": run the tracker for DIST_WORLD_SIZE workers on DIST_TRACKER_HOST:DIST_TRACKER_PORT.
+      - "worker": run worker DIST_RANK of DIST_WORLD_SIZE against that tracker.
+    """
+    role = os.environ.get("DIST_ROLE", "local").lower()
+    if role == "worker":
+        tracker_args = {
+            "dmlc_tracker_uri": os.environ["DIST_TRACKER_HOST"],
+            "dmlc_tracker_port": int(os.environ.get("DIST_TRACKER_PORT", 9091)),
+        }
+        distributed_worker(
+            int(os.environ["DIST_RANK"]),
+            int(os.environ["DIST_WORLD_SIZE"]),
+            tracker_args,
+            int(os.environ.get("DIST_NTHREAD", os.cpu_count())),
+        )
+        return
+    if role == "tracker":
+        tracker = RabitTracker(
+            host_ip=os.environ["DIST_TRACKER_HOST"],
+            n_workers=int(os.environ["DIST_WORLD_SIZE"]),
+            port=int(os.environ.get("DIST_TRACKER_PORT", 9091)),
+            sortby="task",
+        )
+        tracker.start()
+        logging.info(f"Tracker listening, waiting for {os.environ['DIST_WORLD_SIZE']} workers...")
+        tracker.wait_for()
+        return
+
+    counts = [int(n) for n in os.environ.get("DIST_LOCAL_WORKERS", "1,2,4").split(",")]
+    # Every worker needs at least one shard, checked before any process is started
+    _, shard_paths, _ = skr.read_manifest(os.environ["MANIFEST_FILE"])
+    skipped = [n for n in counts if n > len(shard_paths)]
+    if skipped:
+        logging.warning(f"Skipping {skipped} workers: the manifest has only {len(shard_paths)} shards.")
+    counts = [n for n in counts if n <= len(shard_paths)]
+    if not counts:
+        raise ValueError(f"The manifest has fewer shards ({len(shard_paths)}) than any of DIST_LOCAL_WORKERS.")
+    timings = []
+    for world_size in counts:
+        logging.info(f"Running distributed training with {world_size} local workers...")
+        timings.append({"workers": world_size, "seconds": round(run_local_distributed(world_size), 2)})
+    report = pd.DataFrame(timings)
+    report["speedup"] = (report["seconds"].iloc[0] / report["seconds"]).round(2)
+    logging.info(f"Distributed training speedup:\n{report.to_string(index=False)}")
+
+
 def main():
     load_dotenv()
     logging.info("--- Starting Confidential XGBoost Training (In-Memory) ---")
 
+    if os.environ.get("TRAIN_MODE", "single").lower() == "distributed":
+        run_distributed()
+        return
+
+    # A sharded dataset is described by the manifest written by encrypt_data.py
+    manifest_file = os.environ.get("MANIFEST_FILE")
+    if manifest_file:
+        wrapped_key_file, shard_paths, schema_file = skr.read_manifest(manifest_file)
+        wrapped_key_file = os.environ.get("WRAPPED_KEY_FILE", wrapped_key_file)
+    else:
+        wrapped_key_file = os.environ["WRAPPED_KEY_FILE"]
+        shard_paths = [os.environ["ENC_FILE"]]
+        schema_file = os.path.splitext(shard_paths[0])[0] + ".schema.json"
+    schema_file = os.environ.get("SCHEMA_FILE", schema_file)
+
+    # DTYPES=compact parses into memory-efficient dtypes (float32, small ints, categoricals)
+    compact = os.environ.get("DTYPES", "default").lower() == "compact"
+    dtypes = read_schema(schema_file) if compact else None
+    sample_rows = int(os.environ.get("SAMPLE_ROWS", 10_000))
+
+    # Optional encrypted cache of the parsed data, keyed by the dataset and parse options
+    cache_dir = os.environ.get("CACHE_DIR")
+    if cache_dir and not HAS_PYARROW:
+        logging.warning("CACHE_DIR is set but pyarrow is not installed; the parsed-data cache is disabled.")
+        cache_dir = None
+    parse_options = {
+        "format": "csv",
+        "dtypes": "compact" if compact else "default",
+        "schema": dtypes,
+        # Without a schema, the compact dtypes depend on the sample they are inferred from
+        "sample_rows": sample_rows if compact and dtypes is None else None,
+    }
+    dataset_id = dataset_fingerprint(shard_paths, parse_options)
+
+    # Optional encrypted training checkpoints, kept per dataset
+    checkpoint_dir = os.environ.get("CHECKPOINT_DIR")
+    resume = os.environ.get("RESUME", "").lower() in ("1", "true", "yes")
+    if resume and not checkpoint_dir:
+        # Rather than silently training from scratch
+        raise ValueError("RESUME is set but CHECKPOINT_DIR is not: there are no checkpoints to resume from.")
+    if checkpoint_dir:
+        checkpoint_dir = os.path.join(checkpoint_dir, dataset_id[:16])
+
     # 1. Securely unwrap the DEK inside the TEE
     logging.info("Attesting to Azure and unwrapping DEK...")
     dek = skr.unwrap_dek(
-        os.environ["WRAPPED_KEY_FILE"],
+        wrapped_key_file,
         os.environ["ATTEST_URL"],
         os.environ["KEY_KID"]
     )
     logging.info("DEK securely retrieved.")
 
-    # 2. Decrypt the dataset directly into memory
-    encrypted_file = os.environ['ENC_FILE']
-    logging.info(f"Decrypting '{encrypted_file}' into memory...")
-    decrypted_stream = skr.decrypt_to_memory(encrypted_file, dek)
+    # 2. Decrypt the dataset directly into memory and load it into pandas
+    start = time.perf_counter()
+    df = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_key = skr.derive_key(dek, b"train_xgb parsed-data cache")
+        cache_path = os.path.join(cache_dir, dataset_id + ".arrow.enc")
+        df = load_cached_dataset(cache_path, cache_key)
+        if df is not None:
+            logging.info(f"Loaded parsed data from encrypted cache '{cache_path}'.")
+
+    if df is None:
+        if compact and dtypes is None:
+            dtypes = sample_compact_dtypes(shard_paths[0], dek, sample_rows)
+        df = load_dataset(shard_paths, dek, sharded=bool(manifest_file), dtypes=dtypes)
+        if cache_dir:
+            store_cached_dataset(df, cache_path, cache_key)
+            logging.info(f"Stored parsed data in encrypted cache '{cache_path}'.")
+    checkpoint_key = skr.derive_key(dek, b"train_xgb checkpoints") if checkpoint_dir else None
     del dek # The DEK is no longer needed, clear it from memory
-    logging.info("Decryption complete.")
+    logging.info(f"Loaded {len(df)} rows in {time.perf_counter() - start:.2f}s.")
+    if compact:
+        before = default_dtype_footprint(df) / 2**20
+        after = df.memory_usage(index=False, deep=True).sum() / 2**20
+        # The default-dtype figure is computed from the compact data, not measured by parsing it again
+        logging.info(f"Memory usage: {after:.1f} MiB with compact dtypes "
+                     f"(estimate with default dtypes, not measured: {before:.1f} MiB).")
+
+    # 3. Train the model
+    logging.info("Training model...")
 
-    # 3. Load data and train the model
-    logging.info("Loading data into pandas and training model...")
-    df = pd.read_csv(decrypted_stream)
-    
     X = df.drop("Outcome", axis=1)
     y = df["Outcome"]
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
-    model = xgb.XGBClassifier(eval_metric='logloss')
-    model.fit(X_train, y_train)
+    has_categoricals = any(isinstance(dtype, pd.CategoricalDtype) for dtype in X.dtypes)
+    if os.environ.get("TRAIN_MODE", "single").lower() == "search":
+        # Every trial reuses the data decrypted above: one attestation and one decryption per sweep
+        booster, best_iteration, results = hyperparameter_search(X_train, y_train, has_categoricals)
+        logging.info(f"Search results:\n{results.to_string(index=False)}")
+        if os.environ.get("SEARCH_RESULTS"):
+            results.to_csv(os.environ["SEARCH_RESULTS"], index=False)
+            logging.info(f"Search results written to '{os.environ['SEARCH_RESULTS']}'.")
+        booster = booster[:best_iteration]
+        predict = lambda X: (booster.inplace_predict(X) > 0.5).astype(int)
+    else:
+        total_rounds = int(os.environ.get("TRAIN_ROUNDS", 100))
+        callbacks, resume_from = [], None
+        if checkpoint_dir:
+            if resume:
+                resume_from = load_latest_checkpoint(checkpoint_dir, checkpoint_key)
+            callbacks.append(EncryptedCheckpoint(
+                checkpoint_dir,
+                checkpoint_key,
+                min_interval=int(os.environ.get("CHECKPOINT_ROUNDS", 10)),
+                max_overhead_pct=float(os.environ.get("CHECKPOINT_MAX_OVERHEAD_PCT", 5)),
+            ))
+        done_rounds = resume_from.num_boosted_rounds() if resume_from else 0
+
+        if done_rounds >= total_rounds:
+            logging.info("The latest checkpoint already has all the requested rounds.")
+            booster = resume_from
+            predict = lambda X: (booster.inplace_predict(X) > 0.5).astype(int)
+        else:
+            model = xgb.XGBClassifier(
+                n_estimators=total_rounds - done_rounds,
+                eval_metric='logloss',
+                enable_categorical=has_categoricals,
+                callbacks=callbacks,
+            )
+            model.fit(X_train, y_train, xgb_model=resume_from)
+            booster = model.get_booster()
+            predict = model.predict
     logging.info("Model training finished.")
 
     # 4. Evaluate the model
     logging.info("Evaluating model performance...")
-    preds = model.predict(X_test)
+    preds = predict(X_test)
     acc = accuracy_score(y_test, preds)
     report = classification_report(y_test, preds)
 
@@ -57,5 +683,9 @@ def main():
     # Log the multi-line classification report
     logging.info(f"Classification Report:\n{report}")
 
+    # 5. Optionally keep the model, encrypted, for batch scoring with score_xgb.py
+    if os.environ.get("MODEL_OUT"):
+        save_encrypted_model(booster, os.environ["MODEL_OUT"], feature_dtypes(X))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
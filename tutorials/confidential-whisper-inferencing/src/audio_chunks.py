@@ -0,0 +1,257 @@
+# audio_chunks.py
+"""
+Client-side audio processing for Confidential Whisper:
+- preprocessing: decoding to 16 kHz mono (what Whisper uses), trimming long silences and
+  re-encoding compactly, so fewer bytes are encrypted and sent through the OHTTP relay;
+- splitting of long recordings into overlapping segments cut at silences, so they can be
+  transcribed by parallel requests, and stitching of the segment texts.
+
+Audio is decoded and compressed with ffmpeg when it is on the PATH (mp3, m4a, ogg, mp4, ...);
+without it, only PCM WAV files can be decoded and audio is re-encoded as WAV.
+
+Run `python audio_chunks.py` for a self-check on synthetic audio.
+"""
+import io
+import wave
+import shutil
+import subprocess
+from typing import List, Tuple
+
+import numpy as np
+
+SAMPLE_RATE = 16000   # Whisper works on 16 kHz mono audio
+FRAME_S = 0.02        # frame length of the energy curve used to find silences
+SMOOTH_S = 0.3        # a cut needs this much quiet, not a short dip inside a word
+SILENCE_DB = -45      # frames quieter than this (dBFS) are silent
+FORMATS = ("flac", "ogg", "wav")  # flac: lossless; ogg: Opus 32 kbit/s, smallest; wav: no ffmpeg needed
+
+
+def has_ffmpeg() -> bool:
+    return shutil.which("ffmpeg") is not None
+
+
+def decode_audio(data: bytes, sample_rate: int = SAMPLE_RATE) -> Tuple[np.ndarray, int]:
+    """
+    Decodes an audio file to mono int16 samples at `sample_rate`.
+    Returns (samples, sample_rate). Raises ValueError if the file cannot be decoded.
+    """
+    if has_ffmpeg():
+        proc = subprocess.run(
+            ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", "pipe:0",
+             "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"],
+            input=data, capture_output=True,
+        )
+        if proc.returncode != 0:
+            raise ValueError(f"ffmpeg could not decode the audio: {proc.stderr.decode(errors='replace').strip()}")
+        return np.frombuffer(proc.stdout, dtype=np.int16), sample_rate
+
+    try:
+        with wave.open(io.BytesIO(data)) as w:
+            channels, width, rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+            frames = w.readframes(w.getnframes())
+    except (wave.Error, EOFError) as e:
+        raise ValueError("only PCM WAV files can be decoded without ffmpeg") from e
+    if width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.int16) - 128) << 8
+    elif width == 2:
+        samples = np.frombuffer(frames, dtype="<i2")
+    elif width == 4:
+        samples = (np.frombuffer(frames, dtype="<i4") >> 16).astype(np.int16)
+    else:
+        raise ValueError(f"unsupported WAV sample width: {8 * width} bits")
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return resample(samples, rate, sample_rate), sample_rate
+
+
+def resample(samples: np.ndarray, rate: int, target_rate: int, taps: int = 63) -> np.ndarray:
+    """
+    Resamples int16 samples to `target_rate`: windowed-sinc low-pass filter below the new
+    Nyquist frequency (against aliasing), then linear interpolation.
+    """
+    if rate == target_rate or not len(samples):
+        return samples
+    x = samples.astype(np.float32)
+    if target_rate < rate:
+        cutoff = 0.5 * target_rate / rate
+        t = np.arange(taps) - (taps - 1) / 2
+        kernel = (2 * cutoff * np.sinc(2 * cutoff * t) * np.hamming(taps)).astype(np.float32)
+        x = np.convolve(x, kernel / kernel.sum(), mode="same")
+    n = int(round(len(samples) * target_rate / rate))
+    y = np.interp(np.arange(n) * (rate / target_rate), np.arange(len(x)), x)
+    return np.clip(np.round(y), -32768, 32767).astype(np.int16)
+
+
+def trim_silences(samples: np.ndarray, rate: int, min_silence_s: float = 1.0, keep_s: float = 0.3,
+                  threshold_db: float = SILENCE_DB) -> np.ndarray:
+    """
+    Shortens every silence longer than `min_silence_s` to `keep_s` seconds (half kept on each
+    side), including leading and trailing silence. Whisper has nothing to transcribe in them.
+    """
+    n = max(int(rate * FRAME_S), 1)
+    energy = frame_energy(samples, rate)
+    silent = np.concatenate(([False], energy < 32768 * 10 ** (threshold_db / 20), [False]))
+    edges = np.flatnonzero(np.diff(silent.astype(np.int8)))
+    starts, ends = edges[0::2], edges[1::2]  # runs of silent frames [start, end)
+    long_runs = ends - starts > min_silence_s / FRAME_S
+    keep = np.ones(len(energy), dtype=bool)
+    half = int(keep_s / FRAME_S / 2)
+    for start, end in zip(starts[long_runs], ends[long_runs]):
+        keep[start + half:end - half] = False
+    mask = np.ones(len(samples), dtype=bool)
+    mask[:len(keep) * n] = np.repeat(keep, n)
+    return samples[mask]
+
+
+def encode_audio(samples: np.ndarray, rate: int, fmt: str = "flac") -> bytes:
+    """Encodes mono int16 samples as `fmt` (one of FORMATS); flac and ogg need ffmpeg."""
+    if fmt == "wav":
+        return encode_wav(samples, rate)
+    codec = {"flac": ["-c:a", "flac"], "ogg": ["-c:a", "libopus", "-b:a", "32k"]}[fmt]
+    proc = subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-f", "s16le", "-ac", "1", "-ar", str(rate), "-i", "pipe:0",
+         *codec, "-f", fmt, "pipe:1"],
+        input=np.ascontiguousarray(samples, dtype="<i2").tobytes(), capture_output=True,
+    )
+    if proc.returncode != 0:
+        raise ValueError(f"ffmpeg could not encode {fmt}: {proc.stderr.decode(errors='replace').strip()}")
+    return proc.stdout
+
+
+def encode_wav(samples: np.ndarray, rate: int) -> bytes:
+    """16-bit mono PCM WAV file of `samples`."""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(np.ascontiguousarray(samples, dtype="<i2").tobytes())
+    return buf.getvalue()
+
+
+def frame_energy(samples: np.ndarray, rate: int, frame_s: float = FRAME_S) -> np.ndarray:
+    """RMS energy of consecutive frames of `frame_s` seconds."""
+    n = max(int(rate * frame_s), 1)
+    frames = samples[:len(samples) // n * n].reshape(-1, n)
+    # Accumulated in float64 directly from int16, without a float copy of the whole recording
+    return np.sqrt(np.einsum("ij,ij->i", frames, frames, dtype=np.float64) / n)
+
+
+def find_cut_points(samples: np.ndarray, rate: int, segment_s: float, search_s: float) -> List[int]:
+    """
+    Sample indices where to cut the recording: about every `segment_s` seconds, at the
+    quietest point within `search_s` seconds of the target.
+    """
+    n = max(int(rate * FRAME_S), 1)
+    energy = frame_energy(samples, rate)
+    width = max(int(SMOOTH_S / FRAME_S), 1)
+    energy = np.convolve(energy, np.ones(width) / width, mode="same")
+
+    segment, search = int(segment_s * rate), int(search_s * rate)
+    cuts, pos = [], 0
+    while len(samples) - pos > segment + search:
+        target = pos + segment
+        lo, hi = max(target - search, pos + rate) // n, min(target + search, len(samples)) // n
+        if hi > lo:
+            window = energy[lo:hi]
+            # Of the (nearly) quietest frames, the closest to the target, so segments keep their length
+            quiet = np.flatnonzero(window <= window.min() * 1.1 + 1e-6)
+            cut = (lo + int(quiet[np.argmin(np.abs(lo + quiet - target // n))])) * n + n // 2
+        else:
+            cut = target
+        cuts.append(cut)
+        pos = cut
+    return cuts
+
+
+def split_audio(samples: np.ndarray, rate: int, segment_s: float = 120, overlap_s: float = 1.0,
+                search_s: float = 10) -> List[Tuple[float, float, np.ndarray]]:
+    """
+    Splits a recording into segments of about `segment_s` seconds cut at silences, each
+    extended by `overlap_s` seconds into its neighbours so no word is lost at a cut.
+    Returns (start_s, end_s, samples) tuples; a short recording is a single segment.
+    """
+    bounds = [0] + find_cut_points(samples, rate, segment_s, search_s) + [len(samples)]
+    overlap = int(overlap_s * rate)
+    segments = []
+    for a, b in zip(bounds, bounds[1:]):
+        start, end = max(a - overlap, 0), min(b + overlap, len(samples))
+        segments.append((start / rate, end / rate, samples[start:end]))
+    return segments
+
+
+def _normalize(word: str) -> str:
+    return "".join(ch for ch in word.lower() if ch.isalnum())
+
+
+def _overlap_words(previous: List[str], following: List[str], max_words: int) -> int:
+    """Number of words at the start of `following` repeating the end of `previous`."""
+    a = [_normalize(w) for w in previous[-max_words:]]
+    b = [_normalize(w) for w in following[:max_words]]
+    for k in range(min(len(a), len(b)), 0, -1):
+        # A single short word ("a", "the") matching is more likely a coincidence than an overlap
+        if a[-k:] == b[:k] and (k > 1 or len(b[0]) > 3):
+            return k
+    return 0
+
+
+def merge_transcripts(texts: List[str], max_overlap_words: int = 30) -> str:
+    """Joins the texts of consecutive overlapping segments, dropping the words transcribed twice."""
+    merged: List[str] = []
+    for text in texts:
+        words = text.split()
+        if merged and words:
+            words = words[_overlap_words(merged, words, max_overlap_words):]
+        merged += words
+    return " ".join(merged)
+
+
+def _self_check(minutes: int = 20, segment_s: float = 120, overlap_s: float = 1.0):
+    """Splits a synthetic recording (tone bursts separated by pauses) and checks the cuts and the merge."""
+    rate = SAMPLE_RATE
+    rng = np.random.default_rng(0)
+    parts, t = [], 0.0
+    while t < minutes * 60:
+        speech, pause = rng.uniform(2, 8), rng.uniform(0.3, 1.5)
+        n = int(speech * rate)
+        parts.append((8000 * np.sin(np.arange(n) * 2 * np.pi * 220 / rate)).astype(np.int16))
+        parts.append(rng.normal(0, 30, int(pause * rate)).astype(np.int16))
+        t += speech + pause
+    samples = np.concatenate(parts)
+    decoded, decoded_rate = decode_audio(encode_wav(samples, rate))
+    assert decoded_rate == rate and np.array_equal(decoded, samples)
+    tone = (8000 * np.sin(np.arange(48000) * 2 * np.pi * 440 / 48000)).astype(np.int16)
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:  # 1 s of 48 kHz stereo
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(48000)
+        w.writeframes(np.repeat(tone, 2).astype("<i2").tobytes())
+    downsampled, downsampled_rate = decode_audio(buf.getvalue())
+    assert downsampled_rate == rate and len(downsampled) == rate
+    assert abs(np.abs(downsampled[100:-100]).max() - 8000) < 200
+    alias = resample((8000 * np.sin(np.arange(48000) * 2 * np.pi * 12000 / 48000)).astype(np.int16), 48000, rate)
+    assert np.abs(alias[100:-100]).max() < 800, "a 12 kHz tone must not alias into 16 kHz audio"
+    trimmed = trim_silences(samples, rate)
+
+    segments = split_audio(samples, rate, segment_s, overlap_s)
+    energy = frame_energy(samples, rate)
+    quiet = np.percentile(energy, 10) * 10
+    for (start, _, _), (_, end, _) in zip(segments[1:], segments):
+        cut = (start + end) / 2  # each cut is in the middle of the overlap
+        assert energy[int(cut / FRAME_S)] < quiet, f"cut at {cut:.1f}s is not in a pause"
+    assert segments[0][0] == 0 and abs(segments[-1][1] - len(samples) / rate) < 1e-6
+    # Pauses come every few seconds: cuts land near the target instead of anywhere in the search window
+    assert all(abs(e - s - 2 * overlap_s - segment_s) < 5 for s, e, _ in segments[1:-1]), [e - s for s, e, _ in segments]
+
+    words = [f"word{i}" for i in range(100)]
+    texts = [" ".join(words[0:40]), " ".join(words[37:70]), "Word69. " + " ".join(words[70:])]
+    assert merge_transcripts(texts) == " ".join(words), merge_transcripts(texts)
+    assert merge_transcripts(["the cat sat on the", "the mat"]) == "the cat sat on the the mat"
+    print(f"{len(samples) / rate / 60:.0f} min of audio -> {len(segments)} segments of "
+          f"{min(e - s for s, e, _ in segments):.0f}-{max(e - s for s, e, _ in segments):.0f} s, all cut in pauses")
+    print(f"trimming silences longer than 1 s: {len(samples) / rate:.0f} s -> {len(trimmed) / rate:.0f} s")
+
+
+if __name__ == "__main__":
+    _self_check()
@@ -0,0 +1,219 @@
+# chat_stream.py
+"""
+UI-free helpers for the OpenAI-compatible streaming chat API served by vLLM:
+request headers/payload, and a byte-level Server-Sent Events (SSE) parser that
+turns the raw response body into typed chat deltas.
+
+Run `python chat_stream.py` for a micro-benchmark against the previous
+`iter_lines()` + `json.loads` loop. On 100k events, the parser is about 1.1-1.3x
+as fast as that loop with orjson installed, and about 25% slower without it.
+"""
+import json
+from typing import Iterable, Iterator, List, NamedTuple, Optional
+
+# Use a faster JSON decoder when one is installed (`pip install orjson`).
+try:
+    import orjson
+    json_loads = orjson.loads
+    HAS_ORJSON = True
+except Exception:
+    json_loads = json.loads
+    HAS_ORJSON = False
+
+
+def build_headers(api_key: str, header_mode: str):
+    """
+    Builds authentication headers.
+    - header_mode: "X-API-Key" or "Authorization: Bearer"
+    """
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        if header_mode == "X-API-Key":
+            headers["X-API-Key"] = api_key
+        else:
+            headers["Authorization"] = f"Bearer {api_key}"
+    return headers
+
+
+def build_chat_payload(model: str, messages: list, temperature: float, max_tokens: int) -> dict:
+    """Streaming chat/completions request body; the final chunk reports the token usage."""
+    return {
+        "model": model,
+        "messages": messages,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }
+
+
+class SSEEvent(NamedTuple):
+    event: str  # "message" unless an "event:" field was sent
+    data: str   # the "data:" lines of the event, joined with "\n"
+    id: Optional[str]
+
+
+class SSEParser:
+    """
+    Incremental SSE parser working on raw bytes, as specified by the HTML standard:
+    events end with a blank line, lines can end with LF, CRLF or CR, lines starting
+    with ":" are comments, and several "data:" lines form one multi-line payload.
+    """
+
+    def __init__(self):
+        self._buf = b""           # beginning of the next, still incomplete, event
+        self._id = None
+        self._pending_cr = False  # a chunk ended with CR, the next one may start with its LF
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """Consumes a chunk of the body and returns the events it completes."""
+        if self._pending_cr and chunk.startswith(b"\n"):
+            chunk = chunk[1:]
+        self._pending_cr = chunk.endswith(b"\r")
+        if b"\r" in chunk:
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        buf = self._buf + chunk if self._buf else chunk
+        blocks = buf.split(b"\n\n")
+        self._buf = blocks.pop()
+
+        events: List[SSEEvent] = []
+        for block in blocks:
+            try:
+                if block.startswith(b"data: ") and b"\n" not in block:
+                    # Fast path: the single "data:" line of an OpenAI-style stream
+                    events.append(SSEEvent("message", block[6:].decode("utf-8"), self._id))
+                elif block:
+                    self._parse_block(block, events)
+            except UnicodeDecodeError:
+                continue  # malformed event: skipped, like an invalid JSON payload
+        return events
+
+    def _parse_block(self, block: bytes, events: List[SSEEvent]):
+        data: List[bytes] = []
+        event = b""
+        for line in block.split(b"\n"):
+            if not line or line[0] == 0x3A:  # ":" comment / keep-alive
+                continue
+            field, sep, value = line.partition(b":")
+            if sep and value[:1] == b" ":
+                value = value[1:]
+            if field == b"data":
+                data.append(value)
+            elif field == b"event":
+                event = value
+            elif field == b"id":
+                self._id = value.decode("utf-8")
+        if data:
+            events.append(SSEEvent((event or b"message").decode("utf-8"), b"\n".join(data).decode("utf-8"), self._id))
+
+
+class ChatDelta(NamedTuple):
+    content: str = ""
+    finish_reason: Optional[str] = None
+    usage: Optional[dict] = None  # {"prompt_tokens", "completion_tokens", "total_tokens"}
+    done: bool = False            # the "[DONE]" sentinel
+
+
+class ChatStreamError(RuntimeError):
+    """An error event sent by the server instead of a chunk, e.g. after a failure mid-generation."""
+
+
+def parse_chat_event(data: str) -> Optional[ChatDelta]:
+    """
+    Decodes the data of one SSE event of the stream; returns None for malformed events.
+    Raises ChatStreamError for an error event ({"error": {"message": ...}} or {"object": "error", ...}).
+    """
+    if data == "[DONE]":
+        return ChatDelta(done=True)
+    try:
+        payload = json_loads(data)
+    except ValueError:
+        return None
+    if not isinstance(payload, dict):
+        return None  # valid JSON, but not a chunk (e.g. "null" or "[]")
+    if "error" in payload or payload.get("object") == "error":
+        error = payload.get("error", payload)
+        raise ChatStreamError(str(error.get("message") or error) if isinstance(error, dict) else str(error))
+    choices = payload.get("choices") or [{}]
+    choice = choices[0] if isinstance(choices, list) else None
+    if not isinstance(choice, dict):
+        return None
+    delta = choice.get("delta")
+    content = delta.get("content") if isinstance(delta, dict) else None
+    usage = payload.get("usage")
+    return ChatDelta(content if isinstance(content, str) else "", choice.get("finish_reason"),
+                     usage if isinstance(usage, dict) else None)
+
+
+def iter_chat_deltas(chunks: Iterable[bytes]) -> Iterator[ChatDelta]:
+    """
+    Parses the raw body of a streaming chat/completions response into ChatDelta items.
+    Malformed events are skipped, iteration stops after "[DONE]", and an error event raises
+    ChatStreamError.
+    """
+    parser = SSEParser()
+    for chunk in chunks:
+        for event in parser.feed(chunk):
+            delta = parse_chat_event(event.data)
+            if delta is None:
+                continue
+            yield delta
+            if delta.done:
+                return
+
+
+def _benchmark(n_events: int = 100000, chunk_size: int = 1024):
+    """Compares iter_chat_deltas with the previous line-based loop on a synthetic stream."""
+    import codecs
+    import timeit
+
+    event = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "model": "m",
+             "choices": [{"index": 0, "delta": {"content": "token "}, "finish_reason": None}]}
+    body = b"".join(b"data: " + json.dumps(event).encode() + b"\n\n" for _ in range(n_events)) + b"data: [DONE]\n\n"
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+    def iter_lines(chunks):
+        # requests.Response.iter_lines(decode_unicode=True), as used by the previous loop
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        pending = None
+        for chunk in chunks:
+            chunk = decoder.decode(chunk)
+            if pending is not None:
+                chunk = pending + chunk
+            lines = chunk.splitlines()
+            pending = lines.pop() if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1] else None
+            yield from lines
+        if pending is not None:
+            yield pending
+
+    def legacy():
+        text = []
+        for raw in iter_lines(chunks):
+            if not raw:
+                continue
+            if raw.startswith("data:"):
+                data = raw[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    event = json.loads(data)
+                except json.JSONDecodeError:
+                    continue
+                try:
+                    text.append(event["choices"][0]["delta"].get("content", ""))
+                except Exception:
+                    pass
+        return "".join(text)
+
+    def new():
+        return "".join(d.content for d in iter_chat_deltas(chunks))
+
+    assert legacy() == new()
+    decoder = "orjson" if HAS_ORJSON else "json"
+    for name, fn in (("line loop + json", legacy), (f"SSEParser + {decoder}", new)):
+        seconds = min(timeit.repeat(fn, number=1, repeat=3))
+        print(f"{name:>22}: {n_events} events in {seconds * 1000:7.1f} ms ({n_events / seconds:>10,.0f} events/s)")
+
+
+if __name__ == "__main__":
+    _benchmark()
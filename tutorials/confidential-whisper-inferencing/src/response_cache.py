@@ -0,0 +1,65 @@
+# response_cache.py
+"""
+Exact-match LRU/TTL cache of chat answers, so re-asking an identical question
+replays the previous answer instead of running a new generation on the GPU.
+
+Keys are a hash of everything that determines the answer: model, messages,
+temperature and max_tokens. Only deterministic requests (temperature 0) should
+be cached, unless the user accepts replays of sampled answers.
+"""
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class ResponseCache:
+    """
+    Bounded cache of (visible, think) answers, evicting the least recently used entry
+    and expiring entries after ttl_seconds. Keep one instance per user session: answers
+    are confidential and must not be replayed to other users of the app.
+    """
+
+    def __init__(self, max_entries: int = 128, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(model: str, messages: list, temperature: float, max_tokens: int) -> str:
+        request = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """Returns (visible, think) for a fresh entry, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key: str, visible: str, think: str):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), visible, think)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
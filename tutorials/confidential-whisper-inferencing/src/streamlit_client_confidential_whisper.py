@@ -1,16 +1,52 @@
 # streamlit_client.py
 import os
+import io
+import csv
 import json
+import time
+import queue
+import socket
+import importlib.util
+import logging
+import statistics
 import tempfile
 import asyncio
+import threading
+import concurrent.futures
 import requests
 import streamlit as st
+from streamlit.runtime.scriptrunner import RerunException, StopException
 from html import escape
+from typing import Optional
+from contextlib import asynccontextmanager, contextmanager
+from requests.adapters import HTTPAdapter
+from think_parser import ThinkTagParser, THINK_DELTA, VISIBLE_DELTA
+from chat_stream import ChatStreamError, build_headers, build_chat_payload, iter_chat_deltas
+from chat_context import ContextWindow, estimate_tokens, format_for_summary, load_token_counter
+from response_cache import ResponseCache
+from turn_store import Turn, TurnStore
+from audio_chunks import FORMATS, decode_audio, encode_audio, has_ffmpeg, merge_transcripts, split_audio, trim_silences
 
 # =========================
 # ⚙️ Page Configuration
 # =========================
 st.set_page_config(page_title="LLM Client (Confidential GPU)", layout="wide")
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# httpx is optional: it is only needed for HTTP/2 connections to the LLM endpoint.
+try:
+    import httpx
+    HAS_HTTPX = True
+except Exception:
+    HAS_HTTPX = False
+
+# httpx.Client(http2=True) raises ImportError without the h2 package (httpx[http2] extra)
+HAS_HTTP2 = HAS_HTTPX and importlib.util.find_spec("h2") is not None
+
+HTTP_ERRORS = (requests.exceptions.RequestException,) + ((httpx.HTTPError,) if HAS_HTTPX else ())
+# Raised by Streamlit in the script thread to stop or rerun it (stop button or any other interaction)
+STREAMLIT_INTERRUPTS = (StopException, RerunException)
+STREAM_POLL_S = 0.2  # while no token arrives, how often a run checks for a stop (see stream_chat_completions)
 
 # Try to import pyohttp (attested OHTTP client). If missing, we'll show a warning near the audio section.
 try:
@@ -71,117 +107,231 @@ st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 # =========================
 # Session state
 # =========================
-if "messages" not in st.session_state:
-    # Message history sent to model (without <think>)
-    st.session_state.messages = []
+if "history" not in st.session_state:
+    # Every turn, stored once (see turn_store.py): the UI shows content, reasoning and metrics,
+    # history.messages is what is sent to the model (without <think>)
+    st.session_state.history = TurnStore()
 
-if "turns" not in st.session_state:
-    # Rich history for display: also memorize 'think' of each response
-    # Each item: {"role": "user|assistant|system", "content": "...", "think": "...(optional)"}
-    st.session_state.turns = []
+if "latency_log" not in st.session_state:
+    # Metrics of every answered turn of the session (see format_metrics)
+    st.session_state.latency_log = []
+
+if "response_cache" not in st.session_state:
+    # Per session: cached answers are never replayed to other users of the app
+    st.session_state.response_cache = ResponseCache()
+
+if "context" not in st.session_state:
+    # Selects the part of the history sent to the model (see chat_context.py)
+    st.session_state.context = ContextWindow(budget_tokens=8192)
+
+if "batch_results" not in st.session_state:
+    # Results of the last batch transcription (see run_batch)
+    st.session_state.batch_results = []
 
 # =========================
 # Utilities (LLM call)
 # =========================
-def build_headers(api_key: str, header_mode: str):
+@st.cache_resource(show_spinner=False)
+def get_http_client(use_http2: bool = False, pool_size: int = 10, verify_ssl: bool = True):
     """
-    Builds authentication headers.
-    - header_mode: "X-API-Key" or "Authorization: Bearer"
+    Returns a pooled HTTP client shared by every session and rerun of the app (one per
+    configuration), so chat turns reuse keep-alive TCP/TLS connections to the front end
+    instead of paying a new handshake each time.
+    - use_http2: multiplex the requests over one HTTP/2 connection (requires `pip install httpx[http2]`)
+    - pool_size: maximum number of pooled connections
     """
-    headers = {"Content-Type": "application/json"}
-    if api_key:
-        if header_mode == "X-API-Key":
-            headers["X-API-Key"] = api_key
-        else:
-            headers["Authorization"] = f"Bearer {api_key}"
-    return headers
+    if use_http2 and HAS_HTTP2:
+        return httpx.Client(
+            http2=True,
+            verify=verify_ssl,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(180, connect=10),
+        )
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.verify = verify_ssl
+    return session
 
 
-def parse_and_stream_tokens(
-    incoming_text: str,
-    state: dict,
-    think_placeholder,
-    chat_placeholder,
-    thinking_spinner=None,
-):
+@contextmanager
+def open_event_stream(client, url: str, headers: dict, payload: dict, on_response=None):
     """
-    Incremental parsing to support <think> ... </think> tags potentially fragmented between chunks.
+    POSTs a streaming request with the pooled client and yields an iterator over the raw body
+    chunks, as they arrive, for the SSE parser of chat_stream.py.
+    on_response(resp) is called as soon as the response headers are received (status checked).
     """
-    TAG_OPEN = "<think>"
-    TAG_CLOSE = "</think>"
-    MAX_TAG_LEN = max(len(TAG_OPEN), len(TAG_CLOSE))
+    if HAS_HTTPX and isinstance(client, httpx.Client):
+        stream = client.stream("POST", url, headers=headers, json=payload)
+    else:
+        stream = client.post(url, headers=headers, json=payload, stream=True, timeout=(10, 180))
 
-    print(incoming_text, flush=True, end="")
-    state["pending"] += incoming_text
+    # Leaving the block early (stop button, rerun, closed page) closes the connection instead of
+    # returning it to the pool: Caddy then cancels the upstream request and vLLM aborts the generation.
+    with stream as resp:
+        resp.raise_for_status()
+        if on_response:
+            on_response(resp)
+        chunks = resp.iter_bytes() if HAS_HTTPX and isinstance(resp, httpx.Response) else resp.iter_content(chunk_size=None)
+        yield chunks
+        # Read the end of the body (after [DONE]) so the connection goes back to the pool
+        for _ in chunks:
+            pass
 
-    def flush_outside_text(text):
-        if text:
-            state["visible_text"] += text
-            chat_placeholder.markdown(state["visible_text"])
 
-    def flush_thinking_text(text):
-        if text:
-            if not state["thinking_active"] and thinking_spinner:
-                thinking_spinner.markdown("🤔 *Thinking...*")
-                state["thinking_active"] = True
-            state["think_text"] += text
-            think_placeholder.markdown(
-                f"<div class='thinking'>{escape(state['think_text'])}</div>",
-                unsafe_allow_html=True
-            )
+class _StreamStopped(Exception):
+    """Raised inside open_event_stream to close the connection, so the server aborts the generation."""
 
-    while True:
-        if state["in_think"]:
-            idx_close = state["pending"].find(TAG_CLOSE)
-            if idx_close == -1:
-                if len(state["pending"]) > (MAX_TAG_LEN - 1):
-                    consume = len(state["pending"]) - (MAX_TAG_LEN - 1)
-                    chunk, state["pending"] = state["pending"][:consume], state["pending"][consume:]
-                    flush_thinking_text(chunk)
-                break
-            else:
-                before_close = state["pending"][:idx_close]
-                flush_thinking_text(before_close)
-                state["pending"] = state["pending"][idx_close + len(TAG_CLOSE):]
-                state["in_think"] = False
+
+def abort_stream(resp):
+    """
+    Aborts a streaming response read by another thread. Closing the response does not wake up
+    a read blocked on the socket (e.g. during the prefill), shutting the socket down does.
+    An HTTP/2 connection is shared by other requests: only the stream is closed.
+    """
+    try:
+        if HAS_HTTPX and isinstance(resp, httpx.Response):
+            sock = None if resp.http_version == "HTTP/2" else resp.extensions["network_stream"].get_extra_info("socket")
         else:
-            idx_open = state["pending"].find(TAG_OPEN)
-            if idx_open == -1:
-                if len(state["pending"]) > (MAX_TAG_LEN - 1):
-                    consume = len(state["pending"]) - (MAX_TAG_LEN - 1)
-                    chunk, state["pending"] = state["pending"][:consume], state["pending"][consume:]
-                    flush_outside_text(chunk)
-                break
-            else:
-                before_open = state["pending"][:idx_open]
-                flush_outside_text(before_open)
-                state["pending"] = state["pending"][idx_open + len(TAG_OPEN):]
-                state["in_think"] = True
+            sock = resp.raw._connection.sock
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+        resp.close()
+    except Exception:
+        pass  # already closed, or ended meanwhile
 
 
-def finalize_pending(state: dict, think_placeholder, chat_placeholder, thinking_spinner=None):
+BLOCK_CHARS = 1000  # an open block longer than this is closed at its last paragraph break
+
+
+def completed_length(text: str, min_chars: int = BLOCK_CHARS) -> int:
     """
-    At the end of the stream, push the rest of 'pending' to the right place.
+    Length of the beginning of `text` made of finished paragraphs: up to its last blank line
+    outside a ``` code block and followed by an unindented line, or 0 while the text is
+    shorter than min_chars. (Streamlit dedents each element, which would change indented blocks.)
     """
-    if state["pending"]:
-        if state["in_think"]:
+    if len(text) < min_chars:
+        return 0
+    cut = len(text)
+    while True:
+        cut = text.rfind("\n\n", 0, cut)
+        if cut <= 0:
+            return 0
+        if text.count("```", 0, cut) % 2:
+            cut = text.rfind("```", 0, cut)  # inside a code block: look before the fence that opens it
+        elif text[cut + 2:cut + 3] not in ("", " ", "\t", "\n"):
+            return cut + 2
+
+
+def draw_markdown(slot, text: str):
+    slot.markdown(text)
+
+
+def draw_thinking(slot, text: str):
+    slot.markdown(f"<div class='thinking'>{escape(text)}</div>", unsafe_allow_html=True)
+
+
+def draw_blocks(container, blocks: dict, text: str, draw):
+    """
+    Draws `text` in `container` as a sequence of elements: finished blocks (see completed_length)
+    are drawn once in their own element, and only the open block at the end is redrawn on each
+    call. blocks holds the drawing state: {"done": characters drawn in finished blocks, "tail": open element}.
+    """
+    if blocks["tail"] is None:
+        blocks["tail"] = container.empty()
+    tail = text[blocks["done"]:]
+    cut = completed_length(tail)
+    if cut:
+        draw(blocks["tail"], tail[:cut])
+        blocks["tail"] = container.empty()
+        blocks["done"] += cut
+        tail = tail[cut:]
+    draw(blocks["tail"], tail)
+
+
+def render_pending(state: dict, think_placeholder, chat_placeholder, force: bool = False):
+    """
+    Pushes the accumulated text to the placeholders (containers), at most once every
+    state["render_interval"] seconds unless 'force' is set (tag boundaries, end of stream).
+    Only the open block at the end of each text is redrawn (see draw_blocks), so a flush sends
+    a bounded amount of text and the websocket traffic stays linear in the output length,
+    except inside a code block longer than BLOCK_CHARS, which is redrawn whole until it ends.
+    """
+    now = time.monotonic()
+    if not force and now - state["last_render"] < state["render_interval"]:
+        return
+    if state["visible_dirty"]:
+        draw_blocks(chat_placeholder, state["visible_blocks"], state["parser"].visible_text, draw_markdown)
+        state["visible_dirty"] = False
+    if state["think_dirty"]:
+        draw_blocks(think_placeholder, state["think_blocks"], state["parser"].think_text, draw_thinking)
+        state["think_dirty"] = False
+    if state.get("turn") is not None:
+        # Also seen by a run started before this one ends (Streamlit's fast reruns)
+        state["turn"].content, state["turn"].think = state["parser"].visible_text, state["parser"].think_text
+    state["last_render"] = now
+
+
+def apply_parse_events(events: list, state: dict, think_placeholder, chat_placeholder, thinking_spinner=None, force: bool = False):
+    """
+    Applies the events of the <think> parser to the UI state.
+    Tag boundaries force a render so that the switch between reasoning and answer shows at once.
+    """
+    for event in events:
+        if event.kind == THINK_DELTA:
+            if state["first_think"] is None:
+                state["first_think"] = time.perf_counter()
             if not state["thinking_active"] and thinking_spinner:
                 thinking_spinner.markdown("🤔 *Thinking...*")
                 state["thinking_active"] = True
-            state["think_text"] += state["pending"]
-            think_placeholder.markdown(
-                f"<div class='thinking'>{escape(state['think_text'])}</div>",
-                unsafe_allow_html=True
-            )
+            state["think_dirty"] = True
+        elif event.kind == VISIBLE_DELTA:
+            if state["first_visible"] is None:
+                state["first_visible"] = time.perf_counter()
+            state["visible_dirty"] = True
         else:
-            state["visible_text"] += state["pending"]
-            chat_placeholder.markdown(state["visible_text"])
-        state["pending"] = ""
+            force = True
+    render_pending(state, think_placeholder, chat_placeholder, force=force)
+
+
+def parse_and_stream_tokens(
+    incoming_text: str,
+    state: dict,
+    think_placeholder,
+    chat_placeholder,
+    thinking_spinner=None,
+):
+    """
+    Incremental parsing of <think> ... </think> tags potentially fragmented between chunks
+    (see think_parser.ThinkTagParser), then coalesced rendering of:
+      - the 'thinking' placeholder (gray) for reasoning text
+      - the 'chat' placeholder (normal) otherwise
+    """
+    events = state["parser"].feed(incoming_text)
+    apply_parse_events(events, state, think_placeholder, chat_placeholder, thinking_spinner)
+
+
+def finalize_pending(state: dict, think_placeholder, chat_placeholder, thinking_spinner=None):
+    """
+    At the end of the stream, push the rest of the parser's buffer to the right place.
+    """
+    events = state["parser"].finish()
+    apply_parse_events(events, state, think_placeholder, chat_placeholder, thinking_spinner, force=True)
 
+    # Clear the thinking spinner when done
     if state["thinking_active"] and thinking_spinner:
         thinking_spinner.empty()
 
 
+def end_turn(turn: Turn, visible: str, think: str, metrics: Optional[dict]):
+    """Sets the final state of an answer streamed into `turn`: out of the context if it has no text."""
+    turn.content, turn.think, turn.metrics = visible, think, metrics
+    turn.in_context = bool(visible or think)
+    if turn.in_context:
+        st.session_state.latency_log.append(metrics)
+
+
 def stream_chat_completions(
     server_url: str,
     api_key: str,
@@ -191,19 +341,21 @@ def stream_chat_completions(
     temperature: float = 0.2,
     max_tokens: int = 2048,
     verify_ssl: bool = True,
+    render_interval_ms: int = 50,
+    http_client=None,
+    response_cache=None,
+    turn: Optional[Turn] = None,
 ):
     """
     Sends a chat/completions request in streaming mode (OpenAI-like format).
-    Returns (assistant_visible_text, assistant_think_text).
+    The answer is written in place into `turn`, an assistant turn of the history added before
+    the call: its content and reasoning follow the stream, then its metrics are set when it ends
+    or is stopped. On error, the turn is emptied and left out of the model's context.
+    Returns the metrics, None on error.
+    With a ResponseCache, an identical earlier request is replayed from it instead of being sent.
     """
     headers = build_headers(api_key, header_mode)
-    payload = {
-        "model": model,
-        "messages": messages,
-        "stream": True,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-    }
+    payload = build_chat_payload(model, messages, temperature, max_tokens)
 
     assistant_container = st.chat_message("assistant")
     top_line = assistant_container.empty()  # status area "streaming..."
@@ -211,65 +363,313 @@ def stream_chat_completions(
         exp = st.expander("🧠 View reasoning (stream)", expanded=False)
         with exp:
             thinking_spinner = st.empty()
-            think_placeholder = st.empty()
-        chat_placeholder = st.empty()
+            think_placeholder = st.container()
+        chat_placeholder = st.container()
+        # Any click reruns the app: Streamlit interrupts this run, which closes the stream (see below)
+        stop_slot = st.empty()
+        stop_slot.button("⏹️ Stop generating", key="stop_generation")
 
     top_line.markdown("<span class='streaming-dot'></span>Streaming in progress…", unsafe_allow_html=True)
 
     parse_state = {
-        "pending": "",
-        "in_think": False,
-        "think_text": "",
-        "visible_text": "",
+        "parser": ThinkTagParser(),
         "thinking_active": False,
+        # Render scheduling (see render_pending)
+        "think_blocks": {"done": 0, "tail": None},
+        "visible_blocks": {"done": 0, "tail": None},
+        "visible_dirty": False,
+        "think_dirty": False,
+        "last_render": 0.0,
+        "render_interval": render_interval_ms / 1000,
+        # Timings (see format_metrics)
+        "first_think": None,
+        "first_visible": None,
+        # The history shows the answer so far (see render_pending)
+        "turn": turn if turn is not None else Turn("assistant", ""),
     }
+    turn = parse_state["turn"]
+
+    started_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    start = time.perf_counter()
+    headers_at = None
+    cache_key = ResponseCache.make_key(model, messages, temperature, max_tokens) if response_cache is not None else None
+    cached = response_cache.get(cache_key) if cache_key else None
+
+    finish_reason, usage, n_deltas = None, None, 0
+    completed = False
+    # The stream is read by a worker thread (see read_stream) and applied here, in the script thread
+    deltas = queue.Queue()
+    stop = threading.Event()
+    stream = {"response": None}
+    reader = None
+
+    def turn_metrics(finish: str) -> dict:
+        """Timings and token counts of the turn so far (see format_metrics)."""
+        end = time.perf_counter()
+        firsts = [t for t in (parse_state["first_think"], parse_state["first_visible"]) if t is not None]
+        completion_tokens = (usage or {}).get("completion_tokens") or n_deltas
+
+        def since(t):
+            return t - start if t is not None else None
+
+        return {
+            "time": started_at,
+            "model": model,
+            "cached": cached is not None,
+            "headers_s": since(headers_at),
+            "first_think_s": since(parse_state["first_think"]),
+            "first_visible_s": since(parse_state["first_visible"]),
+            "first_token_s": since(min(firsts)) if firsts else None,
+            "total_s": end - start,
+            "prompt_tokens": (usage or {}).get("prompt_tokens"),
+            "completion_tokens": completion_tokens,
+            # Decode speed, after the first token
+            "tokens_per_s": (completion_tokens - 1) / (end - min(firsts)) if firsts and completion_tokens > 1 and end > min(firsts) else None,
+            "finish_reason": finish,
+        }
 
     try:
-        with requests.post(
-            server_url,
-            headers=headers,
-            json=payload,
-            stream=True,
-            timeout=(10, 180),
-            verify=verify_ssl,
-        ) as resp:
-            resp.raise_for_status()
+        if cached is not None:
+            # Replay the cached answer through the same parser and placeholders
+            visible, think = cached
+            parse_and_stream_tokens(
+                f"<think>{think}</think>{visible}" if think else visible,
+                parse_state,
+                think_placeholder=think_placeholder,
+                chat_placeholder=chat_placeholder,
+                thinking_spinner=thinking_spinner,
+            )
+        else:
+            if http_client is None:
+                http_client = get_http_client(verify_ssl=verify_ssl)
+
+            def headers_received(resp):
+                nonlocal headers_at
+                headers_at = time.perf_counter()
+                stream["response"] = resp
+                if stop.is_set():
+                    raise _StreamStopped()
+
+            def read_stream():
+                # No Streamlit calls in this thread: it may outlive the run
+                try:
+                    with open_event_stream(http_client, server_url, headers, payload, headers_received) as chunks:
+                        for delta in iter_chat_deltas(chunks):
+                            if stop.is_set():
+                                raise _StreamStopped()
+                            deltas.put(delta)
+                except _StreamStopped:
+                    pass
+                except Exception as e:
+                    if not stop.is_set():
+                        deltas.put(e)
+                finally:
+                    deltas.put(None)
 
-            for raw in resp.iter_lines(decode_unicode=True):
-                if not raw:
+            reader = threading.Thread(target=read_stream, daemon=True)
+            reader.start()
+            while True:
+                try:
+                    delta = deltas.get(timeout=STREAM_POLL_S)
+                except queue.Empty:
+                    # Nothing received (queueing, prefill): this Streamlit call is where a stop or
+                    # a rerun interrupts the run, so they also take effect before the first token
+                    top_line.markdown(
+                        f"<span class='streaming-dot'></span>Streaming in progress… {time.perf_counter() - start:.0f} s",
+                        unsafe_allow_html=True,
+                    )
                     continue
-                if raw.startswith("data:"):
-                    data = raw[5:].strip()
-                    if data == "[DONE]":
-                        break
-                    try:
-                        event = json.loads(data)
-                    except json.JSONDecodeError:
-                        continue
-                    try:
-                        token = event["choices"][0]["delta"].get("content", "")
-                    except Exception:
-                        token = ""
-                    if token:
-                        parse_and_stream_tokens(
-                            token,
-                            parse_state,
-                            think_placeholder=think_placeholder,
-                            chat_placeholder=chat_placeholder,
-                            thinking_spinner=thinking_spinner,
-                        )
+                if delta is None:
+                    break
+                if isinstance(delta, Exception):
+                    raise delta
+                if delta.content:
+                    parse_and_stream_tokens(
+                        delta.content,
+                        parse_state,
+                        think_placeholder=think_placeholder,
+                        chat_placeholder=chat_placeholder,
+                        thinking_spinner=thinking_spinner,
+                    )
+                finish_reason = delta.finish_reason or finish_reason
+                usage = delta.usage or usage
+                n_deltas += bool(delta.content)
 
+        completed = True
+        stop_slot.empty()
         finalize_pending(parse_state, think_placeholder, chat_placeholder, thinking_spinner)
         top_line.empty()
-        return parse_state["visible_text"], parse_state["think_text"]
+        metrics = turn_metrics(finish_reason)
+        assistant_container.caption(format_metrics(metrics))
 
-    except requests.exceptions.RequestException as e:
+        visible, think = parse_state["parser"].visible_text, parse_state["parser"].think_text
+        if cache_key and cached is None and (visible or think):
+            response_cache.put(cache_key, visible, think)
+        end_turn(turn, visible, think, metrics)
+        return metrics
+
+    except HTTP_ERRORS + (ChatStreamError,) as e:
+        completed = True
+        stop_slot.empty()
         top_line.empty()
         if thinking_spinner:
             thinking_spinner.empty()
-        st.error(f"Server connection error: {e}")
-        st.info("Check the URL, API Key, that the service is running, and network rules.")
-        return "", ""
+        if isinstance(e, ChatStreamError):
+            st.error(f"The server stopped the answer with an error: {e}")
+        else:
+            st.error(f"Server connection error: {e}")
+            st.info("Check the URL, API Key, that the service is running, and network rules.")
+        end_turn(turn, "", "", None)
+        return None
+    except STREAMLIT_INTERRUPTS:
+        if not completed:
+            # Interrupted by Streamlit while streaming (stop button or any other interaction):
+            # the turn keeps the partial answer, marked as stopped (no UI call is allowed here)
+            parser = parse_state["parser"]
+            parser.finish()
+            end_turn(turn, parser.visible_text, parser.think_text, turn_metrics("stopped"))
+        raise
+    except Exception:
+        # Any other error is reported by Streamlit; as after a connection error, the question
+        # is left out of the model's context
+        end_turn(turn, "", "", None)
+        st.session_state.history.drop_unanswered()
+        raise
+    finally:
+        if reader is not None and reader.is_alive():
+            # Stopped or failed before the end: close the connection, so the server aborts the generation
+            stop.set()
+            abort_stream(stream["response"])
+
+
+METRICS_FIELDS = ["time", "model", "cached", "headers_s", "first_think_s", "first_visible_s", "first_token_s",
+                  "total_s", "prompt_tokens", "completion_tokens", "tokens_per_s", "finish_reason"]
+
+
+def format_metrics(m: dict) -> str:
+    """One-line summary of a turn's metrics, shown under the answer."""
+    def ms(seconds):
+        return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.1f} s"
+    if m["cached"]:
+        parts = ["♻️ replayed from the response cache"]
+    else:
+        parts = []
+        if m["headers_s"] is not None:
+            parts.append(f"headers {ms(m['headers_s'])}")
+        if m["first_think_s"] is not None:
+            parts.append(f"first thought {ms(m['first_think_s'])}")
+        if m["first_visible_s"] is not None:
+            parts.append(f"first answer token {ms(m['first_visible_s'])}")
+        parts.append(f"total {ms(m['total_s'])}")
+        if m["prompt_tokens"] is not None:
+            parts.append(f"{m['prompt_tokens']} prompt tokens")
+        parts.append(f"{m['completion_tokens']} completion tokens")
+        if m["tokens_per_s"]:
+            parts.append(f"{m['tokens_per_s']:.1f} tok/s")
+    line = "⏱️ " + " · ".join(parts)
+    if m["finish_reason"] == "length":
+        line += " — ⚠️ answer cut at the max response tokens limit"
+    elif m["finish_reason"] == "stopped":
+        line += " — ⏹️ stopped by the user, partial answer"
+    return line
+
+
+def percentiles(values: list) -> tuple:
+    """(p50, p95) of a non-empty list."""
+    if len(values) == 1:
+        return values[0], values[0]
+    q = statistics.quantiles(values, n=100, method="inclusive")
+    return q[49], q[94]
+
+
+def render_latency_summary(log: list):
+    """Session summary (p50/p95) of the generated turns, and CSV export of every turn."""
+    generated = [m for m in log if not m["cached"]]
+    if not log:
+        st.caption("No turns yet.")
+        return
+    rows = []
+    for label, key, fmt in (("Headers", "headers_s", "{:.2f} s"), ("First token", "first_token_s", "{:.2f} s"),
+                            ("Total", "total_s", "{:.1f} s"), ("Tokens/s", "tokens_per_s", "{:.1f}")):
+        values = [m[key] for m in generated if m[key] is not None]
+        if values:
+            p50, p95 = percentiles(values)
+            rows.append(f"| {label} | {fmt.format(p50)} | {fmt.format(p95)} |")
+    if rows:
+        st.markdown(f"{len(generated)} generated turns\n\n| | p50 | p95 |\n|---|---|---|\n" + "\n".join(rows))
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=METRICS_FIELDS)
+    writer.writeheader()
+    writer.writerows(log)
+    st.download_button("⬇️ Export CSV", buffer.getvalue(), file_name="chat_latency.csv", mime="text/csv")
+
+
+@st.cache_resource(show_spinner=False)
+def get_token_counter(tokenizer_name: str):
+    """Loads the token counter once per tokenizer (see chat_context.load_token_counter)."""
+    return load_token_counter(tokenizer_name)
+
+
+def chat_completion(server_url: str, api_key: str, header_mode: str, model: str, http_client, messages: list,
+                    temperature: float = 0.0, max_tokens: int = 1024) -> tuple:
+    """
+    Non-streaming chat completion; returns (the answer without the reasoning, finish_reason),
+    finish_reason being "length" when max_tokens cut the reply.
+    No Streamlit calls, so it can run in worker threads. Raises HTTP_ERRORS, KeyError, IndexError, ValueError.
+    """
+    payload = {
+        "model": model,
+        "messages": messages,
+        "stream": False,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }
+    resp = http_client.post(server_url, headers=build_headers(api_key, header_mode), json=payload, timeout=120)
+    resp.raise_for_status()
+    choice = resp.json()["choices"][0]
+    content = choice["message"]["content"] or ""
+    # Reasoning models think before answering: keep the answer only
+    parser = ThinkTagParser()
+    parser.feed(content)
+    parser.finish()
+    return parser.visible_text.strip(), choice.get("finish_reason")
+
+
+def complete_chat(server_url: str, api_key: str, header_mode: str, model: str, http_client, messages: list,
+                  temperature: float = 0.0, max_tokens: int = 1024) -> str:
+    """Non-streaming chat completion; returns the answer without the reasoning (see chat_completion)."""
+    return chat_completion(server_url, api_key, header_mode, model, http_client, messages, temperature, max_tokens)[0]
+
+
+def summarize_turns(server_url: str, api_key: str, header_mode: str, model: str, http_client,
+                    previous_summary: str, evicted: list) -> str:
+    """
+    Folds the turns that left the context window into the running summary, with a
+    non-streaming request to the same model. Keeps the previous summary on failure.
+    """
+    try:
+        with st.spinner("Summarizing earlier turns…"):
+            summary = complete_chat(server_url, api_key, header_mode, model, http_client,
+                                    format_for_summary(previous_summary, evicted))
+    except HTTP_ERRORS + (KeyError, IndexError, ValueError) as e:
+        st.warning(f"Could not summarize the earlier turns, they are left out: {e}")
+        return previous_summary
+    return summary or previous_summary
+
+
+def select_context(reserve_tokens: int, exact_counts: bool) -> list:
+    """
+    Returns the part of the history's messages that fits in the context budget, and
+    shows its size under the last user message (also stored in its turn for the history).
+    """
+    window = st.session_state.context
+    messages = window.build(st.session_state.history.messages, reserve_tokens=reserve_tokens)
+    note = f"📏 {'' if exact_counts else '≈'}{window.prompt_tokens} prompt tokens"
+    if window.dropped:
+        note += f" · {window.dropped} earlier messages {'summarized' if window.summary else 'left out'}"
+    st.caption(note)
+    st.session_state.history.last.context = note
+    return messages
 
 # =========================
 # OHTTP helper functions (from Microsoft sample, lightly wrapped)
@@ -289,71 +689,630 @@ def download_kms_certificate(kms_url: str, output_file: str):
         f.write(cert_pem)
 
 
-async def ohttp_infer_whisper(target_uri: str, api_key: str, audio_path: str, kms_url: str):
+KMS_CACHE_TTL_S = 3600  # the KMS certificate and OHTTP key configuration are refetched at least this often
+
+
+# Problem type of the 400 response of an OHTTP gateway to a request encapsulated with a key
+# configuration it no longer has, i.e. after a key rotation (RFC 9458, section 8.2).
+OHTTP_KEY_PROBLEM = "https://iana.org/assignments/http-problem-types#ohttp-key"
+
+
+class OhttpKeyError(RuntimeError):
+    """The OHTTP gateway rejected the request's key configuration (see OHTTP_KEY_PROBLEM)."""
+
+
+def is_ohttp_key_error(e: Exception) -> bool:
     """
-    Async call to Confidential Whisper via OHTTP (pyohttp).
-    Returns the raw response text (JSON string).
+    True if the gateway rejected the key configuration, not for network or service errors.
+    pyohttp raises plain exceptions, so its errors are recognized by the problem type of the
+    gateway's response in their message; read_ohttp_response raises OhttpKeyError for it.
     """
-    # Prepare per-run kms cert
-    with tempfile.NamedTemporaryFile(suffix=".pem", delete=False) as tf:
-        kms_cert_path = tf.name
-    try:
-        download_kms_certificate(kms_url, kms_cert_path)
-        client = pyohttp.OhttpClient(kms_url, kms_cert_path)
+    return isinstance(e, OhttpKeyError) or OHTTP_KEY_PROBLEM in str(e)
 
-        form_fields = {"file": "@" + audio_path, "response_format": "json"}
-        outer_headers = {"api-key": api_key}
 
-        response = await client.post(target_uri, form_fields=form_fields, outer_headers=outer_headers)
-        status = response.status()
-        chunks = []
+class OhttpClientCache:
+    """
+    Process-wide cache, per KMS URL, of the KMS service certificate and of the pyohttp.OhttpClient
+    built from it (which holds the OHTTP key configuration), so a transcription does not pay
+    these round trips before sending any audio.
+    Entries are rebuilt after ttl_seconds, or when a request fails with a stale key (rotation).
+    Clients are used through lease(): the certificate file of a replaced client is only
+    removed once the requests still using it are done.
+    """
+
+    def __init__(self, ttl_seconds: float = KMS_CACHE_TTL_S):
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}   # kms_url -> {"created", "client", "cert_path", "users"}
+        self._retired = []   # replaced entries still leased by requests
+        self._building = {}  # kms_url -> threading.Event set when its fetch ends
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _build(kms_url: str) -> dict:
+        with tempfile.NamedTemporaryFile(suffix=".pem", delete=False) as tf:
+            cert_path = tf.name
+        try:
+            download_kms_certificate(kms_url, cert_path)
+            client = pyohttp.OhttpClient(kms_url, cert_path)
+        except Exception:
+            os.remove(cert_path)
+            raise
+        return {"created": time.monotonic(), "client": client, "cert_path": cert_path, "users": 0}
+
+    @staticmethod
+    def _remove_cert(entry: dict):
+        try:
+            os.remove(entry["cert_path"])
+        except OSError:
+            pass
+
+    def acquire(self, kms_url: str, stale=None):
+        """
+        Returns the client for kms_url, (re)building it when missing, expired, or when it is
+        the `stale` client that just failed. Blocking; each call must be paired with release().
+        One fetch at a time per KMS URL: concurrent callers wait for it. The fetch runs outside
+        the lock, so it does not hold up release() or the other URLs.
+        """
         while True:
-            c = await response.chunk()
-            if c is None:
-                break
-            chunks.append(bytes(c))
-        body = b"".join(chunks).decode("utf-8", errors="replace")
+            with self._lock:
+                entry = self._entries.get(kms_url)
+                if entry is not None and entry["client"] is not stale and time.monotonic() - entry["created"] <= self.ttl_seconds:
+                    entry["users"] += 1
+                    return entry["client"]
+                building = self._building.get(kms_url)
+                if building is None:
+                    building = self._building[kms_url] = threading.Event()
+                    break
+            building.wait()  # then use the client it built, or try again if the fetch failed
+
+        try:
+            entry = self._build(kms_url)
+            entry["users"] = 1
+            with self._lock:
+                old = self._entries.get(kms_url)
+                if old is not None:
+                    if old["users"]:
+                        self._retired.append(old)
+                    else:
+                        self._remove_cert(old)
+                self._entries[kms_url] = entry
+            return entry["client"]
+        finally:
+            with self._lock:
+                del self._building[kms_url]
+            building.set()
+
+    def release(self, client):
+        """Ends a use of `client`; removes its certificate if it was replaced and is no longer used."""
+        with self._lock:
+            for entry in list(self._entries.values()) + self._retired:
+                if entry["client"] is client:
+                    entry["users"] -= 1
+                    if not entry["users"] and entry in self._retired:
+                        self._retired.remove(entry)
+                        self._remove_cert(entry)
+                    return
 
-        if status != 200:
-            raise RuntimeError(f"OHTTP Whisper failed: HTTP {status}\n{body}")
-        return body
+    @asynccontextmanager
+    async def lease(self, kms_url: str, stale=None):
+        """
+        The client for kms_url while the block runs. acquire() runs in a worker thread, so
+        the certificate download does not block the event loop.
+        """
+        client = await asyncio.to_thread(self.acquire, kms_url, stale)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+
+class OhttpEventLoop:
+    """
+    Long-lived asyncio event loop running in a daemon thread, which owns the OHTTP client cache.
+    Streamlit reruns submit coroutines to it instead of creating and closing a loop per call
+    with asyncio.run, so the clients (and the async state they keep) stay bound to one loop,
+    several requests can be in flight at once, and each can be cancelled.
+    """
+
+    def __init__(self):
+        self.client_cache = OhttpClientCache()
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="ohttp-event-loop", daemon=True)
+        self._thread.start()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        """Number of submitted coroutines not finished yet."""
+        return len(self._in_flight)
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """
+        Schedules `coro` on the loop and returns a concurrent.futures.Future for its result;
+        future.cancel() cancels the coroutine.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        with self._lock:
+            self._in_flight.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: concurrent.futures.Future):
+        with self._lock:
+            self._in_flight.discard(future)
+
+    def run(self, coro, on_wait=None, poll_s: float = 0.25):
+        """
+        Runs `coro` on the loop and waits for its result, calling on_wait() every poll_s seconds
+        meanwhile: in a Streamlit run, a UI call there is where a stop or a rerun interrupts the
+        wait, which would otherwise block until the request ends. The coroutine is then cancelled.
+        """
+        future = self.submit(coro)
+        try:
+            while not future.done():
+                concurrent.futures.wait([future], timeout=poll_s)
+                if on_wait is not None and not future.done():
+                    on_wait()
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+
+@st.cache_resource(show_spinner=False)
+def get_ohttp_event_loop() -> OhttpEventLoop:
+    """One OhttpEventLoop (and OHTTP client cache) shared by every session and rerun of the app."""
+    return OhttpEventLoop()
+
+
+# pyohttp reads the audio of a request from a file path ("@path" form field), not from memory. The
+# file is written to a RAM-backed tmpfs, so plaintext audio never reaches a persistent disk.
+AUDIO_TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+# Without tmpfs, audio is only written to the (usually persistent) system temporary directory
+# if this is explicitly allowed with AUDIO_DISK_FALLBACK=1.
+AUDIO_DISK_FALLBACK = os.environ.get("AUDIO_DISK_FALLBACK", "0") == "1"
+CAN_STAGE_AUDIO = AUDIO_TMP_DIR is not None or AUDIO_DISK_FALLBACK
+
+
+@contextmanager
+def audio_upload_path(data, suffix: str):
+    """
+    Writes the in-memory audio `data` (bytes or memoryview, not copied) to a private file on
+    tmpfs and yields its path for pyohttp; the file is removed on exit.
+    Without a writable tmpfs, raises RuntimeError unless AUDIO_DISK_FALLBACK allows the default
+    temporary directory.
+    """
+    if not CAN_STAGE_AUDIO:
+        raise RuntimeError("No tmpfs at /dev/shm to stage the audio for pyohttp. Set AUDIO_DISK_FALLBACK=1 "
+                           f"to allow writing it to {tempfile.gettempdir()} instead.")
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=AUDIO_TMP_DIR)  # mode 0600
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        yield path
     finally:
         try:
-            os.remove(kms_cert_path)
-        except Exception:
+            os.remove(path)
+        except OSError:
             pass
 
 
-def transcribe_with_ohttp(target_uri: str, api_key: str, kms_url: str, uploaded_file) -> str:
+async def ohttp_infer_whisper(target_uri: str, api_key: str, audio_path: str, kms_url: str,
+                              client_cache: OhttpClientCache):
     """
-    Wrapper to accept a Streamlit-uploaded file, save to tmp, and run the async OHTTP infer.
+    Async call to Confidential Whisper via OHTTP (pyohttp), with a cached OHTTP client.
+    Returns the raw response text (JSON string).
+    """
+    form_fields = {"file": "@" + audio_path, "response_format": "json"}
+    outer_headers = {"api-key": api_key}
+
+    async with client_cache.lease(kms_url) as client:
+        try:
+            response = await client.post(target_uri, form_fields=form_fields, outer_headers=outer_headers)
+            return await read_ohttp_response(response)
+        except Exception as e:
+            # Other errors (timeouts, network) are left to the caller's retries
+            if not is_ohttp_key_error(e):
+                raise
+
+    # The key configuration has been rotated: refetch it once and retry
+    async with client_cache.lease(kms_url, stale=client) as client:
+        response = await client.post(target_uri, form_fields=form_fields, outer_headers=outer_headers)
+        return await read_ohttp_response(response)
+
+
+async def read_ohttp_response(response) -> str:
+    """
+    Body of a pyohttp response; raises RuntimeError if the status is not 200, OhttpKeyError
+    if the gateway rejected the key configuration.
+    """
+    status = response.status()
+    chunks = []
+    while True:
+        c = await response.chunk()
+        if c is None:
+            break
+        chunks.append(bytes(c))
+    body = b"".join(chunks).decode("utf-8", errors="replace")
+
+    if status == 400 and OHTTP_KEY_PROBLEM in body:
+        raise OhttpKeyError(f"OHTTP key configuration rejected: HTTP {status}\n{body}")
+    if status != 200:
+        raise RuntimeError(f"OHTTP Whisper failed: HTTP {status}\n{body}")
+    return body
+
+
+def parse_transcript(body: str) -> str:
+    """Best effort to parse the Whisper JSON response and grab 'text', falling back to the raw body."""
+    try:
+        j = json.loads(body)
+        if isinstance(j, dict) and "text" in j:
+            return j["text"]
+    except Exception:
+        pass
+    return body
+
+
+async def transcribe_segments(target_uri: str, api_key: str, kms_url: str, segments: list, rate: int, fmt: str,
+                              client_cache: OhttpClientCache, concurrency: int, retries: int, progress: dict) -> list:
+    """
+    Transcribes audio segments, encoded as `fmt`, with at most `concurrency` OHTTP requests in flight,
+    retrying each failed segment up to `retries` times with exponential backoff.
+    Returns the texts in segment order; progress["done"] counts the segments finished,
+    progress["bytes"] the bytes uploaded and progress["texts"] holds each text as soon as it is received.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    progress["texts"] = [None] * len(segments)
+
+    async def transcribe_one(index: int, samples) -> str:
+        async with semaphore:
+            data = await asyncio.to_thread(encode_audio, samples, rate, fmt)
+            progress["bytes"] += len(data)
+            with audio_upload_path(data, "." + fmt) as audio_path:
+                for attempt in range(retries + 1):
+                    try:
+                        text = parse_transcript(
+                            await ohttp_infer_whisper(target_uri, api_key, audio_path, kms_url, client_cache)
+                        )
+                        break
+                    except Exception:
+                        if attempt == retries:
+                            raise
+                        await asyncio.sleep(2 ** attempt)
+        progress["texts"][index] = text
+        progress["done"] += 1
+        return text
+
+    tasks = [asyncio.ensure_future(transcribe_one(i, samples)) for i, (_, _, samples) in enumerate(segments)]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:  # after a failure, do not keep the other segments running
+            task.cancel()
+
+
+PART_NOTES_PROMPT = (
+    "Below is part {part} of {parts} of the transcript of an audio recording. "
+    "List its key points: facts, names, numbers, decisions and questions raised, in at most 120 words. "
+    "Answer with the list only.\n\nTranscript:\n{text}"
+)
+PART_NOTES_MAX_TOKENS = 512  # about 120 words of notes, with room for a short reasoning
+PART_NOTES_RETRY_MAX_TOKENS = 2048  # second attempt, when the reasoning used up the first budget
+
+
+class TranscriptPipeline:
+    """
+    Map step of a pipelined transcript → LLM answer for recordings transcribed in segments:
+    each segment's text is condensed into notes by the LLM as soon as it is received, while the
+    next segments are still being transcribed, and the notes are shown as they arrive. The final
+    answer (reduce step) is then generated from the notes instead of the whole transcript.
+    - ask(prompt, max_tokens) -> (answer, finish_reason): blocking LLM call without Streamlit calls,
+      run in worker threads (see chat_completion).
+    A part whose notes are empty or cut by max_tokens is asked again with retry_max_tokens; if it
+    still gets none, its raw transcript is used instead, and flagged in the notes shown.
+    """
+
+    def __init__(self, ask, workers: int = 4, max_tokens: int = PART_NOTES_MAX_TOKENS,
+                 retry_max_tokens: int = PART_NOTES_RETRY_MAX_TOKENS):
+        self.ask = ask
+        self.max_tokens = max_tokens
+        self.retry_max_tokens = retry_max_tokens
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="notes")
+        self._futures = {}  # segment index -> Future of its notes
+        self._texts = []
+        self._placeholder = None
+
+    @property
+    def started(self) -> bool:
+        return bool(self._futures)
+
+    def _notes(self, part: int, parts: int, text: str) -> tuple:
+        """Returns (notes, warning, raw): raw when the notes are the part's transcript, for lack of an answer."""
+        prompt = PART_NOTES_PROMPT.format(part=part, parts=parts, text=text)
+        try:
+            for max_tokens in (self.max_tokens, self.retry_max_tokens):
+                answer, finish_reason = self.ask(prompt, max_tokens)
+                if answer and finish_reason != "length":
+                    return answer, "", False
+        except Exception as e:
+            return text, f"raw transcript, the notes request failed: {e}", True  # rather than losing the part
+        if answer:
+            return answer, f"notes cut at {max_tokens} tokens", False
+        if finish_reason == "length":
+            return text, f"raw transcript, the reasoning used up {max_tokens} tokens", True
+        return text, "raw transcript, the model gave empty notes", True
+
+    def update(self, texts: list):
+        """Called with the segment texts received so far (None for pending ones): starts their map step and redraws the notes."""
+        if self._placeholder is None:
+            with st.expander("🧩 Notes on the recording, while it is transcribed", expanded=True):
+                self._placeholder = st.empty()
+        self._texts = texts
+        for i, text in enumerate(texts):
+            if text is not None and i not in self._futures:
+                self._futures[i] = self._executor.submit(self._notes, i + 1, len(texts), text)
+        self._render()
+
+    def _render(self):
+        lines = []
+        for i in range(len(self._texts)):
+            future = self._futures.get(i)
+            if future is None:
+                lines.append(f"**Part {i + 1}** · transcribing…")
+            elif not future.done():
+                lines.append(f"**Part {i + 1}** · taking notes…")
+            else:
+                notes, warning, _ = future.result()
+                lines.append(f"**Part {i + 1}**" + (f" · ⚠️ {warning}" if warning else "") + f"\n\n{notes}")
+        self._placeholder.markdown("\n\n".join(lines))
+
+    def finish(self) -> str:
+        """Waits for the remaining notes and returns the message for the reduce step."""
+        pending = set(self._futures.values())
+        while pending:
+            _, pending = concurrent.futures.wait(pending, timeout=0.5)
+            self._render()
+        self.close()
+        parts = [(i, *self._futures[i].result()) for i in sorted(self._futures)]
+        notes = "\n\n".join(f"Part {i + 1}{' (transcript)' if raw else ''}:\n{text}" for i, text, _, raw in parts)
+        return f"(Notes on an audio recording, transcribed and condensed part by part)\n\n{notes}"
+
+    def close(self):
+        """Cancels the map steps not started yet (the run was interrupted or failed) and releases the workers."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def transcribe_with_ohttp(target_uri: str, api_key: str, kms_url: str, uploaded_file,
+                          preprocess: bool = False, trim_silence: bool = False, audio_format: str = "wav",
+                          split_long_audio: bool = False, segment_s: float = 120, overlap_s: float = 1.0,
+                          concurrency: int = 4, retries: int = 2, on_segment=None) -> str:
+    """
+    Wrapper to accept a Streamlit-uploaded file, hand it to pyohttp through tmpfs, and run the async OHTTP infer.
+    - preprocess: send 16 kHz mono audio encoded as audio_format instead of the original file,
+      optionally with long silences trimmed.
+    - split_long_audio: a recording longer than segment_s is cut at silences into overlapping
+      segments transcribed by parallel requests, and the texts are stitched back together.
+      on_segment(texts) is then called with the segment texts received so far (None for pending ones),
+      whenever the progress is refreshed.
     Returns the transcript text (best effort to parse JSON and grab 'text').
     """
     if not HAS_PYOHTTP:
         raise RuntimeError("pyohttp not installed. Build from https://github.com/microsoft/attested-ohttp-client "
                            "(`./scripts/build-pyohttp.sh` then `pip install target/wheels/*.whl`).")
 
-    # Persist upload to a temp path
+    data = uploaded_file.getbuffer()  # memoryview of the uploaded bytes, no copy
     suffix = "." + (uploaded_file.name.split(".")[-1] if "." in uploaded_file.name else "bin")
-    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tf:
-        tf.write(uploaded_file.read())
-        tmp_path = tf.name
+    ohttp_loop = get_ohttp_event_loop()
+    started = time.perf_counter()
+
+    samples, segments = None, []
+    if preprocess or split_long_audio:
+        try:
+            samples, rate = decode_audio(data)
+            duration = len(samples) / rate
+            if preprocess and trim_silence:
+                samples = trim_silences(samples, rate)
+            if split_long_audio:
+                segments = split_audio(samples, rate, segment_s, overlap_s)
+        except ValueError as e:
+            st.caption(f"Sending the original file as a single request ({e}).")
+            samples = None
+    fmt = audio_format if preprocess else "wav"
+
+    if len(segments) > 1:
+        progress = {"done": 0, "bytes": 0, "texts": [None] * len(segments)}
+        future = ohttp_loop.submit(transcribe_segments(
+            target_uri, api_key, kms_url, segments, rate, fmt, ohttp_loop.client_cache, concurrency, retries, progress
+        ))
+        bar = st.progress(0.0)
+        try:
+            while not future.done():
+                bar.progress(progress["done"] / len(segments),
+                             text=f"Transcribed {progress['done']}/{len(segments)} segments")
+                if on_segment is not None:
+                    on_segment(list(progress["texts"]))
+                concurrent.futures.wait([future], timeout=0.25)
+            texts = future.result()
+            if on_segment is not None:
+                on_segment(texts)
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            bar.empty()
+        report = (f"{duration / 60:.1f} min of audio ({len(data) / 1e6:.2f} MB file) sent as "
+                  f"{len(segments)} {fmt} segments ({progress['bytes'] / 1e6:.2f} MB, {concurrency} parallel requests) "
+                  f"in {time.perf_counter() - started:.1f} s")
+        logging.info(report)
+        st.caption(report)
+        return merge_transcripts(texts)
+
+    if preprocess and samples is not None:
+        prepared = encode_audio(samples, rate, fmt)
+        prepared_s = time.perf_counter() - started
+        report = (f"Preprocessed {len(data) / 1e6:.2f} MB ({duration:.0f} s) into {len(prepared) / 1e6:.2f} MB of "
+                  f"16 kHz mono {fmt} ({len(samples) / rate:.0f} s) in {prepared_s:.2f} s")
+        data, suffix = prepared, "." + fmt
+    else:
+        report = f"Uploaded {len(data) / 1e6:.2f} MB as is"
 
+    waiting = st.empty()
+    with audio_upload_path(data, suffix) as audio_path:
+        body = ohttp_loop.run(
+            ohttp_infer_whisper(target_uri, api_key, audio_path, kms_url, ohttp_loop.client_cache),
+            on_wait=lambda: waiting.caption(f"Waiting for the transcript… {time.perf_counter() - started:.0f} s"),
+        )
+    waiting.empty()
+    report += f"; transcribed in {time.perf_counter() - started:.1f} s"
+    logging.info(report)
+    st.caption(report)
+    return parse_transcript(body)
+
+
+BATCH_FIELDS = ["file", "status", "attempts", "seconds", "transcript", "answer", "error"]
+
+
+def prepare_upload(data, suffix: str, trim_silence: bool, fmt: str) -> tuple:
+    """(data, suffix) of the 16 kHz mono `fmt` version of an audio file, or of the file itself if it cannot be decoded."""
     try:
-        body = asyncio.run(ohttp_infer_whisper(target_uri, api_key, tmp_path, kms_url))
-        # Try JSON parse, fallback to raw
+        samples, rate = decode_audio(data)
+    except ValueError:
+        return data, suffix
+    if trim_silence:
+        samples = trim_silences(samples, rate)
+    return encode_audio(samples, rate, fmt), "." + fmt
+
+
+async def transcribe_batch(jobs: list, target_uri: str, api_key: str, kms_url: str, client_cache: OhttpClientCache,
+                           concurrency: int, retries: int, preprocess: bool, trim_silence: bool, audio_format: str,
+                           ask=None):
+    """
+    Transcribes the audio files of `jobs` with at most `concurrency` OHTTP requests in flight, retrying
+    each file up to `retries` times. With `ask(transcript) -> answer` (blocking, run in a worker thread),
+    each transcript goes to the LLM as soon as it is received, while the next files are transcribed.
+    Jobs are dicts updated in place ("status", "attempts", ...), for the progress table.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_job(job: dict):
+        started = None
         try:
-            j = json.loads(body)
-            if isinstance(j, dict) and "text" in j:
-                return j["text"]
-        except Exception:
-            pass
-        return body
+            async with semaphore:
+                started = time.perf_counter()
+                job["status"] = "transcribing"
+                data, suffix = job.pop("data"), job.pop("suffix")
+                if preprocess:
+                    data, suffix = await asyncio.to_thread(prepare_upload, data, suffix, trim_silence, audio_format)
+                with audio_upload_path(data, suffix) as audio_path:
+                    for attempt in range(retries + 1):
+                        job["attempts"] = attempt + 1
+                        try:
+                            body = await ohttp_infer_whisper(target_uri, api_key, audio_path, kms_url, client_cache)
+                            break
+                        except Exception:
+                            if attempt == retries:
+                                raise
+                            await asyncio.sleep(2 ** attempt)
+            job["transcript"] = parse_transcript(body)
+        except Exception as e:
+            job["status"], job["error"] = "failed", str(e)
+            if started is not None:
+                job["seconds"] = round(time.perf_counter() - started, 1)
+            return
+
+        if ask is not None:  # outside the semaphore: the next file is transcribed meanwhile
+            job["status"] = "asking LLM"
+            try:
+                job["answer"] = await asyncio.to_thread(ask, job["transcript"])
+            except Exception as e:
+                job["error"] = f"LLM: {e}"
+        job["status"] = "done"
+        job["seconds"] = round(time.perf_counter() - started, 1)
+
+    await asyncio.gather(*(run_job(job) for job in jobs))
+
+
+def run_batch(files: list, target_uri: str, api_key: str, kms_url: str, ask=None, **options) -> list:
+    """
+    Runs transcribe_batch on the background OHTTP loop, showing a progress bar and a live status
+    table meanwhile. `options` are the keyword arguments of transcribe_batch. Returns one result per file.
+    """
+    jobs = [
+        {"file": f.name, "status": "queued", "attempts": 0, "seconds": None, "transcript": "", "answer": "",
+         "error": "", "data": f.getbuffer(), "suffix": "." + (f.name.split(".")[-1] if "." in f.name else "bin")}
+        for f in files
+    ]
+    ohttp_loop = get_ohttp_event_loop()
+    future = ohttp_loop.submit(transcribe_batch(jobs, target_uri, api_key, kms_url, ohttp_loop.client_cache,
+                                                ask=ask, **options))
+    bar, table = st.progress(0.0), st.empty()
+    try:
+        while True:
+            finished = sum(job["status"] in ("done", "failed") for job in jobs)
+            bar.progress(finished / len(jobs), text=f"{finished}/{len(jobs)} files")
+            table.dataframe([{k: job[k] for k in ("file", "status", "attempts", "seconds")} for job in jobs],
+                            use_container_width=True)
+            if future.done():
+                break
+            concurrent.futures.wait([future], timeout=0.5)
+        future.result()
+    except BaseException:
+        future.cancel()
+        raise
     finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+        bar.empty()
+        table.empty()
+    return [{k: job[k] for k in BATCH_FIELDS} for job in jobs]
+
+
+def render_batch_results(results: list):
+    """Results table and JSONL export of the last batch."""
+    failed = sum(r["status"] == "failed" for r in results)
+    st.caption(f"{len(results) - failed} of {len(results)} files transcribed"
+               f"{f', {failed} failed' if failed else ''}")
+    st.dataframe(results, use_container_width=True)
+    st.download_button(
+        "⬇️ Export JSONL",
+        data="".join(json.dumps(r, ensure_ascii=False) + "\n" for r in results),
+        file_name="transcripts.jsonl",
+        mime="application/x-ndjson",
+    )
+
+
+def render_turn(turn: Turn):
+    """One message of the history (without re-streaming)."""
+    if turn.role == "assistant" and not (turn.content or turn.has_think):
+        return  # an answer still waiting for its first token, or that failed
+    with st.chat_message(turn.role):
+        st.markdown(turn.content)
+        if turn.notes:
+            with st.expander("🧩 Notes sent to the model"):
+                st.markdown(turn.notes)
+        if turn.context:
+            st.caption(turn.context)
+        if turn.has_think:
+            with st.expander("🧠 View reasoning"):
+                st.markdown(f"<div class='thinking'>{escape(turn.think)}</div>", unsafe_allow_html=True)
+        if turn.metrics:
+            st.caption(format_metrics(turn.metrics))
+
+
+def render_history(history: TurnStore, recent: int):
+    """
+    Renders the last `recent` turns. Older turns are only rendered on demand, one page of
+    `recent` turns at a time, so a rerun costs the same however long the conversation is.
+    """
+    older = len(history) - recent
+    if older > 0 and st.toggle(f"🗂️ Show {older} earlier messages", key="show_older_turns"):
+        pages = -(-older // recent)
+        page = st.number_input(f"Page (1 = oldest, {pages} = most recent)", min_value=1, max_value=pages,
+                               value=pages, key="history_page")
+        for turn in history.turns[(page - 1) * recent:min(page * recent, older)]:
+            render_turn(turn)
+        st.markdown("---")
+    for turn in history.turns[max(older, 0):]:
+        render_turn(turn)
 
 
 # =========================
@@ -376,6 +1335,74 @@ with st.sidebar:
     temperature = st.slider("Temperature", min_value=0.0, max_value=1.0, value=0.2, step=0.05)
     max_tokens = st.slider("Max response tokens", min_value=128, max_value=32000, value=2048, step=128)
     verify_ssl = st.toggle("Verify SSL certificate (vLLM)", value=True, help="Disable if you have a self-signed certificate (not recommended)")
+    render_interval_ms = st.slider(
+        "Render interval (ms)", min_value=0, max_value=500, value=50, step=10,
+        help="Streamed tokens are coalesced and the answer is redrawn at most this often (0 = every token)",
+    )
+    with st.expander("🔌 Connection pool"):
+        use_http2 = st.toggle(
+            "HTTP/2", value=False, disabled=not HAS_HTTP2,
+            help="Multiplex requests over a single connection (requires `pip install httpx[http2]`)",
+        )
+        pool_size = st.number_input("Max pooled connections", min_value=1, max_value=100, value=10)
+    http_client = get_http_client(use_http2, int(pool_size), verify_ssl)
+    with st.expander("🧮 Context window"):
+        context_budget = st.number_input(
+            "Context budget (tokens)", min_value=1024, max_value=262144, value=8192, step=1024,
+            help="Prompt + answer tokens per request, at most the --max-model-len of vLLM. "
+                 "The oldest turns that do not fit are left out.",
+        )
+        summarize_dropped = st.toggle(
+            "Summarize dropped turns", value=False,
+            help="Fold the turns left out into a running summary (one extra request each time the window moves)",
+        )
+        tokenizer_name = st.text_input(
+            "Tokenizer (optional)", value="",
+            help="Hugging Face tokenizer for exact counts, e.g. microsoft/Phi-4-mini-reasoning "
+                 "(requires `pip install transformers`). Empty: about 4 characters per token.",
+        )
+    try:
+        count_tokens = get_token_counter(tokenizer_name.strip())
+    except Exception as e:
+        st.warning(f"Tokenizer unavailable, estimating token counts instead: {e}")
+        count_tokens = estimate_tokens
+    context_window = st.session_state.context
+    context_window.budget_tokens = int(context_budget)
+    context_window.set_token_counter(count_tokens)
+    context_window.summarize = (
+        lambda previous, evicted: summarize_turns(
+            server_url.strip(), api_key.strip(), header_mode, model_name.strip(), http_client, previous, evicted
+        )
+    ) if summarize_dropped else None
+    with st.expander("♻️ Response cache"):
+        cache_enabled = st.toggle(
+            "Replay identical requests", value=False,
+            help="Answers to an identical request (same model, context, temperature and max tokens) "
+                 "are replayed from this session's memory instead of generated again",
+        )
+        cache_sampled = st.toggle(
+            "Also when temperature > 0", value=False, disabled=not cache_enabled,
+            help="Sampled answers are random: by default only temperature 0 answers are cached",
+        )
+        response_cache = st.session_state.response_cache
+        response_cache.max_entries = st.number_input("Max cached answers", min_value=1, max_value=1000, value=128)
+        response_cache.ttl_seconds = 60 * st.number_input("Time to live (minutes)", min_value=1, max_value=1440, value=60)
+        cache_stats = st.empty()  # filled at the end of the run, after this turn's lookup
+        if st.button("Clear cache"):
+            response_cache.clear()
+    use_cache = cache_enabled and (temperature == 0 or cache_sampled)
+    with st.expander("🗂️ History"):
+        history_recent = st.number_input(
+            "Messages shown in full", min_value=2, max_value=200, value=20, step=2,
+            help="Older messages are rendered only on demand, one page at a time",
+        )
+        compress_think = st.toggle(
+            "Compress older reasoning", value=True,
+            help="Keep the reasoning of the messages not shown in full compressed in memory",
+        )
+    st.session_state.history.compress_after = int(history_recent) if compress_think else None
+    with st.expander("⏱️ Latency (session)"):
+        latency_panel = st.container()  # filled at the end of the run, with this turn included
 
     st.markdown("---")
     st.subheader("🔐 Confidential Whisper (OHTTP)")
@@ -390,12 +1417,47 @@ with st.sidebar:
         value="https://accconfinferenceproduction.confidential-ledger.azure.com",
         help="Microsoft Confidential Inferencing KMS URL"
     )
+    with st.expander("🎚️ Audio preprocessing"):
+        preprocess_audio = st.toggle(
+            "Convert to 16 kHz mono", value=has_ffmpeg(),
+            help="Decode the upload and send the 16 kHz mono audio Whisper works on, re-encoded compactly, "
+                 "instead of the original file. Needs ffmpeg on the PATH for formats other than WAV.",
+        )
+        trim_silence = st.toggle(
+            "Trim long silences", value=True, disabled=not preprocess_audio,
+            help="Pauses longer than 1 s are shortened to 0.3 s",
+        )
+        audio_format = st.selectbox(
+            "Upload format", options=FORMATS if has_ffmpeg() else ("wav",), disabled=not preprocess_audio,
+            help="flac: lossless, about half the size of wav; ogg: Opus at 32 kbit/s, smallest",
+        )
+    with st.expander("✂️ Long recordings"):
+        split_long_audio = st.toggle(
+            "Split into parallel requests", value=True,
+            help="Recordings longer than a segment are cut at pauses and the segments transcribed concurrently. "
+                 "Needs ffmpeg on the PATH for formats other than WAV.",
+        )
+        segment_s = st.number_input("Segment length (s)", min_value=30, max_value=1200, value=120, step=30)
+        overlap_s = st.number_input(
+            "Overlap (s)", min_value=0.0, max_value=5.0, value=1.0, step=0.5,
+            help="Audio shared by neighbouring segments, so no word is lost at a cut; repeated words are removed",
+        )
+        whisper_concurrency = st.number_input("Parallel requests", min_value=1, max_value=16, value=4)
+        whisper_retries = st.number_input("Retries per segment", min_value=0, max_value=5, value=2)
+        if split_long_audio and not has_ffmpeg():
+            st.caption("ffmpeg not found: only WAV files will be split.")
     auto_ask_vllm = st.checkbox("After transcribing, ask my vLLM automatically", value=True)
+    pipeline_llm = st.toggle(
+        "Pipeline long recordings with the LLM", value=False, disabled=not auto_ask_vllm,
+        help="When a recording is transcribed in segments, vLLM takes notes on each segment as soon as it is "
+             "transcribed, and the answer is generated from these notes (map-reduce) instead of the full transcript",
+    )
 
     st.markdown("---")
     if st.button("🗑️ Reset conversation"):
-        st.session_state.messages = []
-        st.session_state.turns = []
+        st.session_state.history = TurnStore()
+        st.session_state.pop("history_page", None)
+        st.session_state.context = ContextWindow(budget_tokens=int(context_budget))
         st.rerun()
 
 
@@ -408,12 +1470,7 @@ st.caption("Multi-turn chat • Streaming • Clear reasoning via expander • T
 # =========================
 # History Display
 # =========================
-for msg in st.session_state.turns:
-    with st.chat_message(msg["role"]):
-        st.markdown(msg["content"])
-        if msg.get("think"):
-            with st.expander("🧠 View reasoning"):
-                st.markdown(f"<div class='thinking'>{escape(msg['think'])}</div>", unsafe_allow_html=True)
+render_history(st.session_state.history, int(history_recent))
 
 # =========================
 # Audio transcription (OHTTP)
@@ -423,41 +1480,106 @@ if not HAS_PYOHTTP:
     st.warning("`pyohttp` not installed. Build it from Microsoft's repo and `pip install` the wheel "
                "(see https://github.com/microsoft/attested-ohttp-client).")
 
+if not CAN_STAGE_AUDIO:
+    st.error("No tmpfs at /dev/shm: transcription is disabled so that plaintext audio is not written to disk. "
+             f"Set `AUDIO_DISK_FALLBACK=1` to allow writing it briefly to {tempfile.gettempdir()} instead.")
+elif AUDIO_TMP_DIR is None:
+    st.warning(f"No tmpfs at /dev/shm: uploaded audio is briefly written to {tempfile.gettempdir()} for pyohttp "
+               "(AUDIO_DISK_FALLBACK=1).")
+
 audio_file = st.file_uploader("Upload audio (e.g., .mp3, .wav, .m4a)", type=["mp3","wav","m4a","ogg","mp4"], accept_multiple_files=False)
 
-if st.button("🔐 Transcribe with OHTTP", disabled=(audio_file is None or not HAS_PYOHTTP)):
+if st.button("🔐 Transcribe with OHTTP", disabled=(audio_file is None or not HAS_PYOHTTP or not CAN_STAGE_AUDIO)):
     if not whisper_target or not whisper_key or not kms_url:
         st.error("Please set Whisper Target URI, Whisper API Key, and KMS URL in the sidebar.")
     else:
         with st.spinner("Calling OHTTP → Confidential Whisper…"):
             try:
-                transcript = transcribe_with_ohttp(whisper_target.strip(), whisper_key.strip(), kms_url.strip(), audio_file)
+                pipeline = None
+                if auto_ask_vllm and pipeline_llm:
+                    def ask_vllm(prompt: str, max_tokens: int) -> tuple:
+                        return chat_completion(
+                            server_url.strip(), api_key.strip(), header_mode, model_name.strip(), http_client,
+                            [{"role": "user", "content": prompt}], temperature=temperature, max_tokens=max_tokens,
+                        )
+
+                    pipeline = TranscriptPipeline(ask_vllm, workers=int(whisper_concurrency))
+                transcript = transcribe_with_ohttp(
+                    whisper_target.strip(), whisper_key.strip(), kms_url.strip(), audio_file,
+                    preprocess=preprocess_audio, trim_silence=trim_silence, audio_format=audio_format,
+                    split_long_audio=split_long_audio, segment_s=segment_s, overlap_s=overlap_s,
+                    concurrency=int(whisper_concurrency), retries=int(whisper_retries),
+                    on_segment=pipeline.update if pipeline else None,
+                )
                 st.success("Transcription received.")
                 st.markdown("**Transcript**")
                 st.code(transcript or "(empty)")
 
+                # The model gets the notes taken while transcribing (reduce step), or the whole transcript
+                notes = pipeline.finish() if pipeline and pipeline.started else ""
+
                 # Log the transcript in chat, then (optionally) ask vLLM about it
-                st.chat_message("user").markdown(f"*(Audio transcript)*\n\n{transcript}")
-                st.session_state.turns.append({"role": "user", "content": transcript})
-                st.session_state.messages.append({"role": "user", "content": transcript})
+                user_box = st.chat_message("user")
+                user_box.markdown(f"*(Audio transcript)*\n\n{transcript}")
+                st.session_state.history.append("user", transcript, notes=notes)
 
                 if auto_ask_vllm:
-                    visible, think = stream_chat_completions(
+                    with user_box:
+                        request_messages = select_context(max_tokens, exact_counts=count_tokens is not estimate_tokens)
+                    stream_chat_completions(
                         server_url=server_url.strip(),
                         api_key=api_key.strip(),
                         header_mode=header_mode,
                         model=model_name.strip(),
-                        messages=st.session_state.messages,
+                        messages=request_messages,
                         temperature=temperature,
                         max_tokens=max_tokens,
                         verify_ssl=verify_ssl,
+                        render_interval_ms=render_interval_ms,
+                        http_client=http_client,
+                        response_cache=response_cache if use_cache else None,
+                        turn=st.session_state.history.append("assistant", ""),
                     )
-                    if visible or think:
-                        st.session_state.turns.append({"role": "assistant", "content": visible, "think": think})
-                        st.session_state.messages.append({"role": "assistant", "content": visible})
 
             except Exception as e:
                 st.error(f"OHTTP transcription failed: {e}")
+            finally:
+                # Also when Streamlit interrupts the run (stop, rerun): no notes for a session nobody watches
+                if pipeline:
+                    pipeline.close()
+
+with st.expander("🗂️ Batch transcription (several files)"):
+    batch_files = st.file_uploader(
+        "Upload audio files", type=["mp3","wav","m4a","ogg","mp4"], accept_multiple_files=True, key="batch_files",
+    )
+    batch_ask = st.toggle(
+        "Ask my vLLM about each transcript", value=False,
+        help="Each transcript is sent as soon as it is received, while the next files are being transcribed",
+    )
+    batch_prompt = st.text_area(
+        "Question for each transcript", disabled=not batch_ask,
+        value="Summarize this recording in 3 bullet points and list any action items.",
+    )
+    st.caption("Uses the parallel requests, retries and preprocessing settings of the sidebar.")
+    if st.button("🔐 Transcribe all with OHTTP", disabled=(not batch_files or not HAS_PYOHTTP or not CAN_STAGE_AUDIO)):
+        if not whisper_target or not whisper_key or not kms_url:
+            st.error("Please set Whisper Target URI, Whisper API Key, and KMS URL in the sidebar.")
+        else:
+            def ask_vllm(transcript: str) -> str:
+                return complete_chat(
+                    server_url.strip(), api_key.strip(), header_mode, model_name.strip(), http_client,
+                    [{"role": "user", "content": f"{batch_prompt}\n\nTranscript:\n{transcript}"}],
+                    temperature=temperature, max_tokens=max_tokens,
+                )
+
+            st.session_state.batch_results = run_batch(
+                batch_files, whisper_target.strip(), whisper_key.strip(), kms_url.strip(),
+                ask=ask_vllm if batch_ask else None,
+                concurrency=int(whisper_concurrency), retries=int(whisper_retries),
+                preprocess=preprocess_audio, trim_silence=trim_silence, audio_format=audio_format,
+            )
+    if st.session_state.batch_results:
+        render_batch_results(st.session_state.batch_results)
 
 st.markdown("---")
 
@@ -465,24 +1587,32 @@ st.markdown("---")
 # Text Input & Streaming to your vLLM
 # =========================
 if user_prompt := st.chat_input("Ask your question…"):
-    st.chat_message("user").markdown(user_prompt)
-    st.session_state.turns.append({"role": "user", "content": user_prompt})
-    st.session_state.messages.append({"role": "user", "content": user_prompt})
+    user_box = st.chat_message("user")
+    user_box.markdown(user_prompt)
+    st.session_state.history.append("user", user_prompt)
+    with user_box:
+        request_messages = select_context(max_tokens, exact_counts=count_tokens is not estimate_tokens)
 
-    visible, think = stream_chat_completions(
+    answer = st.session_state.history.append("assistant", "")
+    stream_chat_completions(
         server_url=server_url.strip(),
         api_key=api_key.strip(),
         header_mode=header_mode,
         model=model_name.strip(),
-        messages=st.session_state.messages,
+        messages=request_messages,
         temperature=temperature,
         max_tokens=max_tokens,
         verify_ssl=verify_ssl,
+        render_interval_ms=render_interval_ms,
+        http_client=http_client,
+        response_cache=response_cache if use_cache else None,
+        turn=answer,
     )
+    if not answer.in_context:
+        st.session_state.history.drop_unanswered()
 
-    if visible or think:
-        st.session_state.turns.append({"role": "assistant", "content": visible, "think": think})
-        st.session_state.messages.append({"role": "assistant", "content": visible})
-    else:
-        if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
-            st.session_state.messages.pop()
\ No newline at end of file
+with latency_panel:
+    render_latency_summary(st.session_state.latency_log)
+cache_stats.caption(
+    f"{response_cache.hits} hits · {response_cache.misses} misses · {len(response_cache)} cached answers"
+)
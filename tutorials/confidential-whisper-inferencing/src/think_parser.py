@@ -0,0 +1,223 @@
+# think_parser.py
+"""
+Incremental, UI-free parser splitting a streamed LLM answer into reasoning
+("<think> ... </think>") and visible text.
+
+Tags may be fragmented arbitrarily between chunks. The parser only keeps the few
+characters that could still be the beginning of a tag between two calls, and
+accumulates text in lists, so parsing a whole answer is O(n).
+
+Run `python think_parser.py` for a fuzz check over random chunk fragmentations
+and a micro-benchmark against the previous string-based splitter.
+"""
+from typing import List, NamedTuple, Sequence, Tuple
+
+# Event kinds emitted by ThinkTagParser.feed() / finish()
+THINK_DELTA = "think_delta"
+VISIBLE_DELTA = "visible_delta"
+TAG_OPEN = "tag_open"
+TAG_CLOSE = "tag_close"
+
+# (opening tag, closing tag) pairs
+DEFAULT_TAGS: Tuple[Tuple[str, str], ...] = (("<think>", "</think>"),)
+# Common reasoning-tag dialects of open-weight reasoning models
+REASONING_TAGS: Tuple[Tuple[str, str], ...] = (
+    ("<think>", "</think>"),
+    ("<thinking>", "</thinking>"),
+    ("<reasoning>", "</reasoning>"),
+    ("<|begin_of_thought|>", "<|end_of_thought|>"),
+)
+
+
+class ParseEvent(NamedTuple):
+    kind: str  # THINK_DELTA, VISIBLE_DELTA, TAG_OPEN or TAG_CLOSE
+    text: str  # the new text for deltas, the tag itself for TAG_OPEN / TAG_CLOSE
+
+
+class ThinkTagParser:
+    """
+    Feeds streamed chunks, returns typed events.
+
+        parser = ThinkTagParser()
+        for chunk in stream:
+            for event in parser.feed(chunk):
+                ...
+        events = parser.finish()
+        parser.visible_text, parser.think_text
+    """
+
+    def __init__(self, tags: Sequence[Tuple[str, str]] = DEFAULT_TAGS):
+        if not tags:
+            raise ValueError("At least one (open, close) tag pair is required.")
+        self._closing = dict(tags)
+        self._open_tags = tuple(self._closing)
+        # First characters of every tag: chunks without any of them cannot contain a tag
+        self._tag_starts = "".join({tag[0] for pair in tags for tag in pair})
+        self._pending = ""       # possible beginning of a tag, always shorter than the longest tag
+        self._close_tag = None   # closing tag awaited while inside a reasoning block
+        self._think_parts: List[str] = []
+        self._visible_parts: List[str] = []
+
+    @property
+    def in_think(self) -> bool:
+        return self._close_tag is not None
+
+    @property
+    def think_text(self) -> str:
+        return "".join(self._think_parts)
+
+    @property
+    def visible_text(self) -> str:
+        return "".join(self._visible_parts)
+
+    def _emit(self, events: List[ParseEvent], text: str):
+        if not text:
+            return
+        if self._close_tag is not None:
+            self._think_parts.append(text)
+            events.append(ParseEvent(THINK_DELTA, text))
+        else:
+            self._visible_parts.append(text)
+            events.append(ParseEvent(VISIBLE_DELTA, text))
+
+    def _awaited_tags(self) -> Tuple[str, ...]:
+        return (self._close_tag,) if self._close_tag is not None else self._open_tags
+
+    @staticmethod
+    def _find_tag(buf: str, pos: int, tags: Tuple[str, ...]):
+        """Returns (index, tag) of the earliest complete tag of buf[pos:], or (-1, None)."""
+        best, best_tag = -1, None
+        for tag in tags:
+            idx = buf.find(tag, pos)
+            if idx != -1 and (best == -1 or idx < best):
+                best, best_tag = idx, tag
+        return best, best_tag
+
+    @staticmethod
+    def _partial_tag_len(buf: str, pos: int, tags: Tuple[str, ...]) -> int:
+        """Length of the longest suffix of buf[pos:] that could still grow into one of the tags."""
+        start = max(pos, len(buf) - max(len(tag) for tag in tags) + 1)
+        best = len(buf)
+        for first in {tag[0] for tag in tags}:
+            # Only suffixes starting with the first character of a tag are candidates
+            idx = buf.find(first, start)
+            while idx != -1 and idx < best:
+                suffix = buf[idx:]
+                if any(tag.startswith(suffix) for tag in tags):
+                    best = idx
+                    break
+                idx = buf.find(first, idx + 1)
+        return len(buf) - best
+
+    def feed(self, text: str) -> List[ParseEvent]:
+        """Consumes a chunk and returns the events it completes."""
+        events: List[ParseEvent] = []
+        if not self._pending and not any(c in text for c in self._tag_starts):
+            # Fast path for the vast majority of tokens
+            self._emit(events, text)
+            return events
+        buf = self._pending + text if self._pending else text
+        pos = 0
+        while True:
+            tags = self._awaited_tags()
+            idx, tag = self._find_tag(buf, pos, tags)
+            if idx == -1:
+                keep = self._partial_tag_len(buf, pos, tags)
+                self._emit(events, buf[pos:len(buf) - keep])
+                self._pending = buf[len(buf) - keep:] if keep else ""
+                return events
+            self._emit(events, buf[pos:idx])
+            if self._close_tag is None:
+                self._close_tag = self._closing[tag]
+                events.append(ParseEvent(TAG_OPEN, tag))
+            else:
+                self._close_tag = None
+                events.append(ParseEvent(TAG_CLOSE, tag))
+            pos = idx + len(tag)
+
+    def finish(self) -> List[ParseEvent]:
+        """Flushes what is left at the end of the stream (an unfinished tag is treated as text)."""
+        events: List[ParseEvent] = []
+        self._emit(events, self._pending)
+        self._pending = ""
+        return events
+
+
+def _legacy_split(chunks: Sequence[str]) -> Tuple[str, str]:
+    """The previous dict-based splitter of the Streamlit clients, with the UI calls removed."""
+    tag_open, tag_close = "<think>", "</think>"
+    keep = max(len(tag_open), len(tag_close)) - 1
+    state = {"pending": "", "in_think": False, "think_text": "", "visible_text": ""}
+    for chunk in chunks:
+        state["pending"] += chunk
+        while True:
+            tag = tag_close if state["in_think"] else tag_open
+            target = "think_text" if state["in_think"] else "visible_text"
+            idx = state["pending"].find(tag)
+            if idx == -1:
+                if len(state["pending"]) > keep:
+                    consume = len(state["pending"]) - keep
+                    state[target] += state["pending"][:consume]
+                    state["pending"] = state["pending"][consume:]
+                break
+            state[target] += state["pending"][:idx]
+            state["pending"] = state["pending"][idx + len(tag):]
+            state["in_think"] = not state["in_think"]
+    target = "think_text" if state["in_think"] else "visible_text"
+    state[target] += state["pending"]
+    return state["visible_text"], state["think_text"]
+
+
+def _fuzz(iterations: int = 2000, seed: int = 0):
+    """Checks that any fragmentation of a stream yields the same result as a single chunk."""
+    import random
+
+    rng = random.Random(seed)
+    alphabet = ["a", "b", " ", "<", ">", "/", "\n", "<think>", "</think>", "<thinking>", "</thinking>", "<thi", "k>"]
+    for _ in range(iterations):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 60)))
+        tags = rng.choice([DEFAULT_TAGS, REASONING_TAGS])
+
+        reference = ThinkTagParser(tags)
+        reference.feed(text)
+        reference.finish()
+
+        parser, pos = ThinkTagParser(tags), 0
+        events: List[ParseEvent] = []
+        while pos < len(text):
+            step = rng.randint(1, 8)
+            events += parser.feed(text[pos:pos + step])
+            pos += step
+        events += parser.finish()
+
+        assert (parser.visible_text, parser.think_text) == (reference.visible_text, reference.think_text), text
+        assert "".join(e.text for e in events if e.kind == VISIBLE_DELTA) == parser.visible_text, text
+        assert "".join(e.text for e in events if e.kind == THINK_DELTA) == parser.think_text, text
+        if tags == DEFAULT_TAGS:
+            assert (parser.visible_text, parser.think_text) == _legacy_split([text]), text
+    print(f"fuzz: {iterations} random fragmentations OK")
+
+
+def _benchmark(sizes: Sequence[int] = (8000, 32000, 128000)):
+    """Compares the parser with the previous splitter on long, token-by-token reasoning traces."""
+    import timeit
+
+    for n_tokens in sizes:
+        tokens = ["<think>"] + ["step "] * (n_tokens // 2) + ["</think>"] + ["word "] * (n_tokens // 2)
+
+        def run_parser():
+            parser = ThinkTagParser()
+            for token in tokens:
+                parser.feed(token)
+            parser.finish()
+            return parser.visible_text, parser.think_text
+
+        assert run_parser() == _legacy_split(tokens)
+        for name, fn in (("ThinkTagParser", run_parser), ("legacy splitter", lambda: _legacy_split(tokens))):
+            seconds = min(timeit.repeat(fn, number=1, repeat=3))
+            print(f"{name:>16}: {len(tokens):>7} tokens in {seconds * 1000:8.1f} ms ({len(tokens) / seconds:>12,.0f} tokens/s)")
+
+
+if __name__ == "__main__":
+    _fuzz()
+    _benchmark()
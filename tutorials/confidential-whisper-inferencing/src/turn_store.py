@@ -0,0 +1,153 @@
+# turn_store.py
+"""
+Compact conversation history for the Streamlit chat clients.
+
+Each turn is stored once, in a Turn record with __slots__. The messages sent to the model
+(role and content, never the reasoning) are derived from the turns when a request is sent,
+not on every rerun. The reasoning of old turns, only read when the user opens it, can be
+kept zlib-compressed.
+
+Run `python turn_store.py` for a self-check on a long synthetic conversation.
+"""
+import zlib
+from typing import Iterator, List, Optional
+
+
+class Turn:
+    """One message of the conversation, with what the UI shows about it."""
+
+    __slots__ = ("role", "content", "notes", "metrics", "context", "in_context", "_think")
+
+    def __init__(self, role: str, content: str, think: str = "", metrics: Optional[dict] = None, notes: str = ""):
+        self.role = role
+        self.content = content
+        self.notes = notes        # sent to the model instead of the content, when set
+        self.metrics = metrics
+        self.context = ""         # prompt size note of select_context
+        self.in_context = True    # False: shown, but not sent to the model (e.g. a question whose answer failed)
+        self._think = think       # str, or zlib-compressed bytes
+
+    @property
+    def think(self) -> str:
+        return zlib.decompress(self._think).decode() if isinstance(self._think, bytes) else self._think
+
+    @think.setter
+    def think(self, text: str):
+        self._think = text
+
+    @property
+    def has_think(self) -> bool:
+        return bool(self._think)
+
+    def compress(self, min_chars: int = 1024):
+        """Compresses the reasoning if it is at least min_chars long."""
+        if isinstance(self._think, str) and len(self._think) >= min_chars:
+            self._think = zlib.compress(self._think.encode(), 6)
+
+    def message(self) -> dict:
+        return {"role": self.role, "content": self.notes or self.content}
+
+
+class TurnStore:
+    """
+    The turns of a conversation, and `messages`, the part of them sent to the model.
+    With compress_after, the reasoning of all but the last compress_after turns is compressed.
+    Turns are only changed at the end of the conversation (an answer is filled in place while it
+    streams), so the indices of `messages` used by chat_context.ContextWindow stay valid.
+    """
+
+    def __init__(self, compress_after: Optional[int] = 20, compress_min_chars: int = 1024):
+        self.compress_after = compress_after
+        self.compress_min_chars = compress_min_chars
+        self.turns: List[Turn] = []
+        self._compressed = 0  # turns before this index are compressed already
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def __iter__(self) -> Iterator[Turn]:
+        return iter(self.turns)
+
+    @property
+    def last(self) -> Optional[Turn]:
+        return self.turns[-1] if self.turns else None
+
+    def append(self, role: str, content: str, think: str = "", metrics: Optional[dict] = None,
+               notes: str = "") -> Turn:
+        turn = Turn(role, content, think, metrics, notes)
+        self.turns.append(turn)
+        if self.compress_after is not None:
+            while self._compressed < len(self.turns) - self.compress_after:
+                self.turns[self._compressed].compress(self.compress_min_chars)
+                self._compressed += 1
+        return turn
+
+    @property
+    def messages(self) -> List[dict]:
+        """
+        The messages sent to the model: the turns in context, except an answer without text yet
+        and a question directly followed by another one (its answer failed or was stopped before
+        any text), so the request is not malformed.
+        """
+        kept = [turn for turn in self.turns if turn.in_context and (turn.content or turn.role != "assistant")]
+        return [turn.message() for i, turn in enumerate(kept)
+                if not (turn.role == "user" and i + 1 < len(kept) and kept[i + 1].role == "user")]
+
+    def drop_unanswered(self):
+        """
+        Leaves the last user message out of the model's context (its answer failed), so the
+        next request is not malformed. It stays in the displayed history.
+        """
+        for turn in reversed(self.turns):
+            if turn.in_context:
+                if turn.role == "user":
+                    turn.in_context = False
+                return
+
+
+def _self_check(turns: int = 2000, think_chars: int = 4000):
+    """Fills a store with a long conversation and compares its size with the two lists of dicts it replaces."""
+    import sys
+    import random
+
+    rng = random.Random(0)
+    words = ["token", "cache", "prefix", "budget", "answer", "model", "latency", "attention", "decode", "step"]
+
+    def text(n: int) -> str:
+        return " ".join(rng.choice(words) for _ in range(n // 6))
+
+    store, turn_dicts, message_dicts = TurnStore(), [], []
+    for _ in range(turns):
+        question, answer, think = text(200), text(800), text(think_chars)
+        store.append("user", question)
+        store.append("assistant", answer, think=think)
+        turn_dicts += [{"role": "user", "content": question}, {"role": "assistant", "content": answer, "think": think}]
+        message_dicts += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+    assert store.messages == message_dicts
+    assert [t.think for t in store] == [t.get("think", "") for t in turn_dicts]
+    store.append("user", "unanswered")
+    store.drop_unanswered()
+    assert store.messages == message_dicts and store.last.content == "unanswered"
+    store.append("user", "answer stopped before any text")
+    store.append("user", "next question")
+    assert store.messages == message_dicts + [{"role": "user", "content": "next question"}]
+    store.turns[-2:] = []
+
+    def size(objects) -> int:
+        total = 0
+        for o in objects:
+            total += sys.getsizeof(o)
+            values = o.values() if isinstance(o, dict) else [getattr(o, s) for s in Turn.__slots__]
+            total += sum(sys.getsizeof(v) for v in values if isinstance(v, (str, bytes)))
+        return total
+
+    # The message list shares its strings with the turns; the store builds it only for a request
+    before = size(turn_dicts) + sum(sys.getsizeof(m) for m in message_dicts)
+    after = size(store.turns)
+    print(f"{2 * turns} messages: {before / 1e6:.1f} MB as turns + messages dicts, "
+          f"{after / 1e6:.1f} MB in a TurnStore")
+
+
+if __name__ == "__main__":
+    _self_check()